@@ -0,0 +1,418 @@
+"""
+Benchmarks of the backend, run offline against local stand-ins of the external services (see lib/fake_services.py).
+
+    python benchmark.py session --players 2 10 50 --latency chat=1 images=3 search=0.3 --error-rate search=0.05
+    python benchmark.py session --players 10 --save baseline.json
+    python benchmark.py session --players 10 --compare baseline.json --tolerance 0.25
+    python benchmark.py derangement --sizes 100 10000 100000
+    python benchmark.py startup --budget 0.5
+    python benchmark.py parser --slides 10000 --fuzz 2000
+
+Every session runs in a fresh process, s.t. peak RSS and warm-up are measured per run.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+import uuid
+
+
+ROUTES = ["chat", "images", "search", "download", "frontend"]
+
+
+def parse_route_values(values: list[str]) -> dict[str, float]:
+    """ ["chat=0.5", "search=0.1"] -> {"chat": 0.5, "search": 0.1} ("all=..." sets every route) """
+    result = {}
+    for value in values or []:
+        route, _, number = value.partition("=")
+        if route == "all":
+            result.update({r: float(number) for r in ROUTES})
+        elif route in ROUTES:
+            result[route] = float(number)
+        else:
+            raise argparse.ArgumentTypeError(f"Unknown route '{route}' (choose from {', '.join(ROUTES)} or all).")
+    return result
+
+
+def serve_fake_services(latency: dict, error_rate: dict, seed: int, conn):
+    from lib.fake_services import FakeServiceOptions, FakeServices
+    services = FakeServices(FakeServiceOptions(latency=latency, error_rate=error_rate, seed=seed))
+    conn.send(services.url)
+    services.server.serve_forever()
+
+
+def fake_services_request(url: str, path: str) -> dict:
+    with urllib.request.urlopen(f"{url}/{path}") as res:
+        return json.loads(res.read())
+
+
+def peak_rss_mb(who: str) -> float | None:
+    """ Peak RSS of this process (RUSAGE_SELF) or its reaped children (RUSAGE_CHILDREN), None where unavailable (Windows). """
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(getattr(resource, who)).ru_maxrss / 1024
+
+
+def run_session(num_players: int, nonce: str, verbose: bool, conn):
+    """ Runs one session in this (fresh) process and sends the measurements. """
+    if not verbose:
+        sys.stdout = open(os.devnull, "w")
+    # Fresh search quota per run (quotas are kept per API key, see lib/rate_limit.py)
+    os.environ["GOOGLE_PSE_API_KEY"] = f"benchmark-{nonce}"
+    from lib.fake_services import synthetic_session_id
+    from lib.frontend import get_frontend_client
+    from lib.scheduler import StageScheduler
+    from lib.config import RENDER_PROCESSES
+    from main import generate_from_api
+    # Loaded while the session is watched (see main.py), not part of the measurement
+    import lib.generator
+
+    ready = []
+    scheduler = StageScheduler()
+    t0 = time.perf_counter()
+    try:
+        session = get_frontend_client().get_session(synthetic_session_id(num_players, nonce)).session
+        with scheduler:
+            presentations = generate_from_api(session,
+                                              launch=False,
+                                              pptx_output="memory",
+                                              scheduler=scheduler,
+                                              on_presentation_ready=lambda i, p: ready.append(time.perf_counter() - t0))
+        total = time.perf_counter() - t0
+        error = None
+    except Exception as e:
+        presentations, total, error = [], time.perf_counter() - t0, f"{type(e).__name__}: {e}"
+        scheduler.shutdown(wait=False)
+    if RENDER_PROCESSES > 0:
+        # Reap the render workers, s.t. their peak RSS is reported
+        from lib.render_pool import get_render_pool
+        get_render_pool().shutdown()
+
+    conn.send({
+        "players": num_players,
+        "presentations": len(presentations),
+        "failed": sum(1 for p in presentations if p.error is not None),
+        "first": ready[0] if ready else None,
+        "total": total,
+        "rss_mb": peak_rss_mb("RUSAGE_SELF"),
+        "worker_rss_mb": peak_rss_mb("RUSAGE_CHILDREN"),
+        "stages": {stage: vars(stats) for stage, stats in scheduler.stats.items()},
+        "error": error
+    })
+
+
+def print_result(result: dict):
+    first = f"{result['first']:.2f}s" if result["first"] is not None else "-"
+    rss, worker_rss = [f"{result[key]:.0f}" if result[key] is not None else "-" for key in ["rss_mb", "worker_rss_mb"]]
+    print(f"{result['players']:>7} {first:>9} {result['total']:>8.2f}s {rss:>8} {worker_rss:>10}   "
+          + " ".join(f"{result['calls'][r]:>5}/{result['errors'][r]:<3}" for r in ROUTES))
+    if result["error"]:
+        print(f"        Failed: {result['error']}")
+    if result.get("failed", 0):
+        print(f"        {result['failed']} of {result['presentations']} presentation(s) could not be generated")
+    for stage, stats in result["stages"].items():
+        print(f"        {stage:<10} {stats['calls']:>5} calls, {stats['busy_time']:>8.2f}s busy, {stats['wait_time']:>8.2f}s waiting")
+
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """ Regressions of the time to first presentation and the total time against a saved run (same player counts). """
+    baseline = {r["players"]: r for r in baseline}
+    regressions = []
+    for result in results:
+        base = baseline.get(result["players"], None)
+        if base is None:
+            continue
+        if result["error"] and not base["error"]:
+            regressions.append(f"{result['players']} players: {result['error']}")
+        for metric in ["first", "total"]:
+            if result[metric] is None or base[metric] is None:
+                continue
+            if result[metric] > (1 + tolerance) * base[metric]:
+                regressions.append(f"{result['players']} players: {metric} {result[metric]:.2f}s > {base[metric]:.2f}s + {tolerance:.0%}")
+    return regressions
+
+
+def benchmark_session(args) -> int:
+    latency = parse_route_values(args.latency)
+    error_rate = parse_route_values(args.error_rate)
+    context = multiprocessing.get_context()
+    # Slideshows are not launched
+    os.environ.setdefault("POWERPOINT_EXE_PATH", "")
+
+    receiver, sender = context.Pipe(duplex=False)
+    server = context.Process(target=serve_fake_services, args=(latency, error_rate, args.seed, sender), daemon=True)
+    server.start()
+    sender.close()
+    url = receiver.recv()
+
+    # Read by lib.config and the OpenAI client of the session processes
+    os.environ.update({
+        "OPENAI_BASE_URL": f"{url}/v1",
+        "OPENAI_API_KEY": "benchmark",
+        "GOOGLE_CSE_URL": f"{url}/customsearch/v1",
+        "GOOGLE_PSE_ID": "benchmark",
+        "FRONTEND_URL": url,
+        "COMPLETION_BACKEND": "openai",
+        "COMPLETION_CACHE": "0",
+        "GOOGLE_SEARCH_PER_MINUTE": "0",
+        "GOOGLE_SEARCH_DAILY_QUOTA": str(args.search_quota),
+    })
+
+    print(f"Fake services at {url}, latency {latency or '-'}, error rate {error_rate or '-'}")
+    print(f"{'players':>7} {'first':>9} {'total':>9} {'rss (MB)':>8} {'worker rss':>10}   " + " ".join(f"{r[:10]:>9}" for r in ROUTES))
+    results = []
+    for num_players in args.players:
+        for _ in range(args.repeat):
+            fake_services_request(url, "_reset")
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=run_session, args=(num_players, uuid.uuid4().hex[:8], args.verbose, sender))
+            process.start()
+            sender.close()
+            try:
+                result = receiver.recv()
+            except EOFError:
+                # Crashed without reporting
+                result = {"players": num_players, "presentations": 0, "failed": 0, "first": None, "total": 0, "rss_mb": 0, "worker_rss_mb": 0,
+                          "stages": {}, "error": f"Session process exited with code {process.exitcode}"}
+            process.join()
+            result.update(fake_services_request(url, "_stats"))
+            print_result(result)
+            results.append(result)
+    server.terminate()
+
+    if args.save:
+        json.dump(results, open(args.save, "w", encoding="utf8"), indent=2)
+        print(f"Saved results to {args.save}.")
+    if args.compare:
+        regressions = compare(results, json.load(open(args.compare, encoding="utf8")), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+        print("No regressions.")
+    return 1 if any(r["error"] for r in results) else 0
+
+
+def benchmark_derangement(args) -> int:
+    """ Time per element of the topic assignment (lib/utils.py) for growing sizes, should stay flat. Every sample is checked. """
+    os.environ.setdefault("POWERPOINT_EXE_PATH", "")
+    from lib.utils import random_chunk_derangement, random_derangement
+    print(f"{'size':>8} {'derangement':>14} {'chunks of ' + str(args.chunk):>14}")
+    invalid = 0
+    for n in args.sizes:
+        n -= n % args.chunk
+        xs = list(range(n))
+        times = []
+        for fn, chunk in [(random_derangement, 1), (lambda xs: random_chunk_derangement(xs, args.chunk), args.chunk)]:
+            t0 = time.perf_counter()
+            for _ in range(args.repeat):
+                ys = fn(xs)
+                invalid += sorted(ys) != xs or any(y // chunk == j // chunk for j, y in enumerate(ys))
+            times.append((time.perf_counter() - t0) / args.repeat / n * 1e6)
+        print(f"{n:>8} " + " ".join(f"{t:>10.2f} µs/el" for t in times))
+    if invalid:
+        print(f"{invalid} invalid sample(s).")
+    return 1 if invalid else 0
+
+
+FUZZ_TOKENS = ["**", "#", "## ", "- ", "* ", "1. ", "\t", "  ", "\n", "\r\n", "```", "---", "•", "ä", " "]
+
+
+def random_outline(rng, num_slides: int):
+    """ Random slides and their markdown, as an LLM should write it. """
+    from lib.markdown import Paragraph, Run, Slide
+    words = ["Titanic", "Eisberg", "Rettungsboot", "Kapitän", "Funkspruch", "Nordatlantik", "Überlebende", "1912", "Dampfmaschine", "Passagiere"]
+    slides, lines = [], ["# " + " ".join(rng.sample(words, 2))]
+    for i in range(num_slides):
+        slide = Slide(title=" ".join(rng.sample(words, 3)))
+        lines.append(f"## Folie {i + 1}: {slide.title}")
+        depth = -1
+        for _ in range(rng.randint(3, 7)):
+            depth = rng.randint(0, min(depth + 1, 3))
+            runs = []
+            for k in range(rng.randint(1, 3)):
+                runs.append(Run(("" if k == 0 else " ") + " ".join(rng.sample(words, rng.randint(1, 4))), bold=k % 2 == 1))
+            kind = rng.choice(["bullet", "bullet", "bullet", "numbered"])
+            number = rng.randint(1, 9) if kind == "numbered" else None
+            slide.paragraphs.append(Paragraph(kind, runs, depth=depth, number=number))
+            marker = f"{number}." if number is not None else "-"
+            lines.append("  " * depth + marker + " " + "".join(f" **{r.text.strip()}**" if r.bold else r.text for r in runs))
+        slides.append(slide)
+    return slides, "\n".join(lines)
+
+
+def check_slides(slides) -> list[str]:
+    """ Invariants of every parse result, however malformed the input. """
+    from lib.markdown import MAX_DEPTH
+    errors = []
+    for slide in slides:
+        if "**" in slide.title:
+            errors.append(f"Bold marker in title {slide.title!r}")
+        for paragraph in slide.paragraphs:
+            if not paragraph.runs or not 0 <= paragraph.depth <= MAX_DEPTH or (paragraph.kind == "numbered") != (paragraph.number is not None):
+                errors.append(f"Invalid paragraph {paragraph!r}")
+            if any(not run.text or "**" in run.text for run in paragraph.runs):
+                errors.append(f"Invalid runs {paragraph.runs!r}")
+    return errors
+
+
+def benchmark_parser(args) -> int:
+    """
+    Throughput of the outline parser (lib/markdown.py), and fuzzing: malformed input must parse, streamed as well as at once.
+    The repository has no test suite, so these checks live here: like startup --budget, a failure exits with 1.
+    """
+    os.environ.setdefault("POWERPOINT_EXE_PATH", "")
+    import random
+    from lib.markdown import IncrementalOutlineParser, parse_outline
+    rng = random.Random(args.seed)
+    failures = []
+
+    # Well-formed outlines parse back to their slides
+    slides, md = random_outline(rng, args.slides)
+    parsed = parse_outline(md)[1]
+    for expected, slide in zip(slides, parsed):
+        if (slide.title, [(p.kind, p.depth, p.number, [(r.text.strip(), r.bold) for r in p.runs]) for p in slide.paragraphs]) != \
+                (expected.title, [(p.kind, p.depth, p.number, [(r.text.strip(), r.bold) for r in p.runs]) for p in expected.paragraphs]):
+            failures.append(f"Round trip: {expected!r} parsed as {slide!r}")
+            break
+    if len(parsed) != len(slides):
+        failures.append(f"Round trip: {len(slides)} slides parsed as {len(parsed)}")
+
+    times = []
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        parse_outline(md)
+        times.append(time.perf_counter() - t0)
+    seconds = sorted(times)[len(times) // 2]
+    size = len(md.encode("utf8"))
+    print(f"parse_outline: {size / 1e6 / seconds:.1f} MB/s, {len(slides) / seconds:,.0f} slides/s "
+          f"({args.slides} slides, {md.count(chr(10)) + 1} lines, median of {args.repeat})")
+
+    # Malformed answers: mutated, truncated and reindented outlines
+    for k in range(args.fuzz):
+        _slides, md = random_outline(rng, rng.randint(0, 6))
+        chars = list(md)
+        for _ in range(rng.randint(1, 20)):
+            pos = rng.randrange(len(chars) + 1)
+            if rng.random() < 0.3 and chars:
+                del chars[min(pos, len(chars) - 1)]
+            else:
+                chars.insert(pos, rng.choice(FUZZ_TOKENS))
+        md = "".join(chars)[:rng.randint(0, len(chars))] if rng.random() < 0.2 else "".join(chars)
+        try:
+            whole = parse_outline(md)[1]
+            parser = IncrementalOutlineParser()
+            streamed = []
+            cuts = sorted(rng.sample(range(len(md) + 1), min(len(md) + 1, rng.randint(1, 8))))
+            for a, b in zip([0] + cuts, cuts + [len(md)]):
+                streamed += parser.feed(md[a:b])
+            streamed += parser.finish()
+        except Exception as e:
+            failures.append(f"Fuzz #{k}: {type(e).__name__}: {e} for {md!r}")
+            continue
+        if streamed != whole:
+            failures.append(f"Fuzz #{k}: Streamed parse differs for {md!r}")
+        failures += [f"Fuzz #{k}: {error}" for error in check_slides(whole)]
+    print(f"Fuzzing: {args.fuzz} malformed outlines, {len(failures)} failure(s).")
+    for failure in failures[:10]:
+        print(f"  {failure}")
+    return 1 if failures else 0
+
+
+# Only needed once a session is generated, must not be loaded by watching a session (see main.py)
+HEAVY_MODULES = ["openai", "pptx", "PIL", "tqdm", "lib.generator"]
+
+
+def import_times(stderr: str) -> list[tuple[str, float, int]]:
+    """ Parses the output of python -X importtime: (module, cumulative seconds, nesting level) """
+    times = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _self, cumulative, name = line[len("import time:"):].split("|")
+        times.append((name.strip(), int(cumulative) / 1e6, (len(name) - len(name.lstrip())) // 2))
+    return times
+
+
+def benchmark_startup(args) -> int:
+    """ Time to import main.py (what the session watcher loads before it starts polling) in fresh processes. """
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join([os.path.dirname(os.path.abspath(__file__)), os.environ.get("PYTHONPATH", "")])}
+    code = "import sys, time; t0 = time.perf_counter(); import main; print(time.perf_counter() - t0); print(' '.join(m for m in %r if m in sys.modules))" % HEAVY_MODULES
+    runs = []
+    for _ in range(args.repeat):
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=env, capture_output=True, text=True)
+        if process.returncode != 0:
+            print(process.stderr[-2000:])
+            return 1
+        seconds, loaded = (process.stdout.strip().split("\n") + [""])[:2]
+        runs.append((float(seconds), loaded.split(), process.stderr))
+    seconds, loaded, stderr = sorted(runs, key=lambda run: run[0])[len(runs) // 2]
+
+    print(f"import main: {seconds * 1000:.0f} ms (median of {len(runs)}, budget {args.budget * 1000:.0f} ms)")
+    # Most expensive imports by cumulative time (top-level imports of main only)
+    times = import_times(stderr)
+    top = [(name, cumulative) for name, cumulative, level in times if level <= 1 and name != "main"]
+    for name, cumulative in sorted(top, key=lambda item: -item[1])[:args.top]:
+        print(f"  {name:<40} {cumulative * 1000:>7.1f} ms")
+    failed = False
+    if loaded:
+        print(f"Heavy modules loaded at startup: {', '.join(loaded)}")
+        failed = True
+    if seconds > args.budget:
+        print(f"Startup exceeds the budget.")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("benchmark.py")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    session_parser = subparsers.add_parser("session", help="End-to-end sessions against local stand-ins of OpenAI, Google CSE and the frontend.")
+    session_parser.add_argument("--players", help="Session sizes to run (2-500).", type=int, nargs="+", default=[2, 10, 50])
+    session_parser.add_argument("--repeat", help="Runs per session size.", type=int, default=1)
+    session_parser.add_argument("--latency", help="Mean latency per route in seconds, e.g. chat=1.5 (routes: " + ", ".join(ROUTES) + ", all).",
+                                nargs="*", default=["chat=1", "images=3", "search=0.3", "download=0.1", "frontend=0.05"])
+    session_parser.add_argument("--error-rate", help="Error rate per route, e.g. search=0.05.", nargs="*", default=[])
+    session_parser.add_argument("--search-quota", help="Daily Google search quota per session, 0: unlimited.", type=int, default=0)
+    session_parser.add_argument("--seed", help="Seed of the fake services.", type=int, default=0)
+    session_parser.add_argument("--save", help="Save the results to a JSON file.", type=str, default=None)
+    session_parser.add_argument("--compare", help="Compare with saved results, exits with 1 on regressions.", type=str, default=None)
+    session_parser.add_argument("--tolerance", help="Allowed slowdown relative to the saved results.", type=float, default=0.25)
+    session_parser.add_argument("--verbose", help="Show the output of the backend.", action="store_true")
+
+    derangement_parser = subparsers.add_parser("derangement", help="Scaling of the topic assignment (derangements) with the number of items.")
+    derangement_parser.add_argument("--sizes", help="Numbers of items.", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000])
+    derangement_parser.add_argument("--chunk", help="Chunk size (topics per player).", type=int, default=3)
+    derangement_parser.add_argument("--repeat", help="Samples per size.", type=int, default=5)
+
+    startup_parser = subparsers.add_parser("startup", help="Import time of main.py (session watcher), with a budget.")
+    startup_parser.add_argument("--budget", help="Maximum import time in seconds, exits with 1 if exceeded.", type=float, default=0.5)
+    startup_parser.add_argument("--repeat", help="Fresh processes to measure (median).", type=int, default=5)
+    startup_parser.add_argument("--top", help="Number of imports to show.", type=int, default=10)
+
+    parser_parser = subparsers.add_parser("parser", help="Throughput of the markdown outline parser, and fuzzing with malformed outlines (exits with 1 on failures).")
+    parser_parser.add_argument("--slides", help="Slides of the outline to parse.", type=int, default=10000)
+    parser_parser.add_argument("--repeat", help="Parses to measure (median).", type=int, default=5)
+    parser_parser.add_argument("--fuzz", help="Number of malformed outlines.", type=int, default=2000)
+    parser_parser.add_argument("--seed", help="Seed of the generated outlines.", type=int, default=0)
+
+    args = parser.parse_args()
+    if args.command == "session":
+        if any(n < 2 or n > 500 for n in args.players):
+            parser.error("--players must be between 2 and 500.")
+        sys.exit(benchmark_session(args))
+    if args.command == "derangement":
+        if any(n < 2 * args.chunk for n in args.sizes):
+            parser.error("--sizes must be at least two chunks.")
+        sys.exit(benchmark_derangement(args))
+    if args.command == "startup":
+        sys.exit(benchmark_startup(args))
+    if args.command == "parser":
+        sys.exit(benchmark_parser(args))
@@ -0,0 +1,55 @@
+"""
+Offline bulk generation for events planned ahead (see lib/bulk.py). Every step can be interrupted and resumed.
+
+    python bulk.py prepare tmp/bulk/event --topics template/topics/topics-50-1.json --presentations 16 --backend openai
+    python bulk.py run tmp/bulk/event
+    python bulk.py status tmp/bulk/event
+"""
+import argparse
+import json
+from pathlib import Path
+import sys
+
+from lib.bulk import BULK_BACKENDS, BulkJob, prepare_job, read_jsonl, run_job
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("bulk.py")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    prepare_parser = subparsers.add_parser("prepare", help="Assign topics, generate the prompts and write the request file.")
+    prepare_parser.add_argument("job", help="Job directory.", type=str)
+    prepare_parser.add_argument("--topics", help="JSON file with a list of topics.", type=str, required=True)
+    prepare_parser.add_argument("--presentations", help="Number of presentations (3 topics each).", type=int, required=True)
+    prepare_parser.add_argument("--speakers", help="Speaker names (default: numbered).", type=str, nargs="*", default=None)
+    prepare_parser.add_argument("--language", help="Language of the presentations.", type=str, default="de")
+    prepare_parser.add_argument("--backend", help="Batch backend.", choices=list(BULK_BACKENDS), default="local")
+
+    run_parser = subparsers.add_parser("run", help="Submit, wait for the answers and generate the presentations (resumes where it stopped).")
+    run_parser.add_argument("job", help="Job directory.", type=str)
+    run_parser.add_argument("--poll-interval", help="Seconds between status requests.", type=float, default=None)
+    run_parser.add_argument("--no-openai-images", help="Do not generate an image per presentation.", action="store_true")
+    run_parser.add_argument("--no-google-images", help="Do not search images for the slides.", action="store_true")
+
+    status_parser = subparsers.add_parser("status", help="Show the state of a job.")
+    status_parser.add_argument("job", help="Job directory.", type=str)
+
+    args = parser.parse_args()
+    if args.command == "prepare":
+        topics = json.load(open(args.topics, encoding="utf8"))
+        try:
+            prepare_job(args.job, topic_pool=topics, num_presentations=args.presentations, language=args.language,
+                        speakers=args.speakers, backend=args.backend)
+        except ValueError as e:
+            parser.error(str(e))
+    elif not (Path(args.job) / "job.json").exists():
+        parser.error(f"No bulk job in {args.job}, prepare it first.")
+    elif args.command == "run":
+        job = run_job(args.job, poll_interval=args.poll_interval, openai_images=not args.no_openai_images, google_images=not args.no_google_images)
+        print(f"Bulk job {job.directory}: {job.status}.")
+    elif args.command == "status":
+        job = BulkJob.load(args.job)
+        num_presentations = len(job.presentations())
+        num_done = len({row["custom_id"] for row in read_jsonl(job.directory / "done.jsonl")})
+        print(f"Bulk job {job.directory}: {job.status} (backend {job.backend}, batch {job.batch_id or '-'}), {num_done}/{num_presentations} presentation(s) done.")
+    sys.exit(0)
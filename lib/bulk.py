@@ -0,0 +1,346 @@
+"""
+Bulk mode for events planned ahead: throughput instead of interactive latency.
+A job is a directory, every step records its progress there, s.t. an interrupted job is resumed by running it again:
+
+    job.json             state (backend, batch ID, status)
+    presentations.json   topics, prompts and templates (prepare_job)
+    requests.jsonl       one chat completion request per presentation (OpenAI batch input format)
+    results.jsonl        answers (OpenAI batch output format)
+    done.jsonl           rendered presentations
+    pptx/                .pptx files
+"""
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import hashlib
+import json
+import random
+import time
+from threading import Lock
+from openai import OpenAI
+
+from lib.generator import assign_topics, generate_presentation, plan_image_searches
+from lib.markdown import parse_outline
+from lib.openai_access import CompletionBackend, get_completion_backend
+from lib.presentation import Presentation
+from lib.prompts import generate_prompts
+from lib.scheduler import StageScheduler
+from lib.search_planner import SearchPlanner
+from lib.utils import *
+from lib.config import *
+
+
+def read_jsonl(path: Path) -> list[dict]:
+    if not path.exists():
+        return []
+    with open(path, "r", encoding="utf8") as f:
+        # A line cut off by an interruption is ignored (and redone)
+        lines = [line for line in f.read().split("\n") if line.strip()]
+    rows = []
+    for line in lines:
+        try:
+            rows.append(json.loads(line))
+        except json.JSONDecodeError:
+            pass
+    return rows
+
+
+def append_jsonl(path: Path, rows: list[dict]):
+    with open(path, "a", encoding="utf8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+def write_json_atomic(path: Path, data):
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    json.dump(data, open(tmp_path, "w", encoding="utf8"), ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def answer_of(result: dict) -> str | None:
+    """ Completion text of a batch output line, None if the request failed. """
+    response = result.get("response", None) or {}
+    if result.get("error", None) or response.get("status_code", None) != 200:
+        return None
+    try:
+        return response["body"]["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+class BulkBackend(ABC):
+    """ Batch-style completion service: takes a JSONL file of requests, answers them at some point. """
+
+    @abstractmethod
+    def submit(self, requests_path: Path) -> str:
+        """ Returns the batch ID. """
+        pass
+
+    @abstractmethod
+    def status(self, batch_id: str) -> str:
+        """ "in_progress", "completed" or "failed" """
+        pass
+
+    @abstractmethod
+    def download(self, batch_id: str, results_path: Path):
+        pass
+
+
+class OpenAiBulkBackend(BulkBackend):
+    """ OpenAI Batch API (half the price, results within 24 hours). """
+
+    def __init__(self, client: OpenAI = None):
+        self.client = client or OpenAI()
+
+    def submit(self, requests_path: Path) -> str:
+        file = self.client.files.create(file=open(requests_path, "rb"), purpose="batch")
+        batch = self.client.batches.create(input_file_id=file.id, endpoint="/v1/chat/completions", completion_window="24h")
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        status = self.client.batches.retrieve(batch_id).status
+        if status == "completed":
+            return "completed"
+        if status in ["failed", "expired", "cancelled"]:
+            return "failed"
+        return "in_progress"
+
+    def download(self, batch_id: str, results_path: Path):
+        batch = self.client.batches.retrieve(batch_id)
+        text = ""
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            if file_id:
+                text += self.client.files.content(file_id).text.rstrip("\n") + "\n"
+        with open(results_path, "w", encoding="utf8") as f:
+            f.write(text)
+
+
+class LocalBulkBackend(BulkBackend):
+    """
+    Stand-in that answers the requests with the configured completion backend (e.g. COMPLETION_BACKEND=local for tests),
+    a few requests per status poll. Its progress is kept in BULK_DIR/local, s.t. it survives interruptions as well.
+    """
+
+    def __init__(self, completion_backend: CompletionBackend = None, directory: Path = None, requests_per_poll: int = 16, max_workers: int = 4):
+        self.completion_backend = completion_backend
+        self.directory = Path(directory or BULK_DIR / "local")
+        self.requests_per_poll = requests_per_poll
+        self.max_workers = max_workers
+
+    def submit(self, requests_path: Path) -> str:
+        data = open(requests_path, "rb").read()
+        batch_id = "local-batch-" + hashlib.sha256(data).hexdigest()[:16]
+        batch_dir = self.directory / batch_id
+        batch_dir.mkdir(parents=True, exist_ok=True)
+        open(batch_dir / "input.jsonl", "wb").write(data)
+        return batch_id
+
+    def _answer(self, request: dict) -> dict:
+        backend = self.completion_backend or get_completion_backend()
+        body = request["body"]
+        try:
+            completion = backend.complete(messages=body["messages"], model=body["model"])
+        except Exception as e:
+            return {"custom_id": request["custom_id"], "response": None, "error": {"message": f"{type(e).__name__}: {e}"}}
+        return {
+            "custom_id": request["custom_id"],
+            "response": {"status_code": 200, "body": {"choices": [{"message": {"role": "assistant", "content": completion.answer}}], "usage": completion.usage}},
+            "error": None
+        }
+
+    def status(self, batch_id: str) -> str:
+        batch_dir = self.directory / batch_id
+        if not (batch_dir / "input.jsonl").exists():
+            return "failed"
+        answered = {row["custom_id"] for row in read_jsonl(batch_dir / "output.jsonl")}
+        pending = [request for request in read_jsonl(batch_dir / "input.jsonl") if request["custom_id"] not in answered]
+        if not pending:
+            return "completed"
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            results = list(pool.map(self._answer, pending[:self.requests_per_poll]))
+        append_jsonl(batch_dir / "output.jsonl", results)
+        return "completed" if len(pending) <= self.requests_per_poll else "in_progress"
+
+    def download(self, batch_id: str, results_path: Path):
+        open(results_path, "wb").write(open(self.directory / batch_id / "output.jsonl", "rb").read())
+
+
+BULK_BACKENDS = {
+    "openai": OpenAiBulkBackend,
+    "local": LocalBulkBackend,
+}
+
+
+PRESENTATION_FIELDS = ["speaker", "topic", "wrong_topics", "prompt", "prompt_additions", "num_slides", "speaker_instruction", "image_query_suffix"]
+
+
+@dataclass
+class BulkJob:
+    directory: Path
+    language: str = "de"
+    backend: str = "local"
+    batch_id: str | None = None
+    status: str = "prepared"  # prepared, submitted, downloaded, done
+    created: str = field(default_factory=NOW)
+
+    @property
+    def path(self) -> Path:
+        return self.directory / "job.json"
+
+    def save(self):
+        write_json_atomic(self.path, {k: v for k, v in vars(self).items() if k != "directory"})
+
+    @classmethod
+    def load(cls, directory: Path) -> "BulkJob":
+        directory = Path(directory)
+        if not (directory / "job.json").exists():
+            raise ValueError(f"No bulk job in {directory}, prepare it first.")
+        return cls(directory=directory, **json.load(open(directory / "job.json", encoding="utf8")))
+
+    def presentations(self) -> dict[str, Presentation]:
+        """ Presentations (with their template) by custom ID of their request. """
+        presentations = {}
+        for data in json.load(open(self.directory / "presentations.json", encoding="utf8")):
+            presentation = Presentation(**{k: data[k] for k in PRESENTATION_FIELDS})
+            presentation.pptx_template_path = PPTX_TEMPLATE_DIR / data["template"]
+            presentations[data["custom_id"]] = presentation
+        return presentations
+
+
+def prepare_job(directory: Path,
+                topic_pool: list[str],
+                num_presentations: int,
+                language: str = "de",
+                speakers: list[str] = None,
+                backend: str = "local",
+                num_wrong_topics: int = 2) -> BulkJob:
+    """ Assigns topics from the pool, generates the prompts and writes the request file. """
+    directory = Path(directory)
+    if (directory / "job.json").exists():
+        raise ValueError(f"Bulk job {directory} exists already, run it to resume.")
+    if backend not in BULK_BACKENDS:
+        raise ValueError(f"Unknown bulk backend '{backend}'.")
+    m = 1 + num_wrong_topics
+    if num_presentations < 2 or m * num_presentations > len(topic_pool):
+        raise ValueError(f"prepare_job: {len(topic_pool)} topics are enough for 2-{len(topic_pool) // m} presentations.")
+    speakers = speakers or [f"Vortrag {i + 1}" for i in range(num_presentations)]
+    directory.mkdir(parents=True, exist_ok=True)
+
+    presentations = assign_topics(player_names=speakers[:num_presentations], topic_pool=random.sample(topic_pool, m * num_presentations))
+    generate_prompts(presentations=presentations, language=language, num_wrong_topics=num_wrong_topics)
+    template_files = [f.name for f in os.scandir(PPTX_TEMPLATE_DIR) if f.is_file()]
+    templates = sample_minimal_repitions(template_files, len(presentations))
+
+    rows, requests = [], []
+    for i, (presentation, template) in enumerate(zip(presentations, templates)):
+        custom_id = f"presentation-{i + 1:04d}"
+        rows.append({"custom_id": custom_id, "template": template, **{k: getattr(presentation, k) for k in PRESENTATION_FIELDS}})
+        requests.append({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": COMPLETION_MODEL, "messages": [{"role": "user", "content": presentation.prompt}]}
+        })
+    write_json_atomic(directory / "presentations.json", rows)
+    open(directory / "requests.jsonl", "w").close()
+    append_jsonl(directory / "requests.jsonl", requests)
+    job = BulkJob(directory=directory, language=language, backend=backend)
+    job.save()
+    print(f"Bulk job {directory}: Prepared {len(requests)} request(s).")
+    return job
+
+
+def run_job(directory: Path,
+            bulk_backend: BulkBackend = None,
+            poll_interval: float = None,
+            openai_images: bool = True,
+            google_images: bool = True,
+            stage_limits: dict[str, int] = None) -> BulkJob:
+    """ Runs (or resumes) all remaining steps of a job: submit, poll, download, then generate the presentations. """
+    job = BulkJob.load(directory)
+    bulk_backend = bulk_backend or BULK_BACKENDS[job.backend]()
+    poll_interval = BULK_POLL_INTERVAL if poll_interval is None else poll_interval
+
+    if job.status == "prepared":
+        job.batch_id = bulk_backend.submit(job.directory / "requests.jsonl")
+        job.status = "submitted"
+        job.save()
+        print(f"Bulk job {job.directory}: Submitted batch {job.batch_id}.")
+
+    if job.status == "submitted":
+        while (status := bulk_backend.status(job.batch_id)) == "in_progress":
+            print(f"Bulk job {job.directory}: Batch {job.batch_id} in progress ...")
+            time.sleep(poll_interval)
+        if status == "failed":
+            # Every presentation is then requested individually by the pipeline
+            print(f"Bulk job {job.directory}: Batch {job.batch_id} failed.")
+            open(job.directory / "results.jsonl", "w").close()
+        else:
+            bulk_backend.download(job.batch_id, job.directory / "results.jsonl")
+        job.status = "downloaded"
+        job.save()
+
+    if job.status == "downloaded":
+        generate_job_presentations(job, openai_images=openai_images, google_images=google_images, stage_limits=stage_limits)
+        job.status = "done"
+        job.save()
+    return job
+
+
+def generate_job_presentations(job: BulkJob, openai_images: bool = True, google_images: bool = True, stage_limits: dict[str, int] = None):
+    """
+    Parses the answers and runs the image and pptx stages of all presentations that are not done yet.
+    Presentations without a usable answer are requested individually.
+    """
+    answers = {result["custom_id"]: answer_of(result) for result in read_jsonl(job.directory / "results.jsonl")}
+    done = {row["custom_id"] for row in read_jsonl(job.directory / "done.jsonl")}
+    presentations = {custom_id: p for custom_id, p in job.presentations().items() if custom_id not in done}
+    if not presentations:
+        return
+    num_answers = 0
+    for custom_id, presentation in presentations.items():
+        presentation.markdown = answers.get(custom_id, None)
+        _topic, slides = parse_outline(presentation.markdown)
+        if slides:
+            num_answers += 1
+        else:
+            presentation.markdown = None
+    print(f"Bulk job {job.directory}: {len(done)} presentation(s) done, generating {len(presentations)} "
+          f"({len(presentations) - num_answers} without usable answer are requested individually) ...")
+
+    # Searches of presentations with the same topic are sent once
+    search_planner = SearchPlanner()
+    if google_images:
+        plan_image_searches(list(presentations.values()), planner=search_planner, language=job.language, openai_images=openai_images)
+    pptx_dir = job.directory / "pptx"
+    pptx_dir.mkdir(parents=True, exist_ok=True)
+    lock = Lock()
+
+    def generate(i: int, custom_id: str, presentation: Presentation):
+        generate_presentation(presentation=presentation,
+                              index=i,
+                              openai_client=get_completion_backend(),
+                              scheduler=scheduler,
+                              language=job.language,
+                              openai_images=openai_images,
+                              google_images=google_images,
+                              stream_completions=False,
+                              search_planner=search_planner,
+                              pptx_output="memory")
+        path = presentation.pptx.save(pptx_dir)
+        with lock:
+            append_jsonl(job.directory / "done.jsonl", [{"custom_id": custom_id, "speaker": presentation.speaker,
+                                                         "topic": presentation.topic, "pptx_path": str(path)}])
+
+    failed = 0
+    with StageScheduler(limits=stage_limits) as scheduler:
+        futures = {custom_id: scheduler.submit_presentation(generate, i, custom_id, presentation)
+                   for i, (custom_id, presentation) in enumerate(presentations.items())}
+        for custom_id, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Bulk job {job.directory}: {custom_id} failed: {type(e).__name__}: {e}")
+    if failed:
+        raise RuntimeError(f"{failed} presentation(s) failed, run the job again to retry them.")
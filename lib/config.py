@@ -25,5 +25,116 @@ ESCAPE_PATH = lambda q: re.sub(r"[^A-Za-z0-9]", "", q)
 
 LANGUAGES = ["de", "en"]
 
-PPT_EXE = Path(os.environ.get('POWERPOINT_EXE_PATH'))
+PPT_EXE = Path(os.environ['POWERPOINT_EXE_PATH']) if os.environ.get('POWERPOINT_EXE_PATH') else None  # Only needed to launch the slideshows
 
+
+# Worker processes rendering the .pptx files, 0: render in the pipeline threads (see lib/render_pool.py)
+RENDER_PROCESSES = int(os.getenv("RENDER_PROCESSES", os.cpu_count() or 1))
+
+# Concurrency limits of the presentation pipeline stages (see lib/scheduler.py)
+STAGE_CONCURRENCY = {
+    "completion": int(os.getenv("STAGE_CONCURRENCY_COMPLETION", 4)),
+    "image": int(os.getenv("STAGE_CONCURRENCY_IMAGE", 2)),
+    "search": int(os.getenv("STAGE_CONCURRENCY_SEARCH", 4)),
+    "download": int(os.getenv("STAGE_CONCURRENCY_DOWNLOAD", 8)),
+    "normalize": int(os.getenv("STAGE_CONCURRENCY_NORMALIZE", os.cpu_count() or 2)),
+    "render": int(os.getenv("STAGE_CONCURRENCY_RENDER", max(2, RENDER_PROCESSES))),
+}
+MAX_CONCURRENT_PRESENTATIONS = int(os.getenv("MAX_CONCURRENT_PRESENTATIONS", 6))
+
+# Image downloads (see lib/downloads.py)
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", 10))
+DOWNLOAD_MAX_WORKERS = int(os.getenv("DOWNLOAD_MAX_WORKERS", 16))
+DOWNLOAD_MAX_PER_HOST = int(os.getenv("DOWNLOAD_MAX_PER_HOST", 4))
+
+# Google Custom Search API endpoint (overridden by the benchmark's local stand-in)
+GOOGLE_CSE_URL = os.getenv("GOOGLE_CSE_URL", "https://www.googleapis.com/customsearch/v1")
+
+# Rate limits (requests per minute) and daily quotas of the external APIs, 0: unlimited (see lib/rate_limit.py)
+GOOGLE_SEARCH_PER_MINUTE = float(os.getenv("GOOGLE_SEARCH_PER_MINUTE", 100))
+GOOGLE_SEARCH_DAILY_QUOTA = int(os.getenv("GOOGLE_SEARCH_DAILY_QUOTA", 100))  # Free tier of the Custom Search API
+OPENAI_CHAT_PER_MINUTE = float(os.getenv("OPENAI_CHAT_PER_MINUTE", 0))
+OPENAI_CHAT_DAILY_QUOTA = int(os.getenv("OPENAI_CHAT_DAILY_QUOTA", 0))
+OPENAI_IMAGE_PER_MINUTE = float(os.getenv("OPENAI_IMAGE_PER_MINUTE", 0))
+OPENAI_IMAGE_DAILY_QUOTA = int(os.getenv("OPENAI_IMAGE_DAILY_QUOTA", 0))
+QUOTA_RESET_UTC_OFFSET = float(os.getenv("QUOTA_RESET_UTC_OFFSET", -8))  # hours, daily quotas reset at midnight of this time zone
+
+# Google image searches per presentation (see lib/search_planner.py): slides sharing one search, results per search (max. 10)
+IMAGE_SEARCH_SLIDES_PER_QUERY = int(os.getenv("IMAGE_SEARCH_SLIDES_PER_QUERY", 5))
+IMAGE_SEARCH_NUM = min(int(os.getenv("IMAGE_SEARCH_NUM", 10)), 10)
+
+# Persistent caches (see lib/cache.py)
+CACHE_DIR = TMP_DIR / "cache"
+SEARCH_CACHE_PATH = CACHE_DIR / "search.sqlite"
+QUOTA_PATH = CACHE_DIR / "quota.sqlite"
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", 7 * 24 * 3600))  # seconds
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 5000))
+
+# Content-addressed image store (see lib/image_store.py)
+IMG_STORE_DIR = IMG_DIR / "store"
+IMG_STORE_MAX_URLS = int(os.getenv("IMG_STORE_MAX_URLS", 100000))
+
+# Completions (see lib/openai_access.py)
+COMPLETION_BACKEND = os.getenv("COMPLETION_BACKEND", "openai")  # "openai" or "local" (offline stand-in)
+COMPLETION_MODEL = os.getenv("COMPLETION_MODEL", "gpt-3.5-turbo-0125")
+COMPLETION_CACHE = os.getenv("COMPLETION_CACHE", "1") == "1"
+COMPLETION_CACHE_PATH = CACHE_DIR / "completions.sqlite"
+COMPLETION_CACHE_TTL = float(os.getenv("COMPLETION_CACHE_TTL", 30 * 24 * 3600))  # seconds
+COMPLETION_CACHE_MAX_ENTRIES = int(os.getenv("COMPLETION_CACHE_MAX_ENTRIES", 2000))
+STREAM_COMPLETIONS = os.getenv("STREAM_COMPLETIONS", "1") == "1"  # Parse slides while the answer is streamed
+COMPLETION_BATCH_SIZE = int(os.getenv("COMPLETION_BATCH_SIZE", 0))  # Presentations per completion request (except the first one), 0/1: one request each
+
+# Offline bulk jobs (see lib/bulk.py)
+BULK_DIR = TMP_DIR / "bulk"
+BULK_POLL_INTERVAL = float(os.getenv("BULK_POLL_INTERVAL", 60))  # seconds between status requests of a submitted batch
+
+# Speaker instruction stock (see lib/instructions.py)
+INSTRUCTION_STOCK_PATH = CACHE_DIR / "instructions.sqlite"
+INSTRUCTION_STOCK_MIN = int(os.getenv("INSTRUCTION_STOCK_MIN", 50))  # Fresh instructions to keep per language at least
+INSTRUCTION_STOCK_SESSIONS = float(os.getenv("INSTRUCTION_STOCK_SESSIONS", 5))  # Keep enough fresh instructions for this many sessions of the usual size
+INSTRUCTION_MAX_USES = int(os.getenv("INSTRUCTION_MAX_USES", 3))  # Instructions used this often are no longer fresh (only sampled if nothing else is left)
+INSTRUCTION_REQUEST_MAX = int(os.getenv("INSTRUCTION_REQUEST_MAX", 60))  # Instructions per OpenAI request
+
+# Resilience of the OpenAI requests (see lib/resilience.py)
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", 60))  # seconds per attempt, 0: none
+OPENAI_RETRIES = int(os.getenv("OPENAI_RETRIES", 3))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", 1))  # seconds, doubled per retry (with jitter)
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", 30))  # seconds
+OPENAI_HEDGE = os.getenv("OPENAI_HEDGE", "0") == "1"  # Send a duplicate completion request if the first one is slower than the p95
+OPENAI_HEDGE_MIN_SAMPLES = int(os.getenv("OPENAI_HEDGE_MIN_SAMPLES", 20))  # Completions needed before hedging
+
+# Frontend API (see lib/frontend.py)
+FRONTEND_TIMEOUT = float(os.getenv("FRONTEND_TIMEOUT", 10))
+FRONTEND_MAX_WORKERS = int(os.getenv("FRONTEND_MAX_WORKERS", 8))
+FRONTEND_BATCH_INSTRUCTIONS = os.getenv("FRONTEND_BATCH_INSTRUCTIONS", "0") == "1"  # Needs the setStyleInstructions endpoint
+
+# Session watching (see lib/session_watcher.py)
+SESSION_WATCH_MODE = os.getenv("SESSION_WATCH_MODE", "auto")  # auto, sse, longpoll, webhook or poll
+SESSION_POLL_INTERVAL = float(os.getenv("SESSION_POLL_INTERVAL", 3))
+SESSION_LONG_POLL_TIMEOUT = float(os.getenv("SESSION_LONG_POLL_TIMEOUT", 30))
+SESSION_SSE_READ_TIMEOUT = float(os.getenv("SESSION_SSE_READ_TIMEOUT", 60))
+SESSION_WEBHOOK_HOST = os.getenv("SESSION_WEBHOOK_HOST", "127.0.0.1")  # Interface of the webhook receiver, loopback only by default
+SESSION_WEBHOOK_PORT = int(os.getenv("SESSION_WEBHOOK_PORT", 0))  # 0: any free port
+SESSION_WEBHOOK_URL = os.getenv("SESSION_WEBHOOK_URL", None)  # Public URL of the webhook receiver, if not localhost
+SESSION_WEBHOOK_SAFETY_POLL = float(os.getenv("SESSION_WEBHOOK_SAFETY_POLL", 30))
+
+# Multi-session daemon, main.py --serve (see lib/daemon.py)
+DAEMON_HOST = os.getenv("DAEMON_HOST", "127.0.0.1")
+DAEMON_PORT = int(os.getenv("DAEMON_PORT", 8765))
+DAEMON_MAX_SESSIONS = int(os.getenv("DAEMON_MAX_SESSIONS", 16))  # Sessions watched/generated concurrently
+DAEMON_JOB_HISTORY = int(os.getenv("DAEMON_JOB_HISTORY", 1000))  # Finished sessions kept for status requests
+DAEMON_TOKEN = os.getenv("DAEMON_TOKEN", None)  # Bearer token required by the HTTP endpoint, if set
+
+# Speculative pre-generation while the session is READY (see lib/speculation.py)
+SPECULATE_COMPLETIONS = os.getenv("SPECULATE_COMPLETIONS", "0") == "1"
+
+# Tracing of the pipeline stages, one Chrome trace per session (see lib/tracing.py)
+TRACE_SESSIONS = os.getenv("TRACE_SESSIONS", "1") == "1"
+TRACE_DIR = TMP_DIR / "traces"
+
+# Image normalization before rendering (see lib/image_processing.py)
+NORMALIZE_IMAGES = os.getenv("NORMALIZE_IMAGES", "1") == "1"
+IMAGE_BOX_CM = (11.5, 12.57)  # Max. width and height of slide images
+IMAGE_DPI = int(os.getenv("IMAGE_DPI", 150))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", 85))
+IMAGE_MAX_UNCHANGED_BYTES = int(os.getenv("IMAGE_MAX_UNCHANGED_BYTES", 300 * 1024))  # Smaller images that fit the box are kept as they are
@@ -0,0 +1,187 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+import http.server
+import json
+from threading import Lock
+from typing import Callable
+
+from lib.scheduler import StageScheduler, tenant
+from lib.config import *
+
+
+@dataclass
+class SessionJob:
+    session_id: str
+    state: str = "queued"  # queued, running, done or failed
+    submitted: datetime = field(default_factory=datetime.now)
+    started: datetime | None = None
+    finished: datetime | None = None
+    num_presentations: int | None = None
+    error: str | None = None
+    future: Future | None = field(default=None, repr=False)
+
+    @property
+    def active(self) -> bool:
+        return self.state in ["queued", "running"]
+
+    def to_dict(self) -> dict:
+        return {
+            "sessionId": self.session_id,
+            "state": self.state,
+            "submitted": self.submitted.isoformat(),
+            "started": self.started.isoformat() if self.started else None,
+            "finished": self.finished.isoformat() if self.finished else None,
+            "numPresentations": self.num_presentations,
+            "error": self.error
+        }
+
+
+class SessionDaemon:
+    """
+    Long-running service that handles many sessions concurrently, submitted via submit() or the HTTP endpoint (see serve()).
+    All sessions share one StageScheduler, whose stage slots and threads are given to the sessions round-robin,
+    as well as the process-wide clients, connection pools, caches and rate limiters.
+    """
+
+    def __init__(self,
+                 run_session: Callable[..., list],  # run_session(session_id, scheduler=...) watches and generates one session
+                 max_sessions: int = None,
+                 scheduler: StageScheduler = None,
+                 job_history: int = None):
+        self.run_session = run_session
+        self.max_sessions = max_sessions or DAEMON_MAX_SESSIONS
+        self.scheduler = scheduler or StageScheduler()
+        self.job_history = job_history or DAEMON_JOB_HISTORY
+        self.jobs: OrderedDict[str, SessionJob] = OrderedDict()
+        self._lock = Lock()
+        self._pool = ThreadPoolExecutor(max_workers=self.max_sessions, thread_name_prefix="session")
+
+    def submit(self, session_id: str) -> SessionJob:
+        """ Queues the session, unless it is already queued or running. """
+        if not re.match(r"^[A-Za-z0-9\-]+$", session_id):
+            raise ValueError("Invalid session ID.")
+        with self._lock:
+            job = self.jobs.get(session_id, None)
+            if job is not None and job.active:
+                return job
+            job = SessionJob(session_id=session_id)
+            self.jobs.pop(session_id, None)
+            self.jobs[session_id] = job
+            job.future = self._pool.submit(self._run, job)
+        print(f"Daemon: Queued session {session_id}.")
+        return job
+
+    def _run(self, job: SessionJob):
+        job.state = "running"
+        job.started = datetime.now()
+        try:
+            # Everything this session schedules is accounted to it
+            with tenant(job.session_id):
+                presentations = self.run_session(job.session_id, scheduler=self.scheduler)
+            job.num_presentations = len(presentations or [])
+            job.state = "done"
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            job.state = "failed"
+            print(f"Daemon: Session {job.session_id} failed: {job.error}")
+        finally:
+            job.finished = datetime.now()
+            self._prune()
+        print(f"Daemon: Session {job.session_id} {job.state} ({(job.finished - job.started).total_seconds():.1f}s).")
+
+    def _prune(self):
+        """ Forgets the oldest finished jobs beyond the history size. """
+        with self._lock:
+            finished = [session_id for session_id, job in self.jobs.items() if not job.active]
+            for session_id in finished[:max(0, len(finished) - self.job_history)]:
+                del self.jobs[session_id]
+
+    def get(self, session_id: str) -> SessionJob | None:
+        with self._lock:
+            return self.jobs.get(session_id, None)
+
+    def status(self) -> dict:
+        with self._lock:
+            jobs = list(self.jobs.values())
+        return {
+            "ok": True,
+            "sessions": {state: sum(1 for job in jobs if job.state == state) for state in ["queued", "running", "done", "failed"]},
+            "stages": {stage: vars(stats) for stage, stats in self.scheduler.stats.items()}
+        }
+
+    def serve(self, host: str = None, port: int = None):
+        """
+        Blocking HTTP endpoint:
+        - POST /sessions with {"sessionId": ...} or {"sessionIds": [...]}: queue sessions (202)
+        - GET /sessions, GET /sessions/<id>: job states
+        - GET /health: number of sessions per state and stage statistics
+        Requests need "Authorization: Bearer <DAEMON_TOKEN>" if a token is configured.
+        """
+        daemon = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def _send(self, status: int, data):
+                body = json.dumps(data).encode("utf8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _authorized(self) -> bool:
+                if DAEMON_TOKEN and self.headers.get("Authorization", "") != f"Bearer {DAEMON_TOKEN}":
+                    self._send(401, {"error": {"message": "Unauthorized"}})
+                    return False
+                return True
+
+            def do_GET(self):
+                if not self._authorized():
+                    return
+                path = self.path.split("?")[0].rstrip("/")
+                if path == "/health":
+                    return self._send(200, daemon.status())
+                if path == "/sessions":
+                    with daemon._lock:
+                        jobs = list(daemon.jobs.values())
+                    return self._send(200, {"sessions": [job.to_dict() for job in jobs]})
+                if path.startswith("/sessions/"):
+                    job = daemon.get(path[len("/sessions/"):])
+                    if job is None:
+                        return self._send(404, {"error": {"message": "Unknown session"}})
+                    return self._send(200, job.to_dict())
+                self._send(404, {"error": {"message": "Not found"}})
+
+            def do_POST(self):
+                if not self._authorized():
+                    return
+                if self.path.split("?")[0].rstrip("/") != "/sessions":
+                    return self._send(404, {"error": {"message": "Not found"}})
+                try:
+                    payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                    session_ids = payload.get("sessionIds", []) + ([payload["sessionId"]] if "sessionId" in payload else [])
+                    if not session_ids:
+                        raise ValueError("No session ID given.")
+                    jobs = [daemon.submit(session_id) for session_id in session_ids]
+                except (ValueError, AttributeError, TypeError) as e:
+                    return self._send(400, {"error": {"message": str(e)}})
+                self._send(202, {"sessions": [job.to_dict() for job in jobs]})
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host or DAEMON_HOST, port if port is not None else DAEMON_PORT), Handler)
+        print(f"Daemon: Accepting sessions at http://{server.server_address[0]}:{server.server_address[1]}/sessions "
+              f"(up to {self.max_sessions} concurrently).")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.shutdown(wait=False)
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait)
+        self.scheduler.shutdown(wait=wait)
@@ -0,0 +1,103 @@
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextvars import copy_context
+from threading import BoundedSemaphore, Event, Lock
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from lib.scheduler import StageScheduler, stage_slot
+from lib.tracing import span
+from lib.config import *
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class DownloadEngine:
+    """ Downloads files concurrently over a shared keep-alive session, with a connection cap per host. """
+
+    def __init__(self,
+                 max_workers: int = None,
+                 max_per_host: int = None,
+                 timeout: float = None):
+        self.max_workers = max_workers or DOWNLOAD_MAX_WORKERS
+        self.max_per_host = max_per_host or DOWNLOAD_MAX_PER_HOST
+        self.timeout = timeout or DOWNLOAD_TIMEOUT
+
+        self.session = requests.Session()
+        self.session.headers.update({"User-Agent": "karaokay"})
+        adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="download")
+        self._host_semaphores = defaultdict(lambda: BoundedSemaphore(self.max_per_host))
+        self._host_lock = Lock()
+
+    def _host_semaphore(self, url: str) -> BoundedSemaphore:
+        host = urllib.parse.urlparse(url).netloc.lower()
+        with self._host_lock:
+            return self._host_semaphores[host]
+
+    def _download(self, img, cancel: Event, scheduler: StageScheduler = None) -> bool:
+        if cancel.is_set():
+            return False
+        with self._host_semaphore(img.url), stage_slot(scheduler, "download"):
+            if cancel.is_set():
+                return False
+            try:
+                with span("download", url=img.url, result_index=img.result_index):
+                    img.download(session=self.session, timeout=self.timeout, cancel=cancel)
+            except DownloadCancelled:
+                return False
+            except requests.RequestException as e:
+                print(f"Download of {img.url} failed: {type(e).__name__}")
+                return False
+            except (OSError, ValueError) as e:
+                # Storing (or decoding) the file failed, the other candidates are still fine
+                print(f"Download of {img.url} failed: {type(e).__name__}: {e}")
+                return False
+        return img.downloaded
+
+    def download_first(self, imgs: list, num_downloads: int = None, scheduler: StageScheduler = None) -> list:
+        """
+        Downloads the given images concurrently until num_downloads of them succeeded (all if None).
+        Remaining downloads are cancelled. Returns the downloaded images in their original order.
+        """
+        if not imgs:
+            return []
+        cancel = Event()
+        pending = {self._pool.submit(copy_context().run, self._download, img, cancel, scheduler) for img in imgs}
+        download_counter = 0
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            download_counter += sum(1 for future in done if future.result())
+            if num_downloads is not None and download_counter >= num_downloads:
+                cancel.set()
+                # In-flight downloads notice the cancellation on their next chunk, no need to wait for them
+                for future in pending:
+                    future.cancel()
+                break
+
+        downloaded = [img for img in imgs if img.downloaded]
+        return downloaded[:num_downloads] if num_downloads is not None else downloaded
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+        self.session.close()
+
+
+_engine = None
+_engine_lock = Lock()
+
+
+def get_download_engine() -> DownloadEngine:
+    """ Process-wide download engine, s.t. all searches share the connection pool. """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = DownloadEngine()
+        return _engine
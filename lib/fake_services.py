@@ -0,0 +1,276 @@
+import base64
+from dataclasses import dataclass, field
+import hashlib
+import http.server
+import io
+import json
+import random
+import time
+from threading import Lock, Thread
+import urllib.parse
+
+from PIL import Image as PILImage
+
+from lib.openai_access import LocalBackend
+from lib.types import SessionState
+from lib.config import *
+
+
+ROUTES = ["chat", "images", "search", "download", "frontend"]
+
+
+@dataclass
+class FakeServiceOptions:
+    latency: dict[str, float] = field(default_factory=lambda: {})  # Mean response time per route (seconds)
+    error_rate: dict[str, float] = field(default_factory=lambda: {})  # Share of failing requests per route
+    seed: int | None = None
+    image_size: tuple[int, int] = (800, 600)  # Images served for search results
+    num_base_images: int = 8
+
+
+def synthetic_session_id(num_players: int, nonce: str) -> str:
+    return f"bench-{num_players}-{nonce}"
+
+
+def synthetic_session(session_id: str, num_topics: int = 3) -> dict:
+    """ Closed session with the number of players encoded in the ID (see synthetic_session_id). """
+    _, num_players, nonce = session_id.split("-", 2)
+    topic_pool = json.load(open(TEMPLATE_DIR / "topics" / "topics-50-1.json", encoding="utf8"))
+    rng = random.Random(session_id)
+    players = []
+    for i in range(int(num_players)):
+        # The nonce makes the topics unique, s.t. the persistent caches do not answer the requests
+        topics = [{"name": f"{topic} {nonce}"} for topic in rng.sample(topic_pool, num_topics)]
+        players.append({
+            "id": f"player-{i}-{nonce}",
+            "name": f"Spieler {i + 1}",
+            "sessionId": session_id,
+            "isSpeaker": True,
+            "state": SessionState.CLOSED.value,
+            "topics": topics
+        })
+    return {"id": session_id, "state": SessionState.CLOSED.value, "players": players}
+
+
+class FakeServices:
+    """
+    Local stand-ins for the external services, served by one HTTP server:
+    - OpenAI chat completions (incl. streaming) and image generation: /v1/...
+    - Google Custom Search API: /customsearch/v1
+    - Image hosting of the search results: /img/...
+    - Frontend API with synthetic sessions: /api/session/...
+    Every route has a configurable latency and error rate. Calls and errors are counted per route (/_stats).
+    """
+
+    def __init__(self, options: FakeServiceOptions = None, host: str = "127.0.0.1", port: int = 0):
+        self.options = options or FakeServiceOptions()
+        self.backend = LocalBackend()
+        self._rng = random.Random(self.options.seed)
+        self._lock = Lock()
+        self.calls = {route: 0 for route in ROUTES}
+        self.errors = {route: 0 for route in ROUTES}
+        self.base_images = [self._noise_jpeg(i) for i in range(self.options.num_base_images)]
+
+        services = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                services._handle(self, "GET")
+
+            def do_POST(self):
+                services._handle(self, "POST")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": dict(self.calls), "errors": dict(self.errors)}
+
+    def reset(self):
+        with self._lock:
+            self.calls = {route: 0 for route in ROUTES}
+            self.errors = {route: 0 for route in ROUTES}
+
+    def _noise_jpeg(self, i: int) -> bytes:
+        width, height = self.options.image_size
+        rng = random.Random(f"{self.options.seed}-{i}")
+        img = PILImage.frombytes("RGB", (width, height), rng.randbytes(width * height * 3))
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=85)
+        return buffer.getvalue()
+
+    def _delay(self, route: str) -> float:
+        latency = self.options.latency.get(route, 0)
+        with self._lock:
+            return latency * self._rng.uniform(0.5, 1.5)
+
+    def _count(self, route: str) -> bool:
+        """ Counts the call, returns True if it is to fail. """
+        with self._lock:
+            self.calls[route] += 1
+            failed = self._rng.random() < self.options.error_rate.get(route, 0)
+            if failed:
+                self.errors[route] += 1
+            return failed
+
+    @staticmethod
+    def _send(handler, status: int, body: bytes, content_type: str = "application/json"):
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _send_json(self, handler, status: int, data):
+        self._send(handler, status, json.dumps(data, ensure_ascii=False).encode("utf8"))
+
+    def _handle(self, handler, method: str):
+        url = urllib.parse.urlparse(handler.path)
+        path = url.path
+        query = dict(urllib.parse.parse_qsl(url.query))
+        body = None
+        if method == "POST":
+            length = int(handler.headers.get("Content-Length", 0))
+            body = handler.rfile.read(length) if length else b""
+
+        if path == "/_stats":
+            return self._send_json(handler, 200, self.stats())
+        if path == "/_reset":
+            self.reset()
+            return self._send_json(handler, 200, {})
+
+        if path == "/v1/chat/completions" and method == "POST":
+            route = "chat"
+        elif path == "/v1/images/generations" and method == "POST":
+            route = "images"
+        elif path == "/customsearch/v1":
+            route = "search"
+        elif path.startswith("/img/"):
+            route = "download"
+        elif path.startswith("/api/session/"):
+            route = "frontend"
+        else:
+            return self._send_json(handler, 404, {"error": {"message": "Not found"}})
+
+        failed = self._count(route)
+        delay = self._delay(route)
+        if failed:
+            time.sleep(delay)
+            if route == "search":
+                return self._send_json(handler, 429, {"error": {"code": 429, "message": "Quota exceeded (injected error)."}})
+            return self._send_json(handler, 500 if route in ["chat", "images"] else 503,
+                                   {"error": {"message": "Injected error.", "type": "server_error"}})
+
+        if route == "chat":
+            self._chat(handler, json.loads(body), delay)
+        elif route == "images":
+            time.sleep(delay)
+            self._image(handler, json.loads(body))
+        elif route == "search":
+            time.sleep(delay)
+            self._search(handler, query)
+        elif route == "download":
+            time.sleep(delay)
+            self._download(handler, path)
+        else:
+            time.sleep(delay)
+            self._frontend(handler, method, path)
+
+    def _chat(self, handler, request: dict, delay: float):
+        answer = self.backend.complete(request["messages"], request["model"]).answer
+        created = int(time.time())
+        if not request.get("stream", False):
+            time.sleep(delay)
+            return self._send_json(handler, 200, {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": created,
+                "model": request["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(answer.split()), "total_tokens": len(answer.split())}
+            })
+
+        # Streamed line by line, the latency is spread over the answer (first token after 20 %)
+        lines = answer.splitlines(keepends=True)
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        time.sleep(0.2 * delay)
+        for line in lines:
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": request["model"],
+                "choices": [{"index": 0, "delta": {"content": line}, "finish_reason": None}]
+            }
+            handler.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf8"))
+            handler.wfile.flush()
+            time.sleep(0.8 * delay / len(lines))
+        handler.wfile.write(b"data: [DONE]\n\n")
+        handler.close_connection = True
+
+    def _image(self, handler, request: dict):
+        image = self.backend.generate_image(request["prompt"], request.get("model", "dall-e-3"), request.get("size", "1024x1024"))
+        self._send_json(handler, 200, {
+            "created": int(time.time()),
+            "data": [{"b64_json": base64.b64encode(image.data).decode("ascii"), "revised_prompt": image.revised_prompt}]
+        })
+
+    def _search(self, handler, query: dict):
+        q = query.get("q", "")
+        num = int(query.get("num", 10))
+        start = int(query.get("start", 1))
+        width, height = self.options.image_size
+        digest = hashlib.sha256(q.encode("utf8")).hexdigest()[:16]
+        items = [{
+            "title": f"{q} - Bild {i}",
+            "link": f"{self.url}/img/{digest}-{i}.jpg",
+            "fileFormat": "image/jpeg",
+            "image": {
+                "contextLink": f"{self.url}/page/{digest}-{i}",
+                "width": width,
+                "height": height,
+                "byteSize": len(self.base_images[0])
+            }
+        } for i in range(start, start + num)]
+        self._send_json(handler, 200, {
+            "queries": {"request": [{"searchTerms": q, "count": num, "startIndex": start}]},
+            "items": items
+        })
+
+    def _download(self, handler, path: str):
+        name = path.rsplit("/", 1)[-1]
+        digest = hashlib.sha256(name.encode("utf8")).digest()
+        # Unique bytes per URL (appended after the JPEG data), s.t. the image store does not deduplicate them
+        data = self.base_images[digest[0] % len(self.base_images)] + digest
+        self._send(handler, 200, data, content_type="image/jpeg")
+
+    def _frontend(self, handler, method: str, path: str):
+        parts = path[len("/api/session/"):].strip("/").split("/")
+        session_id = parts[0]
+        if method == "GET" and len(parts) == 1:
+            return self._send_json(handler, 200, {"session": synthetic_session(session_id)})
+        if method == "POST" and parts[1:] == ["setStyleInstructions"]:
+            return self._send_json(handler, 200, {"results": []})
+        if method == "POST" and len(parts) == 4 and parts[1] == "player" and parts[3] == "setStyleInstruction":
+            return self._send_json(handler, 200, {})
+        self._send_json(handler, 404, {"error": {"message": "Not found"}})
@@ -0,0 +1,174 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from lib.config import *
+
+
+@dataclass
+class StyleInstructionUpdate:
+    session_id: str
+    player_id: str
+    instruction: str | None
+
+
+@dataclass
+class DeliveryResult:
+    player_id: str
+    ok: bool
+    status_code: int | None = None
+    error: str | None = None
+
+
+@dataclass
+class DeliveryReport:
+    results: list[DeliveryResult] = field(default_factory=lambda: [])
+    batched: bool = False
+
+    @property
+    def delivered(self) -> list[DeliveryResult]:
+        return [r for r in self.results if r.ok]
+
+    @property
+    def failed(self) -> list[DeliveryResult]:
+        return [r for r in self.results if not r.ok]
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
+    def summary(self) -> str:
+        lines = [f"Delivered {len(self.delivered)}/{len(self.results)} speaker instruction(s){' (batch)' if self.batched else ''}."]
+        lines += [f"  Player {r.player_id}: " + (f"Error {r.status_code}: " if r.status_code else "") + (r.error or "Unknown error") for r in self.failed]
+        return "\n".join(lines)
+
+
+def error_message(res: requests.Response) -> str | None:
+    try:
+        res_data = res.json()
+    except ValueError:
+        return res.reason
+    if isinstance(res_data, dict) and "error" in res_data:
+        return res_data["error"].get("message", None)
+    return res.reason
+
+
+@dataclass
+class SessionResponse:
+    status_code: int
+    session: dict | None  # None if not modified
+    etag: str | None = None
+    last_modified: str | None = None
+
+    @property
+    def modified(self) -> bool:
+        return self.session is not None
+
+
+class FrontendClient:
+    """ Client of the frontend API, sharing one pooled keep-alive session for all requests. """
+
+    def __init__(self, base_url: str = None, timeout: float = None, max_workers: int = None):
+        self.base_url = (base_url or os.getenv("FRONTEND_URL") or "").rstrip("/")
+        self.timeout = timeout or FRONTEND_TIMEOUT
+        self.max_workers = max_workers or FRONTEND_MAX_WORKERS
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}/api/{path.lstrip('/')}"
+
+    def get_session(self, session_id: str, etag: str = None, last_modified: str = None, params: dict = None, timeout: float = None) -> SessionResponse:
+        """ Fetches the session, conditionally if etag/last_modified of a previous response are given. """
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        res = self.session.get(self.url(f"session/{session_id}"), headers=headers, params=params, timeout=timeout or self.timeout)
+        if res.status_code == 304:
+            return SessionResponse(status_code=304, session=None, etag=etag, last_modified=last_modified)
+        if not res.ok:
+            message = error_message(res)
+            if message:
+                print(f"Error {res.status_code}: {message}")
+            raise ValueError(f"Request failed (status code {res.status_code})")
+        return SessionResponse(status_code=res.status_code,
+                               session=res.json()["session"],
+                               etag=res.headers.get("ETag", None),
+                               last_modified=res.headers.get("Last-Modified", None))
+
+    def set_style_instruction(self, update: StyleInstructionUpdate) -> DeliveryResult:
+        url = self.url(f"session/{update.session_id}/player/{update.player_id}/setStyleInstruction")
+        try:
+            res = self.session.post(url, data={"styleInstruction": update.instruction} if update.instruction else {}, timeout=self.timeout)
+        except requests.RequestException as e:
+            return DeliveryResult(player_id=update.player_id, ok=False, error=f"{type(e).__name__}: {e}")
+        if not res.ok:
+            return DeliveryResult(player_id=update.player_id, ok=False, status_code=res.status_code, error=error_message(res))
+        return DeliveryResult(player_id=update.player_id, ok=True, status_code=res.status_code)
+
+    def set_style_instructions_batch(self, session_id: str, updates: list[StyleInstructionUpdate]) -> DeliveryReport | None:
+        """ Sends all instructions of a session in one request. Returns None if the frontend does not support batches. """
+        url = self.url(f"session/{session_id}/setStyleInstructions")
+        payload = {"instructions": [{"playerId": u.player_id, "styleInstruction": u.instruction} for u in updates]}
+        try:
+            res = self.session.post(url, json=payload, timeout=self.timeout)
+        except requests.RequestException as e:
+            return DeliveryReport(results=[DeliveryResult(player_id=u.player_id, ok=False, error=f"{type(e).__name__}: {e}") for u in updates], batched=True)
+        if res.status_code in [404, 405, 501]:
+            return None
+        if not res.ok:
+            message = error_message(res)
+            return DeliveryReport(results=[DeliveryResult(player_id=u.player_id, ok=False, status_code=res.status_code, error=message) for u in updates], batched=True)
+
+        # Per-player confirmations, if the frontend reports them
+        try:
+            confirmed = {r["playerId"]: r for r in res.json().get("results", [])}
+        except (ValueError, AttributeError, KeyError, TypeError):
+            confirmed = {}
+        results = []
+        for u in updates:
+            r = confirmed.get(u.player_id, {"ok": True})
+            ok = bool(r.get("ok", True))
+            results.append(DeliveryResult(player_id=u.player_id, ok=ok, status_code=res.status_code if ok else None, error=r.get("error", None)))
+        return DeliveryReport(results=results, batched=True)
+
+    def set_style_instructions(self, updates: list[StyleInstructionUpdate], batch: bool = None) -> DeliveryReport:
+        """ Delivers the instructions, as one batch request per session if enabled, and concurrently otherwise. """
+        batch = FRONTEND_BATCH_INSTRUCTIONS if batch is None else batch
+        batched_results = []
+        if batch:
+            sessions = {}
+            for u in updates:
+                sessions.setdefault(u.session_id, []).append(u)
+            reports = {session_id: self.set_style_instructions_batch(session_id, session_updates) for session_id, session_updates in sessions.items()}
+            batched_results = [r for report in reports.values() if report is not None for r in report.results]
+            # Batch endpoint is not available for these sessions, fall back to single requests
+            updates = [u for u in updates if reports[u.session_id] is None]
+            if not updates:
+                return DeliveryReport(results=batched_results, batched=True)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="frontend") as pool:
+            results = list(pool.map(self.set_style_instruction, updates))
+        return DeliveryReport(results=batched_results + results, batched=bool(batched_results))
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = Lock()
+
+
+def get_frontend_client() -> FrontendClient:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = FrontendClient()
+        return _client
@@ -1,29 +1,37 @@
 
+from concurrent.futures import Future
 import json
 import math
 import subprocess
 from pathlib import Path
 from threading import Thread
+from typing import Callable, Literal
 
-from openai import OpenAI
-import requests
-from tqdm import tqdm
 
 from lib.presentation import Presentation
-from lib.prompts import generate_prompts
-from lib.openai_access import openai_image_request, openai_request
-from lib.markdown import parse_md_outline
-from lib.google_images import GoogleImage, google_image_search, preprocess_query
+from lib.prompts import batch_prompt, generate_prompts, split_batch_answer
+from lib.openai_access import CompletionBackend, StreamInterrupted, get_completion_backend, openai_image_request, openai_request, openai_stream_request
+from lib.markdown import IncrementalOutlineParser, Slide, parse_outline
+from lib.frontend import StyleInstructionUpdate, get_frontend_client
+from lib.image_processing import normalize_image_in_place
+from lib.instructions import get_instruction_stock
 from lib.pptx_factory import make_pptx
+from lib.rate_limit import ApiLimiter, get_rate_limiter
+from lib.render_pool import RenderSpec, get_render_pool
+from lib.scheduler import StageScheduler
+from lib.search_planner import SearchPlanner, StreamedImages
+from lib.tracing import event, run_in_span, span
 from lib.utils import *
 from lib.config import *
 
 
-launch_queue = []
-
 PPTX_TEMPLATES = []
 
 
+NUM_INSTRUCTIONS_PER_PLAYER = 3  # including one hard-coded
+OR = {"de": "ODER", "en": "OR"}
+
+
 def generate_presentations(player_names: list[str],
                            language: str,
                            players: list[dict] = None,  # Player data as received from API
@@ -32,67 +40,52 @@ def generate_presentations(player_names: list[str],
                            openai_images: bool = True,  # Only one slide
                            google_images: bool = True,  # Rest of the slides
                            launch_first: bool = False,
-                           launch_all: bool = False):
-    openai_client = OpenAI()
+                           launch_all: bool = False,
+                           stage_limits: dict[str, int] = None,  # Concurrency per pipeline stage, see lib/scheduler.py
+                           presentations: list[Presentation] = None,  # Prepared presentations (e.g. from speculation), skips assignment and prompts
+                           instruction_pool: list[str] = None,  # Prefetched speaker instructions
+                           stream_completions: bool = None,  # Search slide images while the text is generated
+                           batch_size: int = None,  # Presentations per completion request, see request_batched_markdown
+                           pptx_output: Literal["file", "memory"] = "file",  # "memory": keep the .pptx in presentation.pptx instead of PPTX_DIR
+                           scheduler: StageScheduler = None,  # Shared scheduler, owned (and shut down) by the caller
+                           search_planner: SearchPlanner = None,  # Shares the Google searches of the session (e.g. with speculation)
+                           on_presentation_ready: Callable[[int, Presentation], None] = None) -> list[Presentation]:  # Called in speaker order
+    openai_client = get_completion_backend()
 
-    print("Assigning topics ...")
-    presentations = assign_topics(player_names=player_names, players=players, topic_pool=topic_pool, topic_groups=topic_groups)
-    # for p in presentations:
-    #     print(p.player)
-    # print([p.player.get("isSpeaker", None) for p in presentations])
-    # return
-    if players:
-        presentations = [p for p in presentations if p.player.get("isSpeaker", True)]
-
-    print("Generating prompts ...")
-    generate_prompts(presentations=presentations,
-                     language=language)
-    
-    print(f"Generated prompts for {len(presentations)} presentation(s).")
+    if presentations is None:
+        presentations = prepare_presentations(player_names=player_names,
+                                              language=language,
+                                              players=players,
+                                              topic_pool=topic_pool,
+                                              topic_groups=topic_groups)
 
     if players:
-        print(f"Accessing OpenAI for speaker instructions ...")
-        num_instructions_per_player = 3  # including one hard-coded
-        k = num_instructions_per_player - 1
-        num_prompt_instructions = math.ceil((k + 0.5) * len(presentations))
-        INSTRUCTION_PROMPT = {
-            "de": f'Wir spielen Powerpoint-Karaoke, d.h. der Vortragende hat die Folien noch nie gesehen. Ich suche kreative Ideen für Anweisungen an den Vortragenden bzgl. Vortragsstil oder überraschenden Aktionen während des Vortrags. Bitte gib {num_prompt_instructions} Ideen für solche Anweisungen. Antworte im JSON-Format. Die Antwort ist eine JSON-Liste, die ausschließlich die Anweisungen als strings enthält.'
-        }
-        OR = {"de": "ODER", "en": "OR"}
-        num_retries = 3
-        while num_retries > 0:
-            instruction_pool = json.loads(openai_request(openai_client, INSTRUCTION_PROMPT[language], save_chat=True, name="instructions"))
-            # print(type(instruction_pool), instruction_pool)
-            if isinstance(instruction_pool, dict):
-                print("Converting response from dict to list ...")
-                if len(instruction_pool) == 1:
-                    instruction_pool = list(instruction_pool.values())[0]
-                else:
-                    instruction_pool = list(instruction_pool.values())
-
-            if not isinstance(instruction_pool, list) or len(instruction_pool) < .75 * num_prompt_instructions or len(instruction_pool) > 1.25 * num_prompt_instructions or not all(isinstance(v, str) for v in instruction_pool):
-                print(f"Instruction response is malformatted, trying again ({num_retries} remaining) ...")
-                num_retries -= 1
-                continue
-            print(f"Received {len(instruction_pool)} instructions (requested {num_prompt_instructions})")
-            instruction_pool = sample_minimal_repitions(list(instruction_pool), k * len(presentations))
-            break
+        k = NUM_INSTRUCTIONS_PER_PLAYER - 1
+        if instruction_pool is None:
+            # Sampled from the local stock, which is refilled in the background
+            with span("instruction_sampling", num_presentations=len(presentations)):
+                instruction_pool = get_instruction_stock().take(language, k * len(presentations))
+        instruction_pool = sample_minimal_repitions(list(instruction_pool), k * len(presentations)) if instruction_pool else []
 
         # Send speaker instructions to API
         print("Sending speaker instructions ...")
-        for i, (player, presentation) in tqdm(enumerate(zip(players, presentations))):
+        updates = []
+        for i, presentation in enumerate(presentations):
             player_instruction_choice = instruction_pool[i * k:(i + 1) * k]
             player_instruction_choice += [presentation.speaker_instruction] if presentation.speaker_instruction else []
             presentation.speaker_instruction = f" [{OR[language]}] ".join(player_instruction_choice)
-            url = f"{os.getenv('FRONTEND_URL')}/api/session/{player['sessionId']}/player/{player['id']}/setStyleInstruction"
-            res = requests.post(url, data={"styleInstruction": presentation.speaker_instruction} if presentation.speaker_instruction else {})
-            if not res.ok:
-                res_data = res.json()
-                if "error" in res_data:
-                    print(f"Error {res.status_code}: {res_data['error']['message']}")
+            updates.append(StyleInstructionUpdate(session_id=presentation.session_id,
+                                                  player_id=presentation.player_id,
+                                                  instruction=presentation.speaker_instruction))
+        with span("instruction_delivery", num_updates=len(updates)):
+            delivery_report = get_frontend_client().set_style_instructions(updates)
+        delivery_results = {result.player_id: result for result in delivery_report.results}
+        for presentation in presentations:
+            presentation.instruction_delivery = delivery_results.get(presentation.player_id, None)
+        print(delivery_report.summary())
     else:
         print("Speaker style instructions are disbaled without API access.")
-    
+
     # for p in presentations:
     #     print(p.speaker, p.topic)
     #     print("Instructions: {p.speaker_instruction}")
@@ -105,101 +98,343 @@ def generate_presentations(player_names: list[str],
     for template, presentation in zip(templates, presentations):
         presentation.pptx_template_path = PPTX_TEMPLATE_DIR / template
 
-    for i, presentation in enumerate(presentations):
-        
-        print(f"Presentation #{i+1} ({presentation.speaker}): Accessing OpenAI ...")
-        # OpenAI request
-        presentation.markdown = openai_request(openai_client, presentation.prompt, save_chat=True, name="presentation")
-
-        # Parse markdown
-        _topic, contents = parse_md_outline(presentation.markdown)
-        num_slides = len(contents)
-        presentation.images = []
-
-        print(f"OpenAI images: {'enabled' if openai_images else 'disabled'}, Google images: {'enabled' if google_images else 'disabled'}")
-        if openai_images:
-            # Image OpenAI request
-            # Find slide with wrong topic
-            print("Requesting image from OpenAI ...")
-            join_slide_text = lambda slide: "\n".join([slide["title"], *[text for format, text, *rest in slide["content"]]])
-            wrong_topic_slides = [(j, wt, slide) for j, slide in enumerate(contents) for wt in presentation.wrong_topics if wt.lower() in join_slide_text(slide).lower()]
-            if wrong_topic_slides:
-                j, wt, slide = random.choice(wrong_topic_slides)
-                img_prompt = f"""Generiere ein Foto, das zu einer Powerpoint Folie zum Thema "{presentation.topic}" passt. Das Bild soll die Verbindung vom Thema "{wt}" zeigen."""
-            else:
-                j = random.choice(list(range(num_slides)))
-                img_prompt = f"""Generiere ein Foto, das zu einer Powerpoint Folie zum Thema "{presentation.topic}" passt. Die Folie hat den folgenden Inhalt:\n""" + contents[j]["content"]
+    search_planner = search_planner or SearchPlanner()
+    if google_images:
+        # Decide how many searches each presentation gets before starting, instead of running into the quota
+        plan_image_searches(presentations, planner=search_planner, language=language, openai_images=openai_images)
 
+    owns_scheduler = scheduler is None
+    if owns_scheduler:
+        scheduler = StageScheduler(limits=stage_limits)
+    try:
+        batch_size = COMPLETION_BATCH_SIZE if batch_size is None else batch_size
+        if batch_size > 1:
+            # The first presentation is requested (and streamed) on its own, s.t. the first slideshow is not delayed
+            request_batched_markdown(openai_client, presentations[1:], language=language, scheduler=scheduler, batch_size=batch_size)
+        # Presentations (and their slides) are generated concurrently, but collected in speaker order.
+        futures = [scheduler.submit_presentation(run_in_span, "presentation", {"player": presentation.player_id,
+                                                                               "speaker": presentation.speaker,
+                                                                               "presentation": i + 1,
+                                                                               "topic": presentation.topic},
+                                                 generate_presentation,
+                                                 presentation=presentation,
+                                                 index=i,
+                                                 openai_client=openai_client,
+                                                 scheduler=scheduler,
+                                                 language=language,
+                                                 openai_images=openai_images,
+                                                 google_images=google_images,
+                                                 stream_completions=stream_completions,
+                                                 search_planner=search_planner,
+                                                 pptx_output=pptx_output) for i, presentation in enumerate(presentations)]
+        launched = False
+        for i, (presentation, future) in enumerate(zip(presentations, futures)):
             try:
-                img = openai_image_request(client=openai_client, topic=f'{presentation.topic}-{slide["title"]}', prompt=img_prompt, save_chat=True, name="img")
-                slide["img"] = img
-                presentation.images.append({
-                    "source": "openai",
-                    "slide": j + 1,
-                    "image": img
-                })
+                future.result()
             except Exception as e:
-                print("OpenAI image generation failed.")
-                print(e)
-        
-        if google_images:
-            # Rest of the slides:
-            # Google image search
-            print("Accessing google images and downloading images ...")
-            for j, slide in tqdm(enumerate(contents)):
-                if slide.get("img", None) is not None:
-                    # Already added from openai
-                    pass
-                query = f"{presentation.topic} {slide['title']}"
-                if presentation.image_query_suffix:
-                    query += " " + presentation.image_query_suffix
-                query = preprocess_query(query, language)
-                imgs, res, parameters = google_image_search(query=query, imgSize=None, safe="active", num_downloads=1)
-                
-                if "error" in res and res["error"]["code"] == 429:
-                    print("Quota for google search exceeded. Disabling image search.")
-                    images = False
-                    break
-                if not imgs:
-                    # No search results, slide stays without image
-                    continue
-                img = imgs[0]
-                slide["img"] = img
-                presentation.images.append({
-                    "source": "google",
-                    "slide": j + 1,
-                    "image": img,
-                    "search": {
-                        "query": query,
-                        "parameters": parameters,
-                        "results": res
-                    },
-                    "all_images": imgs
+                # The other presentations are still shown
+                presentation.error = f"{type(e).__name__}: {e}"
+                print(f"Presentation #{i+1} ({presentation.speaker}) failed: {presentation.error}")
+                event("presentation_failed", presentation=i + 1, player=presentation.player_id, error=presentation.error)
+                continue
+            event("presentation_ready", presentation=i + 1, player=presentation.player_id)
+            if on_presentation_ready is not None:
+                on_presentation_ready(i, presentation)
+
+            # When first presentation is ready, start slideshows in separate thread.
+            # This way, the remaining presentations are generated in the background.
+            if not launched and (launch_first or launch_all):
+                launched = True
+                launch_thread = Thread(target=launch_presentations, kwargs={
+                    "presentations": presentations,
+                    "launch_all": launch_all,
+                    "futures": futures
                 })
+                launch_thread.start()
+    finally:
+        if owns_scheduler:
+            scheduler.shutdown()
+    if google_images:
+        print(search_planner.summary())
+    return presentations
+
+
+def generate_presentation(presentation: Presentation,
+                          index: int,
+                          openai_client: CompletionBackend,
+                          scheduler: StageScheduler,
+                          language: str,
+                          openai_images: bool = True,
+                          google_images: bool = True,
+                          stream_completions: bool = None,
+                          search_planner: SearchPlanner = None,
+                          pptx_output: Literal["file", "memory"] = "file"):
+    """ Runs the pipeline of a single presentation: text, images and pptx. """
+    i = index
+    stream_completions = STREAM_COMPLETIONS if stream_completions is None else stream_completions
+    search_planner = search_planner or SearchPlanner()
+
+    presentation.images = []
+    if google_images:
+        # The searches for the topic do not need the slides, they run while the text is generated
+        search_planner.prefetch(presentation, language=language, scheduler=scheduler,
+                                num_slides=(presentation.num_slides or 5) - (1 if openai_images else 0))
+
+    print(f"Presentation #{i+1} ({presentation.speaker}): Accessing OpenAI ...")
+    # OpenAI request
+    if presentation.markdown is None and presentation.pending_markdown is not None:
+        # Speculatively requested while the session was still open
+        presentation.markdown = presentation.pending_markdown.result()
+    contents = None
+    streamed = None
+    if presentation.markdown is None and stream_completions:
+        # Slides are parsed while the answer is streamed, their images are searched right away
+        parser = IncrementalOutlineParser()
+        chunks = []
+        if google_images and presentation.image_search_mode != "none":
+            streamed = StreamedImages(search_planner, presentation, language=language, scheduler=scheduler)
+
+        emitted = []
+
+        def start_image_search(slides: list[Slide]):
+            # Completed slides are returned in order
+            for slide in slides:
+                j = len(emitted)
+                emitted.append(slide)
+                # Slides with a wrong topic may get the OpenAI image, they are searched once it is chosen
+                if streamed is not None and not (openai_images and any(wt.lower() in slide.text.lower() for wt in presentation.wrong_topics)):
+                    streamed.add(j, slide)
 
-        # Generate pptx file
-        pptx_path = make_pptx(pptx_template_path=presentation.pptx_template_path,
-                              topic=presentation.topic,
-                              speaker=presentation.speaker,
-                              contents=contents)
-        presentation.pptx_path = pptx_path
-        print(f"Saved .pptx file.")
-        # print(f"Saved .pptx file to {pptx_path}.")
-
-        launch_queue.append(presentation)
-
-        # When first presentation is ready, start slideshows in separate thread.
-        # This way, the remaining presentations are generated in the background.
-        if i == 0 and (launch_first or launch_all):
-            launch_thread = Thread(target=launch_presentations, kwargs={
-                "presentations": presentations,
-                "launch_all": launch_all
+        try:
+            with scheduler.stage("completion"):
+                for chunk in openai_stream_request(openai_client, presentation.prompt, save_chat=True, name="presentation"):
+                    chunks.append(chunk)
+                    start_image_search(parser.feed(chunk))
+            start_image_search(parser.finish())
+            if parser.slides:
+                presentation.markdown = "".join(chunks)
+                contents = parser.slides
+            else:
+                # Empty (or unusable) answer, handled like an interrupted stream
+                print(f"Presentation #{i+1}: Streamed answer has no slides, requesting it without streaming ...")
+        except StreamInterrupted as e:
+            # A truncated answer is not rendered, the request is sent again (with retries) instead
+            print(f"Presentation #{i+1}: Answer stream interrupted ({e}), requesting it without streaming ...")
+        if contents is None and streamed is not None:
+            # Images of the discarded slides
+            streamed.wait()
+            presentation.images = []
+            streamed = None
+    if contents is None:
+        if presentation.markdown is None:
+            with scheduler.stage("completion"):
+                presentation.markdown = openai_request(openai_client, presentation.prompt, save_chat=True, name="presentation")
+        if presentation.markdown is None:
+            raise RuntimeError("No answer from OpenAI (retries exhausted).")
+
+        # Parse markdown
+        _topic, contents = parse_outline(presentation.markdown)
+    num_slides = len(contents)
+    if not num_slides:
+        raise RuntimeError("The answer from OpenAI contains no slides.")
+    presentation.contents = contents
+
+    print(f"Presentation #{i+1}: OpenAI images: {'enabled' if openai_images else 'disabled'}, Google images: {'enabled' if google_images else 'disabled'}")
+    openai_future, skip = None, set()
+    if openai_images:
+        # Image OpenAI request
+        # Find slide with wrong topic
+        print(f"Presentation #{i+1}: Requesting image from OpenAI ...")
+        wrong_topic_slides = [(j, wt, slide) for j, slide in enumerate(contents) for wt in presentation.wrong_topics if wt.lower() in slide.text.lower()]
+        if wrong_topic_slides:
+            j, wt, slide = random.choice(wrong_topic_slides)
+            img_prompt = f"""Generiere ein Foto, das zu einer Powerpoint Folie zum Thema "{presentation.topic}" passt. Das Bild soll die Verbindung vom Thema "{wt}" zeigen."""
+        else:
+            j = random.choice(list(range(num_slides)))
+            slide = contents[j]
+            img_prompt = f"""Generiere ein Foto, das zu einer Powerpoint Folie zum Thema "{presentation.topic}" passt. Die Folie hat den folgenden Inhalt:\n""" + slide.text
+        # The Google images of the other slides are searched meanwhile
+        openai_future = scheduler.submit_task(run_in_span, "openai_image", {"slide": j + 1},
+                                              request_openai_image, openai_client=openai_client, topic=f'{presentation.topic}-{slide.title}',
+                                              prompt=img_prompt, scheduler=scheduler)
+        skip.add(j)
+
+    if google_images and presentation.image_search_mode != "none":
+        # A few searches for the whole presentation, their results are distributed over the slides (see lib/search_planner.py)
+        print(f"Presentation #{i+1}: Accessing google images and downloading images ...")
+        with span("slide_images", mode=presentation.image_search_mode, streamed=streamed is not None):
+            if streamed is not None:
+                streamed.wait()
+            # Slides without an image yet (while streaming, only the remaining results of the topic searches are used)
+            search_planner.search_images(presentation, contents, language=language, scheduler=scheduler, skip=skip, topic_only=streamed is not None)
+
+    if openai_future is not None:
+        img = None
+        try:
+            img = openai_future.result()
+        except Exception as e:
+            print("OpenAI image generation failed.")
+            print(e)
+        if img is not None:
+            slide.set_img(img, replace=True)
+            # Drop the search result it replaces (found while streaming)
+            presentation.images = [image for image in presentation.images if image["slide"] != j + 1]
+            presentation.images.append({
+                "source": "openai",
+                "slide": j + 1,
+                "image": img
             })
-            launch_thread.start()
-    
+            presentation.images.sort(key=lambda image: image["slide"])
+        elif google_images:
+            # The slide gets one of the remaining search results instead
+            search_planner.search_images(presentation, contents, language=language, scheduler=scheduler, topic_only=True)
+
+    # Generate pptx file
+    with scheduler.stage("render"), span("make_pptx", processes=RENDER_PROCESSES):
+        if RENDER_PROCESSES > 0:
+            # CPU-bound, rendered in a worker process
+            spec = RenderSpec.from_contents(pptx_template_path=presentation.pptx_template_path,
+                                            topic=presentation.topic,
+                                            speaker=presentation.speaker,
+                                            contents=contents,
+                                            output=pptx_output)
+            pptx = get_render_pool().render(spec)
+        else:
+            pptx = make_pptx(pptx_template_path=presentation.pptx_template_path,
+                             topic=presentation.topic,
+                             speaker=presentation.speaker,
+                             contents=contents,
+                             output=pptx_output)
+    if pptx_output == "memory":
+        presentation.pptx = pptx
+        print(f"Presentation #{i+1}: Rendered .pptx ({pptx.size // 1024} kB).")
+    else:
+        presentation.pptx_path = pptx
+        print(f"Presentation #{i+1}: Saved .pptx file.")
+    # print(f"Saved .pptx file to {pptx_path}.")
+    return presentation
+
+
+def request_batched_markdown(openai_client: CompletionBackend,
+                             presentations: list[Presentation],
+                             language: str,
+                             scheduler: StageScheduler,
+                             batch_size: int):
+    """
+    Requests the text of several presentations at once (see batch_prompt), sets their pending_markdown.
+    Entries that are missing from the answer or do not parse resolve to None, these presentations are then requested individually.
+    """
+    presentations = [p for p in presentations if p.markdown is None and p.pending_markdown is None and p.prompt_additions is not None]
+    for k in range(0, len(presentations), batch_size):
+        batch = presentations[k:k + batch_size]
+        if len(batch) < 2:
+            continue
+        for presentation in batch:
+            presentation.pending_markdown = Future()
+        scheduler.submit_task(run_in_span, "batch_completion", {"num_presentations": len(batch)},
+                              complete_batch, openai_client, batch, language=language, scheduler=scheduler)
+
+
+def complete_batch(openai_client: CompletionBackend, batch: list[Presentation], language: str, scheduler: StageScheduler):
+    entries = {}
+    try:
+        with scheduler.stage("completion"):
+            answer = openai_request(openai_client, batch_prompt(batch, language), save_chat=True, name="presentations")
+        entries = split_batch_answer(answer or "")
+    except Exception as e:
+        print(f"Batched completion failed: {type(e).__name__}: {e}")
+    finally:
+        num_parsed = 0
+        for n, presentation in enumerate(batch, 1):
+            markdown = entries.get(n, None)
+            try:
+                _topic, slides = parse_outline(markdown)
+                assert slides, "No slides."
+                num_parsed += 1
+            except Exception:
+                markdown = None
+            presentation.pending_markdown.set_result(markdown)
+        print(f"Batched completion: {num_parsed}/{len(batch)} presentation(s) parsed{', the rest is requested individually' if num_parsed < len(batch) else ''}.")
+
+
+def request_openai_image(openai_client: CompletionBackend, topic: str, prompt: str, scheduler: StageScheduler):
+    with scheduler.stage("image"):
+        img = openai_image_request(client=openai_client, topic=topic, prompt=prompt, save_chat=True, name="img")
+    if img is not None and NORMALIZE_IMAGES:
+        normalize_image_in_place(img, scheduler=scheduler)
+    return img
+
+
+def plan_image_searches(presentations: list[Presentation],
+                        limiter: ApiLimiter = None,
+                        planner: SearchPlanner = None,
+                        language: str = None,  # Searches that were sent already (e.g. speculatively) are not budgeted again
+                        openai_images: bool = True,  # One slide per presentation gets the OpenAI image instead of a search result
+                        default_num_slides: int = 5):
+    """
+    Splits the remaining Google search quota among the presentations, in speaker order:
+    the planned searches (see SearchPlanner) as long as every later presentation can still get one, otherwise one search per presentation.
+    Presentations beyond the quota get no search (only the OpenAI images).
+    """
+    remaining = (limiter or get_rate_limiter("google_search")).remaining()
+    if remaining is None:
+        return
+    planner = planner or SearchPlanner()
+    num_slides = [max(1, (p.num_slides or default_num_slides) - (1 if openai_images else 0)) for p in presentations]
+    needed = [planner.num_needed(p, n, "slide", language) for p, n in zip(presentations, num_slides)]
+    if remaining >= sum(needed):
+        return
+    for k, (presentation, n, num_searches) in enumerate(zip(presentations, num_slides, needed)):
+        num_later = len(presentations) - k - 1
+        num_single = planner.num_needed(presentation, n, "presentation", language)
+        if remaining - num_searches >= num_later:
+            presentation.image_search_mode = "slide"
+            remaining -= num_searches
+        elif remaining >= num_single:
+            presentation.image_search_mode = "presentation"
+            remaining -= num_single
+        else:
+            presentation.image_search_mode = "none"
+    modes = [p.image_search_mode for p in presentations]
+    print(f"Google search quota is low ({sum(needed)} searches needed): "
+          f"{modes.count('slide')} presentation(s) with all planned searches, {modes.count('presentation')} with one search in total, {modes.count('none')} without.")
+
+
+def prepare_presentations(player_names: list[str],
+                          language: str,
+                          players: list[dict] = None,
+                          topic_pool: list[str] = None,
+                          topic_groups: list[list[str]] = None) -> list[Presentation]:
+    """ Assigns the topics and generates the prompts. """
+    print("Assigning topics ...")
+    with span("assign_topics", num_players=len(player_names)):
+        presentations = assign_topics(player_names=player_names, players=players, topic_pool=topic_pool, topic_groups=topic_groups)
+    # for p in presentations:
+    #     print(p.player)
+    # print([p.player.get("isSpeaker", None) for p in presentations])
+    # return
+    if players:
+        presentations = [p for p in presentations if p.player.get("isSpeaker", True)]
+
+    print("Generating prompts ...")
+    with span("generate_prompts", num_presentations=len(presentations)):
+        generate_prompts(presentations=presentations,
+                         language=language)
+
+    print(f"Generated prompts for {len(presentations)} presentation(s).")
+    return presentations
+
 
-def launch_presentations(presentations: list[Presentation], launch_all: bool):
+def launch_presentations(presentations: list[Presentation], launch_all: bool, futures: list[Future] = None):
     for i, presentation in enumerate(presentations):
+        # Wait until the presentation is generated
+        failed = futures is not None and futures[i].exception() is not None
+        if failed or presentation.error is not None:
+            print(f"Skipping presentation #{i + 1} (Speaker: {presentation.speaker}), it could not be generated.")
+            continue
+        if presentation.pptx_path is None and presentation.pptx is not None:
+            # Rendered into memory, PowerPoint needs a file
+            presentation.pptx_path = presentation.pptx.save()
         # Launch slideshow in PowerPoint app
         assert presentation.pptx_path is not None, f"Presentation #{i + 1} ({presentation.speaker}) cannot be launched."
         print(f"Launching presentation #{i + 1} (Speaker: {presentation.speaker}) ...")
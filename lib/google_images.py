@@ -6,9 +6,15 @@ from dataclasses import dataclass
 from datetime import datetime
 import uuid
 import urllib.parse
+from threading import Event, Lock
 import requests
-import shutil
 
+from lib.cache import DiskCache, cache_key
+from lib.image_store import get_image_store
+from lib.downloads import DownloadCancelled, get_download_engine
+from lib.rate_limit import QuotaExceeded, get_rate_limiter
+from lib.scheduler import StageScheduler, stage_slot
+from lib.tracing import span
 from lib.utils import *
 from lib.config import *
 
@@ -53,22 +59,53 @@ class GoogleImage:
         self.ext = Path(self.url).suffix
         self.query = self.search_parameters["q"]
 
-    def download(self) -> bool:
-        path = IMG_DIR / f"google-img-{self.accessed.strftime(STRFTIME_FULL)}-{(self.result_index+1):03}-{str(uuid.uuid4())[:4]}-{ESCAPE_PATH(self.query)}{self.ext}"
+    def download(self, session: requests.Session = None, timeout: float = None, cancel: Event = None) -> int:
+        store = get_image_store()
+        path = store.lookup_url(self.url)
+        if path is not None:
+            # Known URL, no need to download again
+            self.downloaded = True
+            self.local_path = path
+            return 200
+
         # print(f"Downloading image at {self.url} ...")
-        with open(path, "wb") as f:
-            # res = requests.get(self.url, stream=True)
-            res = requests.get(self.url, stream=True, headers={
-                "User-Agent": "karaokay"
-            })
+        res = (session or requests).get(self.url, stream=True, timeout=timeout or DOWNLOAD_TIMEOUT, headers={
+            "User-Agent": "karaokay"
+        })
+        with res:
             if not res.ok:
                 return res.status_code
-            shutil.copyfileobj(res.raw, f)
+            with store.writer(self.ext) as writer:
+                for chunk in res.iter_content(chunk_size=64 * 1024):
+                    if cancel is not None and cancel.is_set():
+                        raise DownloadCancelled()
+                    writer.write(chunk)
+                path = writer.commit(url=self.url)
         self.downloaded = True
         self.local_path = path
         return res.status_code
 
 
+_search_cache = None
+_search_cache_lock = Lock()
+
+
+def get_search_cache() -> DiskCache:
+    global _search_cache
+    with _search_cache_lock:
+        if _search_cache is None:
+            _search_cache = DiskCache(SEARCH_CACHE_PATH, ttl=SEARCH_CACHE_TTL, max_entries=SEARCH_CACHE_MAX_ENTRIES)
+        return _search_cache
+
+
+def search_cache_key(parameters: dict) -> str:
+    """ Cache key of the search parameters, ignoring the API key and whitespace/case of the query. """
+    parameters = {k: v for k, v in parameters.items() if k != "key"}
+    if "q" in parameters:
+        parameters["q"] = " ".join(parameters["q"].split()).casefold()
+    return cache_key(parameters)
+
+
 def preprocess_query(query: str, language: str):
     # words = list(set(query.split(" ")))
     # words = [w for w in words if w not in query_stopwords[language]]
@@ -82,13 +119,18 @@ def google_image_search(query: str,
                         output: bool = False,
                         num_downloads: int = 10,
                         num: int = 10,
+                        start: int = None,  # Index of the first result (1-based), for the next page of results
                         imgSize="large",
                         fileType=None,
                         gl: str = "de",
                         hl: str = "de",
-                        safe: Literal["off", "active"] = "off"):
+                        safe: Literal["off", "active"] = "off",
+                        scheduler: StageScheduler = None,
+                        use_cache: bool = True,
+                        download: bool = True):  # False: return the candidates without downloading them (see lib/search_planner.py)
     
-    num = min(num_downloads, num)
+    if download:
+        num = min(num_downloads, num)
 
     parameters = {
         "key": os.getenv("GOOGLE_PSE_API_KEY"),
@@ -96,6 +138,7 @@ def google_image_search(query: str,
         "searchType": "image",
         "q": query,
         "num": num,
+        "start": start,
         "imgSize": imgSize,
         "gl": gl,  # Geolocation of end user
         "hl": hl,  # user interface language
@@ -103,23 +146,56 @@ def google_image_search(query: str,
         "fileType": fileType
     }
     parameters = {k: v for k, v in parameters.items() if v is not None}
-    url = f"https://www.googleapis.com/customsearch/v1?" + urllib.parse.urlencode(parameters)
+    url = f"{GOOGLE_CSE_URL}?" + urllib.parse.urlencode(parameters)
     if not uri_validator(url):
         raise ValueError(f"Invalid URL: {url}")
     
-    if output:
-        print(f"Accessing Google image search ...")
-    res = requests.get(url)
-
-    if not res.ok:
-        res_data = res.json()
-        if "error" in res_data:
-            if output:
-                print(f"Error {res.status_code}: {res_data['error']['message']}")
-        return [], res_data, parameters
-        # print(json.dumps(res.json(), indent=2))
-        # raise ValueError(f"Request failed (status code {res.status_code})")
-    res = res.json()
+    # Read-through cache of search results
+    cache = get_search_cache() if use_cache else None
+    key = search_cache_key(parameters)
+    res = cache.get(key) if cache is not None else None
+
+    if res is not None:
+        if output:
+            print(f"Using cached search results for query '{query}'.")
+    else:
+        if output:
+            print(f"Accessing Google image search ...")
+        limiter = get_rate_limiter("google_search")
+        try:
+            limiter.acquire()
+        except QuotaExceeded as e:
+            # Answered locally instead of burning a request into a 429
+            return [], {"error": {"code": 429, "message": str(e)}}, parameters
+        engine = get_download_engine()
+        with stage_slot(scheduler, "search"), span("google_image_search", query=query) as s:
+            # Keep-alive connection of the shared session, the timeout applies to connecting and to each read
+            res = engine.session.get(url, timeout=engine.timeout)
+            if s is not None:
+                s.attributes["status_code"] = res.status_code
+
+        try:
+            res_data = res.json()
+            if not isinstance(res_data, dict):
+                raise ValueError("Not a JSON object")
+        except ValueError:
+            # e.g. an HTML error page of a proxy
+            res_data = {"error": {"code": res.status_code, "message": f"Response is not JSON ({res.headers.get('Content-Type', 'no content type')})"}}
+        if not res.ok or "error" in res_data:
+            if res.status_code == 429:
+                if "per day" in res_data.get("error", {}).get("message", "").lower():
+                    limiter.exhaust()
+                else:
+                    limiter.pause(float(res.headers.get("Retry-After", 60)))
+            if "error" in res_data:
+                if output:
+                    print(f"Error {res.status_code}: {res_data['error']['message']}")
+            return [], res_data, parameters
+            # print(json.dumps(res.json(), indent=2))
+            # raise ValueError(f"Request failed (status code {res.status_code})")
+        res = res_data
+        if cache is not None:
+            cache.set(key, res)
 
     if save_results:
         path = SEARCH_RESULTS_DIR / f"google-result-{NOW()}-{ESCAPE_PATH(query)}.json"
@@ -145,10 +221,11 @@ def google_image_search(query: str,
                         height=item["image"]["height"],
                         byte_size=item["image"]["byteSize"],
                         file_format=item["fileFormat"],
+                        title=item.get("title", None),
                         accessed=accessed) for i, item in enumerate(res["items"])]
     
     # Filter and download the images
-    download_counter = 0
+    candidates = []
     for img in imgs:
         # Image filters
         if img.ext not in [".png", ".jpg", ".jpeg", ".gif"]:
@@ -157,13 +234,12 @@ def google_image_search(query: str,
             continue
         if img.width < 200 or img.height < 200:
             continue
-        img.download()
-        if img.downloaded:
-            download_counter += 1
-        if num_downloads is not None and download_counter >= num_downloads:
-            break
-    
-    imgs = [img for img in imgs if img.downloaded]
+        candidates.append(img)
+    if not download:
+        return candidates, res, parameters
+    # Candidates are fetched concurrently, the remaining downloads are cancelled once enough succeeded
+    imgs = get_download_engine().download_first(candidates, num_downloads=num_downloads, scheduler=scheduler)
+
     if output:
         print(f"Downloaded {len(imgs)} images from Google.")
         # print(f"Downloaded {len(imgs)} images for the query '{query}'.")
@@ -0,0 +1,88 @@
+import io
+from dataclasses import dataclass
+from pathlib import Path
+
+from PIL import Image as PILImage, UnidentifiedImageError
+
+from lib.image_store import get_image_store
+from lib.scheduler import StageScheduler, stage_slot
+from lib.tracing import span
+from lib.config import *
+
+
+@dataclass
+class NormalizedImage:
+    local_path: Path
+    width: int
+    height: int
+
+
+def box_pixels(box_cm: tuple[float, float] = None, dpi: int = None) -> tuple[int, int]:
+    """ Pixel size needed to fill a box of the given size (cm) at the given resolution. """
+    box_cm = box_cm or IMAGE_BOX_CM
+    dpi = dpi or IMAGE_DPI
+    return tuple(round(v / 2.54 * dpi) for v in box_cm)
+
+
+def read_image_size(path: Path) -> tuple[int, int]:
+    """ True dimensions of an image, read from the file header only. """
+    with PILImage.open(path) as img:
+        return img.size
+
+
+def normalize_image(path: Path, box_cm: tuple[float, float] = None, dpi: int = None, quality: int = None) -> NormalizedImage | None:
+    """
+    Downscales the image to the pixel size of the placeholder box and recompresses it (JPEG, or PNG if transparent).
+    Results are kept in the image store. Returns None if the file is not a readable image.
+    """
+    max_width, max_height = box_pixels(box_cm, dpi)
+    quality = quality or IMAGE_JPEG_QUALITY
+    store = get_image_store()
+    # Store blobs are named by their hash, s.t. results can be cached (other files are normalized every time)
+    key = None
+    if Path(path).resolve().is_relative_to(store.blobs_dir.resolve()):
+        key = f"normalized://{Path(path).name}?box={max_width}x{max_height}&q={quality}"
+    normalized_path = store.lookup_url(key) if key is not None else None
+    if normalized_path is not None:
+        width, height = read_image_size(normalized_path)
+        return NormalizedImage(local_path=normalized_path, width=width, height=height)
+
+    try:
+        with PILImage.open(path) as img:
+            width, height = img.size
+            if getattr(img, "is_animated", False):
+                # Keep animations as they are
+                return NormalizedImage(local_path=Path(path), width=width, height=height)
+            scale = min(1, max_width / width, max_height / height)
+            if scale == 1 and Path(path).stat().st_size <= IMAGE_MAX_UNCHANGED_BYTES:
+                return NormalizedImage(local_path=Path(path), width=width, height=height)
+
+            img.load()
+            if scale < 1:
+                img = img.resize((max(1, round(width * scale)), max(1, round(height * scale))), PILImage.LANCZOS)
+            transparent = img.mode in ["RGBA", "LA"] or (img.mode == "P" and "transparency" in img.info)
+            buffer = io.BytesIO()
+            if transparent:
+                img.convert("RGBA").save(buffer, format="PNG", optimize=True)
+                ext = ".png"
+            else:
+                img.convert("RGB").save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+                ext = ".jpg"
+            size = img.size
+    except (UnidentifiedImageError, OSError, ValueError) as e:
+        print(f"Could not normalize image {path}: {e}")
+        return None
+
+    normalized_path = store.put_bytes(buffer.getvalue(), ext, url=key)
+    return NormalizedImage(local_path=normalized_path, width=size[0], height=size[1])
+
+
+def normalize_image_in_place(img, scheduler: StageScheduler = None) -> bool:
+    """ Points the image (GoogleImage/OpenAiImage) to its normalized file with the true dimensions. """
+    with stage_slot(scheduler, "normalize"), span("normalize_image"):
+        normalized = normalize_image(img.local_path)
+    if normalized is None:
+        return False
+    img.local_path = normalized.local_path
+    img.width, img.height = normalized.width, normalized.height
+    return True
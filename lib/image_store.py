@@ -0,0 +1,98 @@
+import hashlib
+import os
+import uuid
+from pathlib import Path
+from threading import Lock
+
+from lib.cache import DiskCache
+from lib.config import *
+
+
+class BlobWriter:
+    """ Streams a blob into a temporary file while hashing it. On commit, the file is moved to its content address. """
+
+    def __init__(self, store: "ImageStore", ext: str):
+        self.store = store
+        self.ext = ext.lower()
+        self.tmp_path = store.incoming_dir / f"{uuid.uuid4()}{self.ext}"
+        self._file = open(self.tmp_path, "wb")
+        self._hash = hashlib.sha256()
+
+    def write(self, data: bytes):
+        self._hash.update(data)
+        self._file.write(data)
+
+    def commit(self, url: str = None) -> Path:
+        self._file.close()
+        path = self.store.blob_path(self._hash.hexdigest(), self.ext)
+        if path.exists():
+            # Identical bytes are stored once
+            self.tmp_path.unlink(missing_ok=True)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(self.tmp_path, path)
+        if url is not None:
+            self.store.link_url(url, path)
+        return path
+
+    def abort(self):
+        self._file.close()
+        self.tmp_path.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is not None:
+            self.abort()
+
+
+class ImageStore:
+    """
+    Content-addressed image store: Blobs are stored under their SHA-256 hash, and an index maps source URLs to blobs.
+    Shared across sessions (and processes), s.t. known URLs are never downloaded twice.
+    """
+
+    def __init__(self, root: Path = None, url_index: DiskCache = None):
+        self.root = Path(root or IMG_STORE_DIR)
+        self.blobs_dir = self.root / "blobs"
+        self.incoming_dir = self.root / "incoming"
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+        self.incoming_dir.mkdir(parents=True, exist_ok=True)
+        self.url_index = url_index or DiskCache(self.root / "urls.sqlite", max_entries=IMG_STORE_MAX_URLS)
+
+    def blob_path(self, digest: str, ext: str) -> Path:
+        return self.blobs_dir / digest[:2] / f"{digest}{ext.lower()}"
+
+    def lookup_url(self, url: str) -> Path | None:
+        entry = self.url_index.get(url)
+        if entry is None:
+            return None
+        path = self.root / entry
+        if not path.exists():
+            self.url_index.delete(url)
+            return None
+        return path
+
+    def link_url(self, url: str, path: Path):
+        self.url_index.set(url, str(Path(path).relative_to(self.root).as_posix()))
+
+    def writer(self, ext: str) -> BlobWriter:
+        return BlobWriter(self, ext)
+
+    def put_bytes(self, data: bytes, ext: str, url: str = None) -> Path:
+        with self.writer(ext) as writer:
+            writer.write(data)
+            return writer.commit(url=url)
+
+
+_store = None
+_store_lock = Lock()
+
+
+def get_image_store() -> ImageStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ImageStore()
+        return _store
@@ -0,0 +1,166 @@
+import json
+import math
+import sqlite3
+import time
+from threading import Lock, Thread
+
+from lib.openai_access import CachedBackend, CompletionBackend, get_completion_backend, openai_request
+from lib.config import *
+
+
+INSTRUCTION_PROMPT = {
+    "de": 'Wir spielen Powerpoint-Karaoke, d.h. der Vortragende hat die Folien noch nie gesehen. Ich suche kreative Ideen für Anweisungen an den Vortragenden bzgl. Vortragsstil oder überraschenden Aktionen während des Vortrags. Bitte gib {num} Ideen für solche Anweisungen. Antworte im JSON-Format. Die Antwort ist eine JSON-Liste, die ausschließlich die Anweisungen als strings enthält.',
+    "en": 'We are playing PowerPoint karaoke, i.e. the speaker has never seen the slides before. I am looking for creative ideas for instructions to the speaker regarding the presentation style or surprising actions during the talk. Please give {num} ideas for such instructions. Answer in JSON format. The answer is a JSON list that only contains the instructions as strings.'
+}
+
+
+def request_instructions(openai_client: CompletionBackend, language: str, num_instructions: int) -> list[str]:
+    """ Requests ideas for speaker instructions from OpenAI. Empty if all attempts fail. """
+    print(f"Accessing OpenAI for {num_instructions} speaker instructions ...")
+    num_retries = 3
+    while num_retries > 0:
+        answer = openai_request(openai_client, INSTRUCTION_PROMPT[language].format(num=num_instructions), save_chat=True, name="instructions")
+        if answer is None:
+            # Transient errors were already retried
+            print("No instructions received from OpenAI.")
+            return []
+        try:
+            instruction_pool = json.loads(answer)
+        except json.JSONDecodeError:
+            instruction_pool = None
+        if isinstance(instruction_pool, dict):
+            print("Converting response from dict to list ...")
+            if len(instruction_pool) == 1:
+                instruction_pool = list(instruction_pool.values())[0]
+            else:
+                instruction_pool = list(instruction_pool.values())
+
+        if not isinstance(instruction_pool, list) or len(instruction_pool) < .75 * num_instructions or len(instruction_pool) > 1.25 * num_instructions or not all(isinstance(v, str) for v in instruction_pool):
+            print(f"Instruction response is malformatted, trying again ({num_retries} remaining) ...")
+            num_retries -= 1
+            continue
+        print(f"Received {len(instruction_pool)} instructions (requested {num_instructions})")
+        return instruction_pool
+    return []
+
+
+def instruction_key(text: str) -> str:
+    """ Instructions that only differ in case, punctuation or spacing are duplicates. """
+    return re.sub(r"\W+", " ", text.casefold()).strip()
+
+
+class InstructionStock:
+    """
+    Persistent stock of speaker instructions per language (SQLite), deduplicated and sampled locally, least used first.
+    Sessions take their instructions instantly; the stock is refilled by OpenAI requests in the background,
+    sized to the observed demand (instructions per session). Only an empty stock is filled on the request path.
+    """
+
+    def __init__(self, path: Path = None, openai_client: CompletionBackend = None, min_stock: int = None, max_uses: int = None):
+        self.path = Path(path or INSTRUCTION_STOCK_PATH)
+        self.openai_client = openai_client
+        self.min_stock = min_stock or INSTRUCTION_STOCK_MIN
+        self.max_uses = max_uses or INSTRUCTION_MAX_USES
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = Lock()
+        self._refilling = set()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS instructions (language TEXT NOT NULL, key TEXT NOT NULL, text TEXT NOT NULL, "
+                           "created REAL NOT NULL, uses INTEGER NOT NULL, PRIMARY KEY (language, key))")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS demand (language TEXT PRIMARY KEY, per_session REAL NOT NULL, sessions INTEGER NOT NULL)")
+
+    def _client(self) -> CompletionBackend:
+        client = self.openai_client or get_completion_backend()
+        # Identical prompts would be answered from the cache, refills need new ideas
+        return client.backend if isinstance(client, CachedBackend) else client
+
+    def take(self, language: str, k: int) -> list[str]:
+        """ Up to k different instructions for a session, least used first. """
+        self._record_demand(language, k)
+        texts = self._sample(language, k)
+        if not texts:
+            # Empty stock (first session of the language), has to wait for OpenAI once
+            self.refill(language)
+            texts = self._sample(language, k)
+        self.refill_in_background(language)
+        return texts
+
+    def _sample(self, language: str, k: int) -> list[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT key, text FROM instructions WHERE language = ? ORDER BY uses, RANDOM() LIMIT ?", (language, k)).fetchall()
+            self._conn.executemany("UPDATE instructions SET uses = uses + 1 WHERE language = ? AND key = ?", [(language, key) for key, _text in rows])
+        return [text for _key, text in rows]
+
+    def _record_demand(self, language: str, k: int):
+        with self._lock:
+            # Exponential moving average of the instructions per session
+            self._conn.execute("INSERT INTO demand (language, per_session, sessions) VALUES (?, ?, 1) "
+                               "ON CONFLICT (language) DO UPDATE SET per_session = 0.7 * per_session + 0.3 * excluded.per_session, sessions = sessions + 1",
+                               (language, k))
+
+    def add(self, language: str, texts: list[str]) -> int:
+        """ Adds new instructions, returns how many were not in the stock yet. """
+        rows = {instruction_key(text): text.strip() for text in texts if instruction_key(text)}
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany("INSERT OR IGNORE INTO instructions (language, key, text, created, uses) VALUES (?, ?, ?, ?, 0)",
+                                   [(language, key, text, time.time()) for key, text in rows.items()])
+            return self._conn.total_changes - before
+
+    def fresh(self, language: str) -> int:
+        """ Instructions that were used less than max_uses times. """
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM instructions WHERE language = ? AND uses < ?", (language, self.max_uses)).fetchone()[0]
+
+    def target(self, language: str) -> int:
+        """ Fresh instructions to keep in stock: enough for the next few sessions of the observed size. """
+        with self._lock:
+            row = self._conn.execute("SELECT per_session FROM demand WHERE language = ?", (language,)).fetchone()
+        per_session = row[0] if row is not None else 0
+        return max(self.min_stock, math.ceil(INSTRUCTION_STOCK_SESSIONS * per_session))
+
+    def refill(self, language: str) -> int:
+        """ Requests as many instructions as are missing (at most INSTRUCTION_REQUEST_MAX), returns the number of new ones. """
+        missing = self.target(language) - self.fresh(language)
+        num_instructions = min(INSTRUCTION_REQUEST_MAX, max(10, missing))
+        added = self.add(language, request_instructions(self._client(), language, num_instructions))
+        print(f"Instruction stock ({language}): {added} new instruction(s), {self.fresh(language)} fresh.")
+        return added
+
+    def refill_in_background(self, language: str):
+        """ Refills off the request path if the fresh stock is below the target (at most one refill per language at a time). """
+        if self.fresh(language) >= self.target(language):
+            return
+        with self._lock:
+            if language in self._refilling:
+                return
+            self._refilling.add(language)
+
+        def refill():
+            try:
+                self.refill(language)
+            except Exception as e:
+                print(f"Instruction stock ({language}): Refill failed: {type(e).__name__}: {e}")
+            finally:
+                with self._lock:
+                    self._refilling.discard(language)
+
+        Thread(target=refill, name=f"instruction-refill-{language}", daemon=True).start()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_stock = None
+_stock_lock = Lock()
+
+
+def get_instruction_stock() -> InstructionStock:
+    """ Process-wide instruction stock. """
+    global _stock
+    with _stock_lock:
+        if _stock is None:
+            _stock = InstructionStock()
+        return _stock
@@ -1,50 +1,161 @@
-
+from dataclasses import dataclass, field
 import re
+from threading import Lock
+
+
+MAX_DEPTH = 8  # Deepest paragraph level of PowerPoint
+
+# One match per non-blank line: heading, skipped line (code fence, horizontal rule), bullet, numbered item or text
+LINE = re.compile(r"^(?P<indent>[ \t]*)(?:"
+                  r"(?P<hashes>#{1,6})(?=\s|$)[ \t]*(?P<heading>.*)"
+                  r"|(?P<skip>```.*|[-*_]{3,}[ \t\r]*$)"
+                  r"|[-*+•](?=\s|$)[ \t]*(?P<item>.*)"
+                  r"|(?P<number>\d{1,3})[.)][ \t]+(?P<numbered>.*)"
+                  r"|(?P<text>\S.*))", re.MULTILINE)
+SLIDE_PREFIX = re.compile(r"^(?:Folie|Slide)\s*\d+\s*[:.\-–]\s*", re.IGNORECASE)
+
+
+@dataclass(slots=True)
+class Run:
+		text: str
+		bold: bool = False
+
+
+@dataclass(slots=True)
+class Paragraph:
+		kind: str  # "bullet", "numbered" or "text"
+		runs: list[Run]
+		depth: int = 0  # Nesting level of the list item
+		number: int | None = None  # Of a numbered list item
+
+		@property
+		def text(self) -> str:
+				return "".join(run.text for run in self.runs)
+
+
+_img_lock = Lock()
+
+
+@dataclass(slots=True)
+class Slide:
+		title: str
+		paragraphs: list[Paragraph] = field(default_factory=list)
+		img: object = None  # GoogleImage (or SlideImageSpec in a render worker)
+
+		@property
+		def text(self) -> str:
+				return "\n".join([self.title, *[p.text for p in self.paragraphs]])
+
+		def set_img(self, img, replace: bool = False) -> bool:
+				""" Sets the image unless the slide has one already (e.g. from OpenAI) and replace is False, False then. """
+				with _img_lock:
+						if self.img is not None and not replace:
+								return False
+						self.img = img
+						return True
+
+
+def parse_runs(text: str) -> list[Run]:
+		""" Splits **bold** parts, an unmatched ** is dropped. """
+		if "**" not in text:
+				return [Run(text)] if text else []
+		# Alternating normal and bold parts
+		parts = text.split("**")
+		if not len(parts) % 2:
+				parts[-2:] = [parts[-2] + parts[-1]]
+		return [Run(part, k % 2 == 1) for k, part in enumerate(parts) if part]
+
+
+def process_slide_title(title: str) -> str:
+		return SLIDE_PREFIX.sub("", title.replace("**", "").strip()).strip()
+
+
+class IncrementalOutlineParser:
+		"""
+		Parses a markdown outline in a single pass, also while it is streamed. Slides are emitted as soon as they are complete.
+		Tolerates the usual deviations of LLM answers: code fences, any indentation of list items, "# " for slides, stray bold markers.
+		"""
+
+		def __init__(self, topic: str = None):
+				self.topic = topic
+				self.slides: list[Slide] = []
+				self._buffer = ""
+				self._current: Slide | None = None
+				self._seen_title = False
+				self._indents: list[int] = []  # Indentation of the enclosing list items
+
+		def feed(self, chunk: str) -> list[Slide]:
+				""" Adds a chunk of the answer, returns the slides completed by it. """
+				lines, _newline, self._buffer = (self._buffer + chunk).rpartition("\n")
+				return self._parse(lines)
+
+		def finish(self) -> list[Slide]:
+				""" Ends the stream, returns the remaining slides. """
+				completed = self._parse(self._buffer)
+				self._buffer = ""
+				if self._current is not None:
+						completed.append(self._current)
+						self._current = None
+				return completed
+
+		def _parse(self, lines: str) -> list[Slide]:
+				""" Parses complete lines, returns the slides completed by them. """
+				completed = []
+				current = self._current
+				indents = self._indents
+				for indent, hashes, heading, skip, item, number, numbered, text in map(re.Match.groups, LINE.finditer(lines)):
+						if heading is not None:
+								if len(hashes) == 1 and not self._seen_title and not self.slides:
+										# Presentation title
+										self._seen_title = True
+										if self.topic is None:
+												self.topic = heading.replace("**", "").strip()
+										continue
+								if len(hashes) <= 2:
+										if current is not None:
+												completed.append(current)
+										current = Slide(process_slide_title(heading))
+										indents = []
+										self.slides.append(current)
+										continue
+								# Subheading
+								text = heading
+						if current is None or skip is not None:
+								continue
+
+						if item is not None:
+								kind = "bullet"
+						elif numbered is not None:
+								kind = "numbered"
+								item = numbered
+								number = int(number)
+						else:
+								# Text
+								indents = []
+								runs = parse_runs(text.strip())
+								if runs:
+										current.paragraphs.append(Paragraph("text", runs))
+								continue
 
+						# Nesting depth from the indentation relative to the enclosing items (tabs count as 4 spaces)
+						width = len(indent.replace("\t", "    ") if "\t" in indent else indent)
+						while indents and indents[-1] > width:
+								indents.pop()
+						if not indents or indents[-1] < width:
+								indents.append(width)
+						item = item.strip()
+						runs = parse_runs(item) if "**" in item else [Run(item)] if item else None
+						if runs:
+								depth = len(indents) - 1
+								current.paragraphs.append(Paragraph(kind, runs, depth if depth < MAX_DEPTH else MAX_DEPTH, number))
+				self._current = current
+				self._indents = indents
+				return completed
 
-def parse_md_line(line: str):
-		# Headings
-		if line.startswith("# "):
-				return ("h1", line[2:])
-		if line.startswith("## "):
-				return ("h2", process_slide_title(line[3:].strip()))
-		line = re.sub("^#+\s*", "", line)
-
-		# Bullets
-		for i in range(4):
-				tabs = (i + 1) * "  "
-				if line.startswith(tabs + "- ") or line.startswith(tabs + "* "):
-						return ("bullet", line[2 * (i + 1) + 2:], i)
-		line = line.strip()
-		line = re.sub("^[\-\*] ", "", line).strip()
-
-		# Normal text
-		return ("text", line)
-
-
-def process_slide_title(title: str):
-		match = re.match(r"^Folie \d+: (.*)$", title)
-		if match:
-				title = match.groups()[0]
-		return title
-
-
-def parse_md_outline(md: str, topic: str = None):
-		lines = [line.rstrip() for line in md.split("\n")]
-		lines = [parse_md_line(line) for line in lines if line]
-		if topic is None:
-				assert lines[0][0] == "h1", "The topic is not correctly formatted."
-				topic = lines[0][1]
-		else:
-				assert lines[0] == ("h1", topic), "The topic does not match or is not correctly formatted."
-		lines = lines[1:]
-		titles = [(i, line) for i, line in enumerate(lines) if line[0] == "h2"]
-		contents = []
-		for i, (j0, title) in enumerate(titles):
-				j1 = titles[i + 1][0] if i < len(titles) - 1 else len(lines)
-				contents.append({
-						"title": title[1],
-						"content": lines[j0 + 1:j1]
-				})
-		return topic, contents
 
+def parse_outline(md: str | None, topic: str = None) -> tuple[str | None, list[Slide]]:
+		""" Topic (first heading 1) and slides of a markdown outline. No answer (None) has no slides. """
+		parser = IncrementalOutlineParser(topic=topic)
+		parser.feed(md or "")
+		parser.finish()
+		return parser.topic, parser.slides
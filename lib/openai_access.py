@@ -1,33 +1,284 @@
-
-from dataclasses import dataclass
+from abc import ABC, abstractmethod
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+import io
 import json
+import random
+import time
 import uuid
 import base64
-from openai import OpenAI, OpenAIError
+from threading import Lock
+from typing import Iterator
+from openai import OpenAI, OpenAIError, RateLimitError
 
+from lib.cache import DiskCache, cache_key
+from lib.image_store import get_image_store
+from lib.rate_limit import ApiLimiter, QuotaExceeded, get_rate_limiter
+from lib.tracing import span
 from lib.config import *
 
-def openai_request(client, prompt, save_chat: bool = True, name: str = None):
+
+class StreamInterrupted(Exception):
+    """ The streamed answer failed (possibly after some chunks), what was received is incomplete. """
+    pass
+
+
+@dataclass
+class Completion:
+    answer: str
+    usage: dict = field(default_factory=dict)
+    cached: bool = False
+
+
+@dataclass
+class GeneratedImage:
+    data: bytes
+    revised_prompt: str | None = None
+
+
+class CompletionBackend(ABC):
+    """ Source of chat completions and generated images. """
+
+    @abstractmethod
+    def complete(self, messages: list[dict], model: str) -> Completion:
+        pass
+
+    def stream(self, messages: list[dict], model: str) -> Iterator[str]:
+        """ Yields the answer in chunks as it is generated (by default in one piece). """
+        yield self.complete(messages, model).answer
+
+    @abstractmethod
+    def generate_image(self, prompt: str, model: str, size: str) -> GeneratedImage:
+        pass
+
+
+# Timing of the current attempt (see run_attempt in lib/resilience.py): its timeout runs from when the request is sent
+current_attempt = ContextVar("current_attempt", default=None)
+
+
+def limited(limiter: ApiLimiter, request, *args, **kwargs):
+    """ Sends the request within the rate limit and daily quota, and adapts them to the 429 responses of the API. """
+    attempt = current_attempt.get()
+    if attempt is not None:
+        attempt.limited = True
+    limiter.acquire()
+    if attempt is not None:
+        attempt.sent = time.monotonic()
     try:
-        completion = client.chat.completions.create(
-            model="gpt-3.5-turbo-0125",
-            messages=[{"role": "user", "content": prompt}]
+        return request(*args, **kwargs)
+    except RateLimitError as e:
+        if e.code == "insufficient_quota":
+            limiter.exhaust()
+        else:
+            limiter.pause(float(e.response.headers.get("Retry-After", 20)))
+        raise
+
+
+class OpenAiBackend(CompletionBackend):
+
+    def __init__(self, client: OpenAI = None):
+        # Retries are up to ResilientBackend (see lib/resilience.py)
+        self.client = client or OpenAI(timeout=OPENAI_TIMEOUT or None, max_retries=0)
+
+    def complete(self, messages: list[dict], model: str) -> Completion:
+        completion = limited(get_rate_limiter("openai_chat"), self.client.chat.completions.create, model=model, messages=messages)
+        return Completion(answer=completion.choices[0].message.content,
+                          usage=completion.usage.dict() if completion.usage else {})
+
+    def stream(self, messages: list[dict], model: str) -> Iterator[str]:
+        chunks = limited(get_rate_limiter("openai_chat"), self.client.chat.completions.create, model=model, messages=messages, stream=True)
+        for chunk in chunks:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def generate_image(self, prompt: str, model: str, size: str) -> GeneratedImage:
+        response = limited(
+            get_rate_limiter("openai_image"),
+            self.client.images.generate,
+            model=model,
+            prompt=prompt,
+            size=size,
+            quality="standard",
+            n=1,
+            response_format="b64_json",
         )
-        answer = completion.choices[0].message.content
+        return GeneratedImage(data=base64.b64decode(response.data[0].b64_json),
+                              revised_prompt=response.data[0].revised_prompt)
+
+
+class CachedBackend(CompletionBackend):
+    """ Answers identical completion requests (model + messages) from a bounded on-disk cache. Images are not cached. """
+
+    def __init__(self, backend: CompletionBackend, cache: DiskCache = None):
+        self.backend = backend
+        self.cache = cache or DiskCache(COMPLETION_CACHE_PATH, ttl=COMPLETION_CACHE_TTL, max_entries=COMPLETION_CACHE_MAX_ENTRIES)
+
+    def complete(self, messages: list[dict], model: str) -> Completion:
+        key = cache_key({"model": model, "messages": messages})
+        entry = self.cache.get(key)
+        if entry is not None:
+            return Completion(answer=entry["answer"], usage=entry["usage"], cached=True)
+        completion = self.backend.complete(messages, model)
+        if completion.answer:
+            # Failures (no answer) are not cached, s.t. the next request tries again
+            self.cache.set(key, {"answer": completion.answer, "usage": completion.usage})
+        return completion
+
+    def stream(self, messages: list[dict], model: str) -> Iterator[str]:
+        key = cache_key({"model": model, "messages": messages})
+        entry = self.cache.get(key)
+        if entry is not None:
+            yield entry["answer"]
+            return
+        chunks = []
+        for chunk in self.backend.stream(messages, model):
+            chunks.append(chunk)
+            yield chunk
+        answer = "".join(chunks)
+        if answer:
+            self.cache.set(key, {"answer": answer, "usage": {}})
+
+    def generate_image(self, prompt: str, model: str, size: str) -> GeneratedImage:
+        return self.backend.generate_image(prompt, model, size)
+
+
+class LocalBackend(CompletionBackend):
+    """
+    Deterministic offline stand-in for development and load testing.
+    Answers presentation prompts with a markdown outline (one per presentation for batch prompts) and JSON prompts with a list of strings.
+    """
+
+    def _random(self, *data) -> random.Random:
+        return random.Random(cache_key(data))
+
+    def complete(self, messages: list[dict], model: str) -> Completion:
+        prompt = "\n".join(m["content"] for m in messages if m["role"] == "user")
+        rng = self._random(model, messages)
+        if "JSON" in prompt:
+            answer = self._json_list(prompt, rng)
+        elif "=== " in prompt:
+            answer = self._batch_markdown(prompt, rng)
+        else:
+            answer = self._markdown(prompt, rng)
+        return Completion(answer=answer, usage={"prompt_tokens": len(prompt.split()), "completion_tokens": len(answer.split())})
+
+    def stream(self, messages: list[dict], model: str) -> Iterator[str]:
+        for line in self.complete(messages, model).answer.splitlines(keepends=True):
+            yield line
+
+    def _json_list(self, prompt: str, rng: random.Random) -> str:
+        numbers = [int(n) for n in re.findall(r"\b(\d+)\b", prompt)]
+        n = numbers[0] if numbers else 10
+        return json.dumps([f"Anweisung {i + 1}: {rng.choice(['Flüstere', 'Singe', 'Tanze', 'Reime', 'Zwinkere'])} auf Folie {rng.randint(1, 5)}." for i in range(n)], ensure_ascii=False)
+
+    def _markdown(self, prompt: str, rng: random.Random) -> str:
+        topic = re.search(r'"([^"]+)"', prompt)
+        topic = topic.group(1) if topic else "Thema"
+        num_slides = re.search(r"(\d+) (?:Folien|slides)", prompt)
+        num_slides = int(num_slides.group(1)) if num_slides else 5
+        lines = [f"# {topic}"]
+        for i in range(1, num_slides + 1):
+            lines.append(f"## Folie {i}: {topic} – Aspekt {rng.randint(1, 99)}")
+            for j in range(rng.randint(4, 6)):
+                lines.append(f"- Stichpunkt {j + 1} über **{topic}**")
+        return "\n".join(lines)
+
+    def _batch_markdown(self, prompt: str, rng: random.Random) -> str:
+        entries = re.findall(r'^(Präsentation|Presentation) (\d+): \w+ "([^"]+)"', prompt, re.MULTILINE)
+        num_slides = re.search(r"(\d+) (?:Folien|slides)", prompt)
+        return "\n".join(f"=== {word} {n} ===\n" + self._markdown(f'"{topic}" {num_slides.group(0) if num_slides else ""}', rng)
+                         for word, n, topic in entries)
+
+    def generate_image(self, prompt: str, model: str, size: str) -> GeneratedImage:
+        from PIL import Image as PILImage
+        width, height = (int(v) for v in size.split("x"))
+        rng = self._random(model, prompt, size)
+        img = PILImage.new("RGB", (width, height), tuple(rng.randrange(256) for _ in range(3)))
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG")
+        return GeneratedImage(data=buffer.getvalue(), revised_prompt=prompt)
+
+
+_backend = None
+_backend_lock = Lock()
+
+
+def get_completion_backend() -> CompletionBackend:
+    """ Process-wide backend as configured by COMPLETION_BACKEND ("openai" or "local") and COMPLETION_CACHE. OpenAI requests are retried. """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if COMPLETION_BACKEND == "local":
+                backend = LocalBackend()
+            elif COMPLETION_BACKEND == "openai":
+                from lib.resilience import ResilientBackend
+                backend = ResilientBackend(OpenAiBackend())
+            else:
+                raise ValueError(f"Unknown completion backend '{COMPLETION_BACKEND}'.")
+            _backend = CachedBackend(backend) if COMPLETION_CACHE else backend
+        return _backend
+
+
+def as_backend(client: CompletionBackend | OpenAI | None) -> CompletionBackend:
+    if client is None:
+        return get_completion_backend()
+    if isinstance(client, CompletionBackend):
+        return client
+    return OpenAiBackend(client)
+
+
+def openai_request(client: CompletionBackend | OpenAI, prompt, save_chat: bool = True, name: str = None, model: str = None):
+    try:
+        model = model or COMPLETION_MODEL
+        with span("openai_request", purpose=name, model=model) as s:
+            completion = as_backend(client).complete(messages=[{"role": "user", "content": prompt}], model=model)
+            if s is not None:
+                s.attributes.update(cached=completion.cached, **completion.usage)
+        answer = completion.answer
 
         if save_chat:
             path = CHATS_DIR / f"openai-chat-{NOW()}{'-' + name if name else ''}-{uuid.uuid4()}.json"
             json.dump({
                 "prompt": prompt,
                 "answer": answer,
-                "usage": completion.usage.dict()
+                "usage": completion.usage,
+                "cached": completion.cached
             }, open(path, "w", encoding="utf8"), indent=2)
 
         return answer
 
     except OpenAIError as e:
-        print(f"Error (status code {e.status_code}):")
-        print(f'Message: "{e.message}"')
+        print(f"Error (status code {getattr(e, 'status_code', None)}):")
+        print(f'Message: "{getattr(e, "message", e)}"')
+    except (QuotaExceeded, TimeoutError) as e:
+        print(f"Error: {e}")
+
+
+def openai_stream_request(client: CompletionBackend | OpenAI, prompt, save_chat: bool = True, name: str = None, model: str = None) -> Iterator[str]:
+    """ Streaming variant of openai_request, yields the answer in chunks. Raises StreamInterrupted if the request fails. """
+    chunks = []
+    try:
+        model = model or COMPLETION_MODEL
+        with span("openai_stream_request", purpose=name, model=model):
+            for chunk in as_backend(client).stream(messages=[{"role": "user", "content": prompt}], model=model):
+                chunks.append(chunk)
+                yield chunk
+
+        if save_chat:
+            path = CHATS_DIR / f"openai-chat-{NOW()}{'-' + name if name else ''}-{uuid.uuid4()}.json"
+            json.dump({
+                "prompt": prompt,
+                "answer": "".join(chunks),
+                "stream": True
+            }, open(path, "w", encoding="utf8"), indent=2)
+
+    except OpenAIError as e:
+        print(f"Error (status code {getattr(e, 'status_code', None)}):")
+        print(f'Message: "{getattr(e, "message", e)}"')
+        raise StreamInterrupted(f"after {len(chunks)} chunk(s): {getattr(e, 'message', e)}") from e
+    except (QuotaExceeded, TimeoutError) as e:
+        print(f"Error: {e}")
+        raise StreamInterrupted(str(e)) from e
 
 
 @dataclass
@@ -37,39 +288,31 @@ class OpenAiImage:
     local_path: Path
 
 
-def openai_image_request(client: OpenAI, topic: str, prompt: str, save_chat: bool = True, name: str = None):
-    
+def openai_image_request(client: CompletionBackend | OpenAI, topic: str, prompt: str, save_chat: bool = True, name: str = None):
+
     try:
-        response = client.images.generate(
-            model="dall-e-3",
-            prompt=prompt,
-            size="1024x1024",
-            quality="standard",
-            n=1,
-            response_format="b64_json",
-        )
+        with span("openai_image_request", purpose=name, model="dall-e-3"):
+            response = as_backend(client).generate_image(prompt=prompt, model="dall-e-3", size="1024x1024")
 
-        img_path = IMG_DIR / f"openai-img-{datetime.now().strftime(STRFTIME_FULL)}-{str(uuid.uuid4())[:4]}-{ESCAPE_PATH(topic)}.png"
-        image_data = base64.b64decode(response.data[0].b64_json)
-        with open(img_path, mode="wb") as png:
-            png.write(image_data)
+        img_path = get_image_store().put_bytes(response.data, ".png")
 
         if save_chat:
             path = CHATS_DIR / f"openai-chat-{NOW()}{'-' + name if name else ''}-image-{uuid.uuid4()}.json"
             json.dump({
                 "prompt": prompt,
-                "revised_prompt": response.data[0].revised_prompt,
+                "revised_prompt": response.revised_prompt,
                 "local_path": str(img_path)
             }, open(path, "w", encoding="utf8"), indent=2)
 
         return OpenAiImage(local_path=img_path, width=1024, height=1024)
 
     except OpenAIError as e:
-        print(f"Error (status code {e.status_code}):")
-        print(f'Message: "{e.message}"')
+        print(f"Error (status code {getattr(e, 'status_code', None)}):")
+        print(f'Message: "{getattr(e, "message", e)}"')
+    except (QuotaExceeded, TimeoutError) as e:
+        print(f"Error: {e}")
 
 
 if __name__ == "__main__":
-    openai_client = OpenAI()
     prompt = "Please write a romantic poem in German in the style of the 19th century that features nostalgia and grief. The poem should have 3x4 verses and crossed rhymes."
-    print(openai_request(openai_client, prompt))
\ No newline at end of file
+    print(openai_request(get_completion_backend(), prompt))
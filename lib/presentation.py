@@ -1,7 +1,16 @@
 
+from __future__ import annotations
+
+from concurrent.futures import Future
 from dataclasses import dataclass, field
 from pathlib import Path
-from pptx import Presentation as PptxPresentation
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pptx import Presentation as PptxPresentation
+    from lib.frontend import DeliveryResult
+    from lib.markdown import Slide
+    from lib.pptx_factory import RenderedPptx
 
 
 @dataclass
@@ -14,10 +23,16 @@ class Presentation:
     speaker_instruction: list[str] = field(default_factory=lambda: [])
     image_query_suffix: str | None = None
     prompt: str | None = None
+    prompt_additions: str | None = None  # Presentation-specific part of the prompt (see batch_prompt)
+    num_slides: int | None = None  # As requested by the prompt
     markdown: str | None = None
-    contents: list[dict] = field(default_factory=lambda: [])
+    contents: list[Slide] = field(default_factory=lambda: [])  # Parsed markdown (see lib/markdown.py)
     images: list[dict] = field(default_factory=lambda: [])
     pptx_path: Path | None = None
+    pptx: RenderedPptx | None = None  # In-memory output (see make_pptx)
+    pending_markdown: Future | None = None  # Speculative completion (see lib/speculation.py)
+    image_search_mode: str = "slide"  # Google searches: "slide" (as planned by SearchPlanner), "presentation" (one for all slides) or "none", see plan_image_searches
+    error: str | None = None  # Why the presentation could not be generated
     # pptx: PptxPresentation | None
 
     # DB connection
@@ -25,5 +40,7 @@ class Presentation:
     player_id: str | None = None
     player: dict | None = None
     topic_id: str | None = None
+    author_id: str | None = None  # Player who provided the topics
+    instruction_delivery: DeliveryResult | None = None
 
 
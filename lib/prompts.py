@@ -6,7 +6,6 @@ import math
 import random
 from typing import Callable, Dict
 
-from openai import OpenAI
 
 from lib.presentation import Presentation
 from lib.config import *
@@ -213,6 +212,9 @@ def generate_prompts(presentations: list[Presentation],
         if language not in PROMPT:
             raise ValueError(f"promt creation: Undefined language {language}.")
         presentation.prompt = PROMPT[language](topic=topic, prompt_additions=prompt_additions)
+        presentation.prompt_additions = prompt_additions
+        presentation.num_slides = num_slides
+        presentation.image_query_suffix = image_query_suffix
         
         
         # print(speaker_name)
@@ -230,6 +232,62 @@ def generate_prompts(presentations: list[Presentation],
         #     print("  Speaker style instruction: " + presentation.speaker_instruction)
 
 
+BATCH_SEPARATOR = {"de": "=== Präsentation {n} ===", "en": "=== Presentation {n} ==="}
+
+
+def batch_prompt(presentations: list[Presentation],
+                 language: str,
+                 num_slides=5,  # Unless set by generate_prompts
+                 num_bullets_min=4,
+                 num_bullets_max=6) -> str:
+    """ One prompt for several presentations (prompts prepared by generate_prompts): the common instructions once, then topic and additions per presentation. """
+    num_bullets = f"{num_bullets_min}-{num_bullets_max}" if num_bullets_min != num_bullets_max else num_bullets_min
+    slide_counts = [p.num_slides or num_slides for p in presentations]
+    # The slide count is given once if it is the same for all presentations
+    common_count = slide_counts[0] if len(set(slide_counts)) == 1 else None
+    BATCH_PROMPT = {
+        "de": lambda: "\n".join([
+            f'Generiere aus Stichpunkten bestehende Inhalte für {len(presentations)} PowerPoint-Präsentationen, im Markdown-Format.',
+            f'Jede Präsentation soll {f"{common_count} Folien" if common_count else "die angegebene Anzahl Folien"} enthalten und pro Folie {num_bullets} Stichpunkte.',
+            'Der Präsentationsstil soll locker, aber dennoch informativ sein.',
+            'Baue in jede Präsentation 2-3 Witze ein.',
+            'Formatiere jede Präsentation im Markdown-Format! Verwende Überschrift 1 für den Präsentationstitel, Überschrift 2 für Folientitel, und Aufzählungen für die Stichpunkte.',
+            f'Beginne jede Präsentation mit einer eigenen Zeile "{BATCH_SEPARATOR["de"].format(n="<Nummer>")}". Die Antwort soll ausschließlich Markdown sein, füge keine weiteren Erklärungen hinzu!',
+            '',
+            *[f'Präsentation {n}: Thema "{p.topic}"' + (f', {k} Folien.' if not common_count else '.') + (f'\n{p.prompt_additions}' if p.prompt_additions else '') + '\n'
+              for n, (p, k) in enumerate(zip(presentations, slide_counts), 1)]
+        ]),
+        "en": lambda: "\n".join([
+            f'Generate bullet point contents for {len(presentations)} PowerPoint presentations, in markdown format.',
+            f'Every presentation should have {f"{common_count} slides" if common_count else "the given number of slides"} with {num_bullets} bullet points each.',
+            'The presentation style should be casual, but still informative.',
+            'Include 2-3 jokes in every presentation.',
+            'Format every presentation in markdown! Use heading 1 for the presentation title, heading 2 for the slide titles, and lists for the bullet points.',
+            f'Start every presentation with a separate line "{BATCH_SEPARATOR["en"].format(n="<number>")}". The answer should only be markdown, do not add any explanations!',
+            '',
+            *[f'Presentation {n}: Topic "{p.topic}"' + (f', {k} slides.' if not common_count else '.') + (f'\n{p.prompt_additions}' if p.prompt_additions else '') + '\n'
+              for n, (p, k) in enumerate(zip(presentations, slide_counts), 1)]
+        ])
+    }
+    if language not in BATCH_PROMPT:
+        raise ValueError(f"batch_prompt: Undefined language {language}.")
+    return BATCH_PROMPT[language]()
+
+
+def split_batch_answer(answer: str) -> dict[int, str]:
+    """ Splits the answer to a batch_prompt at the separator lines, returns the markdown per presentation number. """
+    # Tolerates emphasis or heading marks around the separator
+    separator = re.compile(r"^[\s*#_]*=+\s*(?:Präsentation|Presentation)\s+(\d+)\s*=+[\s*_]*$", re.MULTILINE | re.IGNORECASE)
+    matches = list(separator.finditer(answer))
+    entries = {}
+    for match, next_match in zip(matches, matches[1:] + [None]):
+        markdown = answer[match.end():next_match.start() if next_match is not None else len(answer)].strip()
+        # Drop code fences around the markdown
+        markdown = re.sub(r"^```(?:markdown)?\s*|\s*```$", "", markdown).strip()
+        entries.setdefault(int(match.group(1)), markdown)
+    return entries
+
+
 if __name__ == "__main__":
     
     # f = open(TEMPLATE_DIR / "pp_karaoke.txt", "r", encoding="utf8")
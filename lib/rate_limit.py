@@ -0,0 +1,154 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+import hashlib
+import sqlite3
+import time
+from threading import Lock
+
+from lib.config import *
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+@dataclass
+class LimiterState:
+    api: str
+    tokens: float
+    used: int  # Requests of the current quota day
+    remaining: int | None  # None: no daily quota
+    exhausted: bool
+
+
+def quota_day(now: float = None) -> str:
+    """ Current quota day, daily quotas reset at midnight of QUOTA_RESET_UTC_OFFSET (Google: Pacific time). """
+    t = datetime.fromtimestamp(now if now is not None else time.time(), tz=timezone.utc) + timedelta(hours=QUOTA_RESET_UTC_OFFSET)
+    return t.strftime("%Y-%m-%d")
+
+
+class ApiLimiter:
+    """
+    Token bucket (requests per minute, bursts up to one minute's worth) and daily quota budget of one external API.
+    The state is kept in SQLite, s.t. all processes using the same API key share it.
+    A rate or quota of 0 means unlimited.
+    """
+
+    def __init__(self, api: str, per_minute: float = 0, daily_quota: int = 0, key: str = None, path: Path = None):
+        self.api = api
+        self.per_minute = per_minute
+        self.daily_quota = daily_quota
+        # Quotas are per API key
+        self.id = api + (":" + hashlib.sha256(key.encode("utf8")).hexdigest()[:12] if key else "")
+        self.path = Path(path or QUOTA_PATH)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS limiters (id TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, "
+                           "day TEXT NOT NULL, used INTEGER NOT NULL, exhausted INTEGER NOT NULL, paused_until REAL NOT NULL)")
+
+    def _transaction(self, fn):
+        """ Runs fn(state, now) on the current state (refilled, new day applied) and stores the state as fn left it. """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                day = quota_day(now)
+                row = self._conn.execute("SELECT tokens, updated, day, used, exhausted, paused_until FROM limiters WHERE id = ?", (self.id,)).fetchone()
+                capacity = max(1, self.per_minute)
+                if row is None:
+                    state = {"tokens": capacity, "day": day, "used": 0, "exhausted": 0, "paused_until": 0}
+                else:
+                    tokens, updated, row_day, used, exhausted, paused_until = row
+                    tokens = min(capacity, tokens + (now - updated) * self.per_minute / 60)
+                    state = {"tokens": tokens, "day": row_day, "used": used, "exhausted": exhausted, "paused_until": paused_until}
+                    if row_day != day:
+                        state.update(day=day, used=0, exhausted=0)
+                result = fn(state, now)
+                self._conn.execute("INSERT OR REPLACE INTO limiters (id, tokens, updated, day, used, exhausted, paused_until) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   (self.id, state["tokens"], now, state["day"], state["used"], state["exhausted"], state["paused_until"]))
+                self._conn.execute("COMMIT")
+                return result
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _remaining(self, state: dict) -> int | None:
+        if state["exhausted"]:
+            return 0
+        if not self.daily_quota:
+            return None
+        return max(0, self.daily_quota - state["used"])
+
+    def try_acquire(self) -> tuple[bool, float]:
+        """ Takes a token and a request of the budget if possible. Returns (acquired, seconds to wait before retrying). """
+        def acquire(state, now):
+            if self._remaining(state) == 0:
+                raise QuotaExceeded(f"Daily quota of {self.api} is exhausted.")
+            if now < state["paused_until"]:
+                return False, state["paused_until"] - now
+            if self.per_minute and state["tokens"] < 1:
+                return False, (1 - state["tokens"]) * 60 / self.per_minute
+            if self.per_minute:
+                state["tokens"] -= 1
+            state["used"] += 1
+            return True, 0
+        return self._transaction(acquire)
+
+    def acquire(self, timeout: float = None) -> bool:
+        """
+        Blocks until a request may be sent. Returns False if it could not be acquired within timeout.
+        Raises QuotaExceeded if the daily quota is exhausted.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            acquired, wait = self.try_acquire()
+            if acquired:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def remaining(self) -> int | None:
+        """ Requests left today, None if there is no daily quota. """
+        return self._transaction(lambda state, now: self._remaining(state))
+
+    def state(self) -> LimiterState:
+        return self._transaction(lambda state, now: LimiterState(api=self.api, tokens=state["tokens"], used=state["used"],
+                                                                 remaining=self._remaining(state), exhausted=bool(state["exhausted"])))
+
+    def exhaust(self):
+        """ The API reported its quota as exceeded, no more requests until the next quota day. """
+        def exhaust(state, now):
+            state["exhausted"] = 1
+        self._transaction(exhaust)
+
+    def pause(self, seconds: float):
+        """ The API reported a rate limit (429), hold back all requests for the given time (e.g. Retry-After). """
+        def pause(state, now):
+            state["paused_until"] = max(state["paused_until"], now + seconds)
+            state["tokens"] = 0
+        self._transaction(pause)
+
+    def close(self):
+        self._conn.close()
+
+
+LIMITS = {
+    "google_search": lambda: (GOOGLE_SEARCH_PER_MINUTE, GOOGLE_SEARCH_DAILY_QUOTA, os.getenv("GOOGLE_PSE_API_KEY")),
+    "openai_chat": lambda: (OPENAI_CHAT_PER_MINUTE, OPENAI_CHAT_DAILY_QUOTA, os.getenv("OPENAI_API_KEY")),
+    "openai_image": lambda: (OPENAI_IMAGE_PER_MINUTE, OPENAI_IMAGE_DAILY_QUOTA, os.getenv("OPENAI_API_KEY")),
+}
+
+_limiters = {}
+_limiters_lock = Lock()
+
+
+def get_rate_limiter(api: str) -> ApiLimiter:
+    """ Process-wide limiter of the given API ("google_search", "openai_chat" or "openai_image") as configured. """
+    with _limiters_lock:
+        if api not in _limiters:
+            per_minute, daily_quota, key = LIMITS[api]()
+            _limiters[api] = ApiLimiter(api, per_minute=per_minute, daily_quota=daily_quota, key=key)
+        return _limiters[api]
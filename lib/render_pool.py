@@ -0,0 +1,81 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+import random
+from threading import Lock
+from typing import Literal
+
+from lib.markdown import Slide
+from lib.config import *
+
+
+@dataclass
+class SlideImageSpec:
+    local_path: Path
+    width: int
+    height: int
+
+
+@dataclass
+class RenderSpec:
+    """ Serializable input of make_pptx, s.t. presentations can be rendered in worker processes. """
+    pptx_template_path: Path | None
+    topic: str
+    speaker: str
+    slides: list[Slide] = field(default_factory=lambda: [])  # Images replaced by SlideImageSpec
+    output: Literal["file", "memory"] = "file"
+    seed: int | None = None  # Layout choice, workers must not share the random state of the parent
+
+    @classmethod
+    def from_contents(cls, pptx_template_path, topic: str, speaker: str, contents: list[Slide], output: Literal["file", "memory"] = "file") -> "RenderSpec":
+        slides = []
+        for slide in contents:
+            img = slide.img
+            img = SlideImageSpec(local_path=Path(img.local_path), width=img.width, height=img.height) if img is not None and img.local_path else None
+            slides.append(Slide(title=slide.title, paragraphs=slide.paragraphs, img=img))
+        return cls(pptx_template_path=pptx_template_path,
+                   topic=topic,
+                   speaker=speaker,
+                   slides=slides,
+                   output=output,
+                   seed=random.getrandbits(32))
+
+
+def render_spec(spec: RenderSpec):
+    """ Runs in the worker process. """
+    from lib.pptx_factory import make_pptx
+    if spec.seed is not None:
+        random.seed(spec.seed)
+    return make_pptx(pptx_template_path=spec.pptx_template_path,
+                     topic=spec.topic,
+                     speaker=spec.speaker,
+                     contents=spec.slides,
+                     output=spec.output)
+
+
+class RenderPool:
+    """ Renders presentations in worker processes, s.t. rendering scales across cores and does not hold the GIL. """
+
+    def __init__(self, processes: int = None):
+        self.processes = processes or RENDER_PROCESSES or 1
+        self._pool = ProcessPoolExecutor(max_workers=self.processes)
+
+    def submit(self, spec: RenderSpec) -> Future:
+        return self._pool.submit(render_spec, spec)
+
+    def render(self, spec: RenderSpec):
+        return self.submit(spec).result()
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait)
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def get_render_pool() -> RenderPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = RenderPool()
+        return _pool
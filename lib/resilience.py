@@ -0,0 +1,250 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextvars import copy_context
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+import random
+import time
+from threading import Lock
+from typing import Callable, Iterator
+from openai import APIConnectionError, APIStatusError, RateLimitError
+
+from lib.openai_access import Completion, CompletionBackend, GeneratedImage, current_attempt
+from lib.rate_limit import QuotaExceeded
+from lib.tracing import event
+from lib.config import *
+
+
+RETRYABLE_STATUS_CODES = [408, 409, 429]  # and all 5xx
+
+
+def is_retryable(e: BaseException) -> bool:
+    """ Transient errors (timeouts, connection errors, rate limits, server errors). Bad requests, auth errors and exhausted quotas are final. """
+    if isinstance(e, QuotaExceeded):
+        return False
+    if isinstance(e, RateLimitError):
+        return e.code != "insufficient_quota"
+    if isinstance(e, APIStatusError):
+        return e.status_code in RETRYABLE_STATUS_CODES or e.status_code >= 500
+    return isinstance(e, (APIConnectionError, TimeoutError, ConnectionError))
+
+
+def retry_after(e: BaseException) -> float | None:
+    """ Seconds to wait as requested by the server (Retry-After or retry-after-ms header), if any. """
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            value = headers["retry-after"]
+            try:
+                return float(value)
+            except ValueError:
+                return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (ValueError, TypeError):
+        pass
+    return None
+
+
+def backoff_delay(attempt: int, base: float, cap: float, rng: random.Random = random) -> float:
+    """ Exponential backoff with full jitter: uniform in [0, min(cap, base * 2^attempt)], s.t. clients retrying together spread out. """
+    return rng.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class LatencyTracker:
+    """ Recent latencies per key (e.g. model), to tell when a request takes unusually long. """
+
+    def __init__(self, window: int = 200, min_samples: int = None):
+        self.window = window
+        self.min_samples = min_samples or OPENAI_HEDGE_MIN_SAMPLES
+        self._samples: dict[str, deque[float]] = {}
+        self._lock = Lock()
+
+    def record(self, key: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, key: str, q: float) -> float | None:
+        """ q-quantile of the recent latencies, None until there are enough samples. """
+        with self._lock:
+            samples = sorted(self._samples.get(key, []))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+@dataclass
+class RetryPolicy:
+    retries: int = 3  # Attempts after the first one
+    base_delay: float = 1  # seconds
+    max_delay: float = 30  # seconds
+    timeout: float | None = 60  # seconds per attempt
+
+    @classmethod
+    def from_config(cls) -> "RetryPolicy":
+        return cls(retries=OPENAI_RETRIES, base_delay=OPENAI_BACKOFF_BASE, max_delay=OPENAI_BACKOFF_MAX, timeout=OPENAI_TIMEOUT or None)
+
+
+def retry_delay(e: BaseException, attempt: int, policy: RetryPolicy) -> float:
+    delay = backoff_delay(attempt, policy.base_delay, policy.max_delay)
+    server_delay = retry_after(e)
+    return max(delay, server_delay) if server_delay is not None else delay
+
+
+def with_retries(fn: Callable, policy: RetryPolicy, name: str = "request"):
+    """ Calls fn() until it succeeds, a non-retryable error occurs or the retries are used up (then the last error is raised). """
+    for attempt in range(policy.retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= policy.retries or not is_retryable(e):
+                raise
+            delay = retry_delay(e, attempt, policy)
+            print(f"{name}: {type(e).__name__}, retrying in {delay:.1f}s ({attempt + 1}/{policy.retries}) ...")
+            event("retry", api=name, attempt=attempt + 1, error=type(e).__name__, delay=round(delay, 2))
+            time.sleep(delay)
+
+
+MAX_ABANDONED_ATTEMPTS = 16  # Of the 32 attempt workers, the rest stays free for new attempts
+
+_attempt_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="attempt")
+_abandoned = 0  # Attempts that were given up while running, they keep their worker until the call returns
+_abandoned_lock = Lock()
+
+
+@dataclass
+class AttemptClock:
+    started: float | None = None  # A worker picked the attempt up
+    limited: bool = False  # Waits for the rate limiter (see limited in lib/openai_access.py)
+    sent: float | None = None  # The request was sent
+
+    def deadline(self, timeout: float | None) -> float | None:
+        """ The timeout runs from when the request was sent, neither the queue of the pool nor the rate limiter count. """
+        start = self.sent if self.sent is not None else None if self.limited else self.started
+        return start + timeout if start is not None and timeout is not None else None
+
+
+def _run_timed(fn: Callable, clock: AttemptClock):
+    clock.started = time.monotonic()
+    current_attempt.set(clock)
+    return fn()
+
+
+def _release_abandoned(future: Future):
+    global _abandoned
+    with _abandoned_lock:
+        _abandoned -= 1
+
+
+def _abandon(futures: list[Future]):
+    """ Gives up the attempts: queued ones are cancelled, running ones are counted until they return. """
+    global _abandoned
+    for future in futures:
+        if future.cancel():
+            continue
+        with _abandoned_lock:
+            _abandoned += 1
+        future.add_done_callback(_release_abandoned)
+
+
+def run_attempt(fn: Callable, timeout: float | None, hedge_after: float | None = None, name: str = "request"):
+    """
+    Runs fn() in a worker thread and waits at most timeout seconds after the request was sent (TimeoutError).
+    If it has not returned after hedge_after seconds, a duplicate is sent and the first successful answer is used.
+    An abandoned call is not interrupted, its result is discarded. While too many of them occupy the workers,
+    attempts fail right away (TimeoutError, retried with backoff) and are not hedged.
+    """
+    with _abandoned_lock:
+        overloaded = _abandoned >= MAX_ABANDONED_ATTEMPTS
+    if overloaded:
+        raise TimeoutError(f"{name}: {MAX_ABANDONED_ATTEMPTS} abandoned requests are still running.")
+
+    def submit() -> tuple[Future, AttemptClock]:
+        clock = AttemptClock()
+        return _attempt_pool.submit(copy_context().run, _run_timed, fn, clock), clock
+
+    start = time.monotonic()
+    attempts = dict([submit()])
+    hedged = hedge_after is None
+    error = None
+    try:
+        while attempts:
+            # The first attempt is hedged hedge_after seconds after it was sent, the attempts time out individually
+            first = next(iter(attempts.values()))
+            deadlines = [clock.deadline(timeout) for clock in attempts.values()]
+            hedge_at = None if hedged else first.deadline(hedge_after)
+            until = [t for t in deadlines + [hedge_at] if t is not None]
+            # Deadlines are not known before the requests are sent, check again shortly
+            wait_for = max(0, min(until) - time.monotonic()) if until else None
+            if (timeout is not None and None in deadlines) or (not hedged and hedge_at is None):
+                wait_for = min(wait_for, 0.1) if wait_for is not None else 0.1
+            done, _ = wait(attempts, timeout=wait_for, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+                del attempts[future]
+            now = time.monotonic()
+            if attempts and all(t is not None and now >= t for t in [clock.deadline(timeout) for clock in attempts.values()]):
+                raise TimeoutError(f"{name} timed out after {timeout:.0f}s.")
+            hedge_at = None if hedged else first.deadline(hedge_after)
+            if attempts and hedge_at is not None and now >= hedge_at:
+                with _abandoned_lock:
+                    overloaded = _abandoned >= MAX_ABANDONED_ATTEMPTS
+                hedged = True
+                if not overloaded:
+                    # Slower than usual, race a duplicate against it
+                    print(f"{name}: No answer after {now - start:.1f}s, sending a hedged request ...")
+                    event("hedge", api=name, after=round(now - start, 2))
+                    future, clock = submit()
+                    attempts[future] = clock
+        raise error
+    finally:
+        _abandon([future for future in attempts if not future.done()])
+
+
+class ResilientBackend(CompletionBackend):
+    """
+    Retries transient errors of the wrapped backend with jittered exponential backoff (respecting Retry-After),
+    with a timeout per attempt. Optionally, a completion slower than the p95 of its model is hedged by a duplicate request.
+    Streams are only retried until their first chunk arrived (their timeout is the read timeout of the client).
+    """
+
+    def __init__(self, backend: CompletionBackend, policy: RetryPolicy = None, hedge: bool = None, latencies: LatencyTracker = None):
+        self.backend = backend
+        self.policy = policy or RetryPolicy.from_config()
+        self.hedge = OPENAI_HEDGE if hedge is None else hedge
+        self.latencies = latencies or LatencyTracker()
+
+    def complete(self, messages: list[dict], model: str) -> Completion:
+        def attempt():
+            hedge_after = self.latencies.percentile(model, 0.95) if self.hedge else None
+            t0 = time.monotonic()
+            completion = run_attempt(lambda: self.backend.complete(messages, model), self.policy.timeout, hedge_after=hedge_after, name="OpenAI completion")
+            self.latencies.record(model, time.monotonic() - t0)
+            return completion
+        return with_retries(attempt, self.policy, name="OpenAI completion")
+
+    def stream(self, messages: list[dict], model: str) -> Iterator[str]:
+        for attempt in range(self.policy.retries + 1):
+            started = False
+            try:
+                for chunk in self.backend.stream(messages, model):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                if started or attempt >= self.policy.retries or not is_retryable(e):
+                    raise
+                delay = retry_delay(e, attempt, self.policy)
+                print(f"OpenAI stream: {type(e).__name__}, retrying in {delay:.1f}s ({attempt + 1}/{self.policy.retries}) ...")
+                event("retry", api="OpenAI stream", attempt=attempt + 1, error=type(e).__name__, delay=round(delay, 2))
+                time.sleep(delay)
+
+    def generate_image(self, prompt: str, model: str, size: str) -> GeneratedImage:
+        # Not hedged, every generated image is billed
+        return with_retries(lambda: run_attempt(lambda: self.backend.generate_image(prompt, model, size), self.policy.timeout, name="OpenAI image"),
+                            self.policy, name="OpenAI image")
@@ -0,0 +1,179 @@
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar, copy_context
+from dataclasses import dataclass
+from threading import Event, Lock
+import time
+from typing import Callable
+
+from lib.config import *
+
+
+STAGES = ["completion", "image", "search", "download", "normalize", "render"]
+
+
+_tenant: ContextVar[str | None] = ContextVar("tenant", default=None)
+
+
+@contextmanager
+def tenant(key: str):
+    """ Everything scheduled within the block is accounted to the given tenant (e.g. a session) for fair scheduling. """
+    token = _tenant.set(key)
+    try:
+        yield
+    finally:
+        _tenant.reset(token)
+
+
+def current_tenant() -> str | None:
+    return _tenant.get()
+
+
+class FairSemaphore:
+    """ Semaphore whose free slots go round-robin to the tenants waiting for it (FIFO within a tenant). """
+
+    def __init__(self, value: int):
+        self._value = value
+        self._lock = Lock()
+        self._waiting: OrderedDict[str | None, deque[Event]] = OrderedDict()
+
+    def acquire(self):
+        with self._lock:
+            if self._value > 0 and not self._waiting:
+                self._value -= 1
+                return
+            ticket = Event()
+            self._waiting.setdefault(current_tenant(), deque()).append(ticket)
+        ticket.wait()
+
+    def release(self):
+        with self._lock:
+            if not self._waiting:
+                self._value += 1
+                return
+            # The slot is handed over directly to the next tenant, which then moves to the back
+            key, queue = next(iter(self._waiting.items()))
+            ticket = queue.popleft()
+            del self._waiting[key]
+            if queue:
+                self._waiting[key] = queue
+        ticket.set()
+
+
+class FairExecutor:
+    """
+    Thread pool that starts the submitted calls round-robin across tenants (FIFO within a tenant),
+    s.t. a large session cannot starve the others. Calls run in the context of the submitter.
+    """
+
+    def __init__(self, max_workers: int, thread_name_prefix: str = ""):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._queues: OrderedDict[str | None, deque] = OrderedDict()
+        self._lock = Lock()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        future = Future()
+        with self._lock:
+            self._queues.setdefault(current_tenant(), deque()).append((future, copy_context(), fn, args, kwargs))
+        # One runner per call, every runner starts whichever call is next in fair order
+        self._pool.submit(self._run_next)
+        return future
+
+    def _run_next(self):
+        with self._lock:
+            key, queue = next(iter(self._queues.items()))
+            future, context, fn, args, kwargs = queue.popleft()
+            del self._queues[key]
+            if queue:
+                self._queues[key] = queue
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = context.run(fn, *args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait)
+
+
+@dataclass
+class StageStats:
+    calls: int = 0
+    wait_time: float = 0  # seconds spent waiting for a slot
+    busy_time: float = 0  # seconds spent holding a slot
+
+
+class StageScheduler:
+    """
+    Runs presentation pipelines concurrently, with a separate concurrency limit per stage.
+    Can be shared by several sessions (see lib/daemon.py), stage slots and pool threads are then shared fairly among them.
+    """
+
+    def __init__(self, limits: dict[str, int] = None, max_presentations: int = None, max_tasks: int = None):
+        self.limits = {**STAGE_CONCURRENCY, **(limits or {})}
+        unknown = set(self.limits) - set(STAGES)
+        if unknown:
+            raise ValueError(f"StageScheduler: Unknown stage(s) {', '.join(sorted(unknown))}.")
+        if any(v < 1 for v in self.limits.values()):
+            raise ValueError(f"StageScheduler: Stage limits must be at least 1.")
+        self._semaphores = {stage: FairSemaphore(limit) for stage, limit in self.limits.items()}
+        self.stats = {stage: StageStats() for stage in self.limits}
+        self._stats_lock = Lock()
+
+        # Presentations and their sub-tasks (slides) get separate pools, s.t. a presentation
+        # waiting for its slides can never block the slides from being scheduled.
+        self.max_presentations = max_presentations or MAX_CONCURRENT_PRESENTATIONS
+        self.max_tasks = max_tasks or sum(self.limits.values())
+        self._presentation_pool = FairExecutor(max_workers=self.max_presentations, thread_name_prefix="presentation")
+        self._task_pool = FairExecutor(max_workers=self.max_tasks, thread_name_prefix="task")
+
+    @contextmanager
+    def stage(self, name: str):
+        """ Blocks until a slot of the given stage is free and holds it for the duration of the block. """
+        semaphore = self._semaphores[name]
+        t0 = time.perf_counter()
+        semaphore.acquire()
+        t1 = time.perf_counter()
+        try:
+            yield
+        finally:
+            semaphore.release()
+            t2 = time.perf_counter()
+            with self._stats_lock:
+                stats = self.stats[name]
+                stats.calls += 1
+                stats.wait_time += t1 - t0
+                stats.busy_time += t2 - t1
+
+    def run(self, stage: str, fn: Callable, *args, **kwargs):
+        with self.stage(stage):
+            return fn(*args, **kwargs)
+
+    def submit_presentation(self, fn: Callable, *args, **kwargs) -> Future:
+        # Tasks run in the context of the caller (e.g. its tracer and span, see lib/tracing.py)
+        return self._presentation_pool.submit(fn, *args, **kwargs)
+
+    def submit_task(self, fn: Callable, *args, **kwargs) -> Future:
+        """ Schedules a leaf task (must not submit further tasks itself). Stage slots are acquired by the task. """
+        return self._task_pool.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True):
+        self._presentation_pool.shutdown(wait=wait)
+        self._task_pool.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+def stage_slot(scheduler: StageScheduler | None, name: str):
+    """ Stage slot of the given scheduler, or a no-op context if running without scheduler. """
+    if scheduler is None:
+        return nullcontext()
+    return scheduler.stage(name)
@@ -0,0 +1,307 @@
+from concurrent.futures import Future
+from contextvars import copy_context
+import copy
+from dataclasses import dataclass
+import re
+from threading import Lock
+
+from lib.downloads import get_download_engine
+from lib.google_images import GoogleImage, google_image_search, preprocess_query
+from lib.image_processing import normalize_image_in_place
+from lib.markdown import Slide
+from lib.presentation import Presentation
+from lib.scheduler import StageScheduler
+from lib.config import *
+
+
+WORD = re.compile(r"\w{4,}")
+
+
+def words(text: str) -> set[str]:
+    return set(WORD.findall(text.casefold()))
+
+
+def assign_results(slides: list[tuple[int, Slide]], candidates: list[GoogleImage], topic: str) -> dict[int, int]:
+    """
+    One distinct candidate per slide (slide index -> candidate index), most relevant pairs first:
+    words of the slide title (except the topic, which all results match) in the title or page URL of the result.
+    Ties in result order, s.t. without any relevance the slides get the top results in order.
+    """
+    ignore = words(topic)
+    slide_words = [words(slide.title) - ignore for _j, slide in slides]
+    result_words = [words(f"{img.title or ''} {img.context_url}") for img in candidates]
+    pairs = sorted((-len(slide_words[n] & result_words[k]), k, n) for k in range(len(candidates)) for n in range(len(slides)))
+    assignment, used = {}, set()
+    for _score, k, n in pairs:
+        j = slides[n][0]
+        if j not in assignment and k not in used:
+            assignment[j] = k
+            used.add(k)
+    return assignment
+
+
+@dataclass
+class PlannedSearch:
+    query: str
+    start: int | None  # Page of the results (None: first page)
+    slides: list[tuple[int, Slide]]
+
+
+class SearchPlanner:
+    """
+    Plans the Google image searches of a session. Instead of one search per slide with a single result, the slides of a presentation
+    are coalesced into few wider searches (IMAGE_SEARCH_NUM results each), whose distinct results are spread over the slides by relevance.
+    Identical searches (e.g. the speculative topic search and the slide search) are sent once per session.
+    """
+
+    def __init__(self, slides_per_query: int = None, num_results: int = None):
+        self.slides_per_query = slides_per_query or IMAGE_SEARCH_SLIDES_PER_QUERY
+        self.num_results = num_results or IMAGE_SEARCH_NUM
+        self.num_searches = 0
+        self.num_deduplicated = 0
+        self._searches: dict[tuple[str, int | None], Future] = {}
+        self._lock = Lock()
+
+    def topic_query(self, presentation: Presentation, language: str) -> str:
+        query = presentation.topic
+        if presentation.image_query_suffix:
+            query += " " + presentation.image_query_suffix
+        return preprocess_query(query, language)
+
+    def group_sizes(self, num_slides: int, mode: str = "slide") -> list[int]:
+        """ Slides per search ("presentation" mode: one search for all slides). """
+        size = max(1, num_slides if mode == "presentation" else self.slides_per_query)
+        return [min(size, num_slides - k) for k in range(0, num_slides, size)]
+
+    def num_queries(self, num_slides: int, mode: str = "slide") -> int:
+        return len(self.group_sizes(num_slides, mode)) if mode != "none" else 0
+
+    def num_topic_pages(self, num_slides: int, mode: str = "slide") -> int:
+        """ Searches by the topic only (one page of results each), which can be sent before the slides are known. """
+        if mode == "none":
+            return 0
+        return sum(1 for size in self.group_sizes(num_slides, mode) if size > 1 or mode == "presentation")
+
+    def num_needed(self, presentation: Presentation, num_slides: int, mode: str = "slide", language: str = None) -> int:
+        """ Searches the presentation still needs: the planned ones, except topic pages that were sent already (e.g. speculatively). """
+        num_needed = self.num_queries(num_slides, mode)
+        if language is not None and num_needed:
+            query = self.topic_query(presentation, language)
+            num_needed -= sum(1 for page in range(self.num_topic_pages(num_slides, mode)) if self.sent(query, self._start(page)))
+        return num_needed
+
+    def sent(self, query: str, start: int | None) -> bool:
+        with self._lock:
+            future = self._searches.get(self._key(query, start), None)
+            return future is not None and not future.cancelled()
+
+    def _key(self, query: str, start: int | None) -> tuple[str, int | None]:
+        return " ".join(query.split()).casefold(), start
+
+    def _start(self, page: int) -> int | None:
+        """ Index of the first result of a page, None for the first page (the default). """
+        return page * self.num_results + 1 if page else None
+
+    def plan(self, presentation: Presentation, slides: list[tuple[int, Slide]], language: str, topic_only: bool = False) -> list[PlannedSearch]:
+        """
+        Groups of slides are searched by the topic, one page of results per group.
+        A single slide is searched by the topic and its title (as without grouping), unless topic_only.
+        """
+        topic_query = self.topic_query(presentation, language)
+        searches, page, k = [], 0, 0
+        for size in self.group_sizes(len(slides), presentation.image_search_mode):
+            group = slides[k:k + size]
+            k += size
+            if size > 1 or topic_only or presentation.image_search_mode == "presentation":
+                searches.append(PlannedSearch(query=topic_query, start=self._start(page), slides=group))
+                page += 1
+            else:
+                query = f"{presentation.topic} {group[0][1].title}"
+                if presentation.image_query_suffix:
+                    query += " " + presentation.image_query_suffix
+                searches.append(PlannedSearch(query=preprocess_query(query, language), start=None, slides=group))
+        return searches
+
+    def search(self, query: str, start: int | None, scheduler: StageScheduler) -> Future:
+        """ Candidates of the search (not downloaded), each search is sent once. """
+        key = self._key(query, start)
+        with self._lock:
+            future = self._searches.get(key, None)
+            if future is not None and not future.cancelled():
+                self.num_deduplicated += 1
+                return future
+            self.num_searches += 1
+            future = scheduler.submit_task(google_image_search, query=query, start=start, num=self.num_results, download=False,
+                                           imgSize=None, safe="active", scheduler=scheduler)
+            self._searches[key] = future
+            return future
+
+    def prefetch(self, presentation: Presentation, language: str, scheduler: StageScheduler, num_slides: int) -> list[Future]:
+        """ Starts the searches that only depend on the topic (before the slides are known). """
+        if num_slides < 1:
+            return []
+        query = self.topic_query(presentation, language)
+        return [self.search(query, self._start(page), scheduler) for page in range(self.num_topic_pages(num_slides, presentation.image_search_mode))]
+
+    def search_images(self, presentation: Presentation, contents: list[Slide], language: str, scheduler: StageScheduler,
+                      skip: set[int] = frozenset(), topic_only: bool = False) -> int:
+        """
+        Finds distinct images for the slides without one (except skip), returns the number of slides that got one.
+        topic_only: use the remaining results of the topic searches (sent already), e.g. for a slide whose OpenAI image failed.
+        """
+        if presentation.image_search_mode == "none":
+            return 0
+        slides = [(j, slide) for j, slide in enumerate(contents) if slide.img is None and j not in skip]
+        if not slides:
+            return 0
+        searches = self.plan(presentation, slides, language, topic_only=topic_only)
+        futures = [self.search(search.query, search.start, scheduler) for search in searches]
+        used = {image["image"].url for image in presentation.images if image["source"] == "google"}
+        num_found = 0
+        for search, future in zip(searches, futures):
+            try:
+                candidates, res, parameters = future.result()
+            except Exception as e:
+                print(f"Google image search failed: {type(e).__name__}: {e}")
+                continue
+            if "error" in res:
+                print(f"Google image search failed: {res['error'].get('message', None)}")
+            # Shared with other presentations of the same query, downloaded separately
+            candidates = [copy.copy(img) for img in candidates if img.url not in used]
+            for j, slide, img in self._download(search.slides, candidates, presentation.topic, scheduler):
+                used.add(img.url)
+                if NORMALIZE_IMAGES and not normalize_image_in_place(img, scheduler=scheduler):
+                    # Not a readable image
+                    continue
+                if not slide.set_img(img):
+                    continue
+                num_found += 1
+                presentation.images.append({
+                    "source": "google",
+                    "slide": j + 1,
+                    "image": img,
+                    "search": {
+                        "query": search.query,
+                        "parameters": parameters,
+                        "results": res
+                    },
+                    "all_images": candidates
+                })
+        presentation.images.sort(key=lambda image: image["slide"])
+        return num_found
+
+    def _download(self, slides: list[tuple[int, Slide]], candidates: list[GoogleImage], topic: str, scheduler: StageScheduler) -> list[tuple[int, Slide, GoogleImage]]:
+        """ Downloads the assigned candidates concurrently, slides whose download failed get the remaining candidates. """
+        if not candidates:
+            return []
+        engine = get_download_engine()
+        assignment = assign_results(slides, candidates, topic)
+        engine.download_first([candidates[k] for k in assignment.values()], scheduler=scheduler)
+        downloaded, failed = [], []
+        for j, slide in slides:
+            img = candidates[assignment[j]] if j in assignment else None
+            if img is not None and img.downloaded:
+                downloaded.append((j, slide, img))
+            else:
+                failed.append((j, slide))
+        leftovers = [img for k, img in enumerate(candidates) if k not in set(assignment.values())]
+        if failed and leftovers:
+            imgs = engine.download_first(leftovers, num_downloads=len(failed), scheduler=scheduler)
+            downloaded += [(j, slide, img) for (j, slide), img in zip(failed, imgs)]
+        return downloaded
+
+    def summary(self) -> str:
+        return f"Google image search: {self.num_searches} search(es), {self.num_deduplicated} deduplicated."
+
+
+def _then(future: Future, scheduler: StageScheduler, fn, *args) -> Future:
+    """ Runs fn(future, *args) as a leaf task once the future is done, s.t. no task has to wait for it. """
+    context = copy_context()
+    result = Future()
+
+    def resolve(task: Future):
+        if task.cancelled():
+            result.cancel()
+        elif task.exception() is not None:
+            result.set_exception(task.exception())
+        else:
+            result.set_result(task.result())
+
+    def submit(_future: Future):
+        try:
+            # In the context of the caller (e.g. its span), not of the thread that completed the future
+            context.run(scheduler.submit_task, fn, future, *args).add_done_callback(resolve)
+        except Exception as e:
+            # e.g. the scheduler was shut down
+            result.set_exception(e)
+
+    future.add_done_callback(submit)
+    return result
+
+
+class StreamedImages:
+    """
+    Images of the slides that are found while the answer is streamed: as soon as a slide is parsed, it gets the most relevant
+    unused result of its group's topic search (see SearchPlanner.prefetch), which is downloaded right away.
+    """
+
+    def __init__(self, planner: SearchPlanner, presentation: Presentation, language: str, scheduler: StageScheduler):
+        self.planner = planner
+        self.presentation = presentation
+        self.scheduler = scheduler
+        self.query = planner.topic_query(presentation, language)
+        self.futures: list[Future] = []
+        self._num_slides = 0
+        self._used: set[str] = set()
+        self._lock = Lock()
+
+    def add(self, slide_index: int, slide: Slide):
+        mode = self.presentation.image_search_mode
+        if mode == "none":
+            return
+        page = 0 if mode == "presentation" else self._num_slides // self.planner.slides_per_query
+        self._num_slides += 1
+        search = self.planner.search(self.query, self.planner._start(page), self.scheduler)
+        self.futures.append(_then(search, self.scheduler, self._find_image, slide_index, slide))
+
+    def wait(self):
+        """ Blocks until the images of the added slides are found (or not). """
+        for future in self.futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Google image search failed: {type(e).__name__}: {e}")
+        self.presentation.images.sort(key=lambda image: image["slide"])
+
+    def _find_image(self, search: Future, j: int, slide: Slide):
+        candidates, res, parameters = search.result()
+        slide_words = words(slide.title) - words(self.presentation.topic)
+        with self._lock:
+            # A few of the most relevant results are reserved and tried in order
+            ranked = sorted((k for k, img in enumerate(candidates) if img.url not in self._used),
+                            key=lambda k: (-len(slide_words & words(f"{candidates[k].title or ''} {candidates[k].context_url}")), k))[:3]
+            reserved = [copy.copy(candidates[k]) for k in ranked]
+            self._used.update(img.url for img in reserved)
+        engine = get_download_engine()
+        img = next((img for img in reserved if engine.download_first([img], scheduler=self.scheduler)), None)
+        with self._lock:
+            self._used.difference_update(other.url for other in reserved if other is not img)
+        if img is None:
+            return
+        if NORMALIZE_IMAGES and not normalize_image_in_place(img, scheduler=self.scheduler):
+            # Not a readable image
+            return
+        with self._lock:
+            if not slide.set_img(img):
+                return
+            self.presentation.images.append({
+                "source": "google",
+                "slide": j + 1,
+                "image": img,
+                "search": {
+                    "query": self.query,
+                    "parameters": parameters,
+                    "results": res
+                },
+                "all_images": candidates
+            })
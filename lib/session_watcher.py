@@ -0,0 +1,216 @@
+import http.server
+import json
+import queue
+import time
+from threading import Thread
+from typing import Iterator
+
+import requests
+
+from lib.frontend import FrontendClient, get_frontend_client
+from lib.types import SessionState
+from lib.config import *
+
+
+WATCH_MODES = ["auto", "sse", "longpoll", "webhook", "poll"]
+SSE_MAX_RECONNECT_DELAY = 30  # seconds
+
+
+class WatchModeUnsupported(Exception):
+    pass
+
+
+def session_state(session: dict) -> SessionState:
+    return [s for s in SessionState if session["state"] == s.value][0]
+
+
+class SessionWatcher:
+    """
+    Yields a session whenever it changes on the frontend.
+    Modes:
+    - sse: Server-sent events from /api/session/<id>/events (unsupported if the first request is not answered with an event stream)
+    - longpoll: Conditional requests that the frontend holds until the session changes (?wait=<seconds>)
+    - webhook: Local HTTP receiver that the frontend notifies (the session is then fetched), with slow conditional polling as safety net
+    - poll: Conditional requests (ETag/If-Modified-Since) every poll_interval seconds
+    - auto: sse, falling back to poll
+    """
+
+    def __init__(self,
+                 session_id: str,
+                 mode: str = None,
+                 client: FrontendClient = None,
+                 poll_interval: float = None,
+                 long_poll_timeout: float = None,
+                 webhook_port: int = None,
+                 webhook_host: str = None):
+        if not re.match(r"^[A-Za-z0-9\-]+$", session_id):
+            raise ValueError("Invalid session ID.")
+        self.session_id = session_id
+        self.mode = mode or SESSION_WATCH_MODE
+        if self.mode not in WATCH_MODES:
+            raise ValueError(f"SessionWatcher: Unknown mode '{self.mode}'.")
+        self.client = client or get_frontend_client()
+        self.poll_interval = poll_interval or SESSION_POLL_INTERVAL
+        self.long_poll_timeout = long_poll_timeout or SESSION_LONG_POLL_TIMEOUT
+        self.webhook_port = webhook_port if webhook_port is not None else SESSION_WEBHOOK_PORT
+        self.webhook_host = webhook_host or SESSION_WEBHOOK_HOST
+
+        self._etag = None
+        self._last_modified = None
+        self._last_session = None
+
+    def wait_for(self, *states: SessionState) -> dict:
+        """ Blocks until the session is in one of the given states and returns it. """
+        for session in self.updates():
+            state = session_state(session)
+            print(f"Session state: {state.name}")
+            if state in states:
+                return session
+
+    def updates(self) -> Iterator[dict]:
+        if self.mode == "sse":
+            yield from self._watch_sse()
+        elif self.mode == "longpoll":
+            yield from self._watch_poll(long_poll=True)
+        elif self.mode == "webhook":
+            yield from self._watch_webhook()
+        elif self.mode == "poll":
+            yield from self._watch_poll()
+        else:
+            try:
+                yield from self._watch_sse()
+            except WatchModeUnsupported as e:
+                print(f"Server-sent events unavailable ({e}), falling back to polling.")
+                yield from self._watch_poll()
+
+    def _changed(self, session: dict) -> bool:
+        if session == self._last_session:
+            return False
+        self._last_session = session
+        return True
+
+    def _fetch(self, params: dict = None, timeout: float = None) -> dict | None:
+        """ Conditional request, returns the session if it changed since the last response. """
+        res = self.client.get_session(self.session_id, etag=self._etag, last_modified=self._last_modified, params=params, timeout=timeout)
+        if not res.modified:
+            return None
+        self._etag, self._last_modified = res.etag, res.last_modified
+        return res.session if self._changed(res.session) else None
+
+    def _watch_poll(self, long_poll: bool = False) -> Iterator[dict]:
+        while True:
+            t0 = time.monotonic()
+            if long_poll:
+                session = self._fetch(params={"wait": int(self.long_poll_timeout)}, timeout=self.long_poll_timeout + self.client.timeout)
+            else:
+                session = self._fetch()
+            if session is not None:
+                yield session
+                continue
+            # A frontend without long-poll support answers immediately, wait as for plain polling
+            time.sleep(max(0, self.poll_interval - (time.monotonic() - t0)))
+
+    def _watch_sse(self) -> Iterator[dict]:
+        # Initial state, events only report changes
+        session = self._fetch()
+        if session is not None:
+            yield session
+        url = self.client.url(f"session/{self.session_id}/events")
+        connected = False
+        failures = 0
+        while True:
+            try:
+                with self.client.session.get(url, stream=True, headers={"Accept": "text/event-stream"},
+                                             timeout=(self.client.timeout, SESSION_SSE_READ_TIMEOUT)) as res:
+                    if res.ok and res.headers.get("Content-Type", "").startswith("text/event-stream"):
+                        connected = True
+                        failures = 0
+                        # Changes between the last fetch and the subscription are not sent as events
+                        session = self._fetch()
+                        if session is not None:
+                            yield session
+                        for session in self._parse_sse(res):
+                            if self._changed(session):
+                                yield session
+                        print("Event stream closed by the server, reconnecting ...")
+                    elif not connected:
+                        raise WatchModeUnsupported(f"status code {res.status_code}")
+                    else:
+                        # The frontend supported events before, e.g. a proxy error while it restarts
+                        failures += 1
+                        print(f"Event stream unavailable (status code {res.status_code}), reconnecting ...")
+            except requests.RequestException as e:
+                # Connection lost or idle for too long
+                failures += 1
+                print(f"Event stream interrupted ({type(e).__name__}), reconnecting ...")
+            # Reconnect after a pause (longer after repeated failures), catching up with a conditional request
+            time.sleep(min(self.poll_interval * 2 ** max(0, failures - 1), SSE_MAX_RECONNECT_DELAY))
+            session = self._fetch()
+            if session is not None:
+                yield session
+
+    @staticmethod
+    def _parse_sse(res: requests.Response) -> Iterator[dict]:
+        data = []
+        # Small chunks, s.t. events are not held back in the read buffer
+        for line in res.iter_lines(chunk_size=1, decode_unicode=True):
+            if line is None:
+                continue
+            if line == "":
+                # End of event
+                if data:
+                    try:
+                        payload = json.loads("\n".join(data))
+                    except json.JSONDecodeError:
+                        print("Skipping malformed session event.")
+                        payload = None
+                    if isinstance(payload, dict):
+                        yield payload.get("session", payload)
+                data = []
+            elif line.startswith("data:"):
+                data.append(line[5:].lstrip())
+
+    def _watch_webhook(self) -> Iterator[dict]:
+        notifications = queue.Queue()
+
+        class WebhookHandler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                # The receiver is unauthenticated: a notification only triggers a fetch, its body is not trusted
+                self.rfile.read(int(self.headers.get("Content-Length", 0) or 0))
+                notifications.put(True)
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((self.webhook_host, self.webhook_port), WebhookHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        callback_url = SESSION_WEBHOOK_URL or f"http://localhost:{server.server_port}"
+        try:
+            res = self.client.session.post(self.client.url(f"session/{self.session_id}/webhook"),
+                                           json={"url": callback_url}, timeout=self.client.timeout)
+            registered = res.ok
+        except requests.RequestException:
+            registered = False
+        if not registered:
+            print("Webhook registration failed, falling back to polling.")
+            server.shutdown()
+            yield from self._watch_poll()
+            return
+
+        try:
+            session = self._fetch()
+            if session is not None:
+                yield session
+            while True:
+                try:
+                    notifications.get(timeout=SESSION_WEBHOOK_SAFETY_POLL)
+                except queue.Empty:
+                    # No notification for a while, make sure none got lost
+                    pass
+                session = self._fetch()
+                if session is not None:
+                    yield session
+        finally:
+            server.shutdown()
@@ -0,0 +1,185 @@
+from concurrent.futures import Future
+import random
+
+from lib.cache import cache_key
+from lib.openai_access import get_completion_backend, openai_request
+from lib.presentation import Presentation
+from lib.prompts import generate_prompts
+from lib.rate_limit import get_rate_limiter
+from lib.scheduler import StageScheduler
+from lib.search_planner import SearchPlanner
+from lib.utils import random_assignment
+from lib.config import *
+
+
+def session_players(session: dict) -> list[dict]:
+    """ Players taking part in the generation (same selection as generate_from_api). """
+    return [p for p in session["players"] if p["topics"]]
+
+
+class Speculator:
+    """
+    Drafts the presentations while the session is still READY and starts the work that only depends on the topics:
+    image searches per topic and (optionally) the completions. Speaker instructions come from the instruction stock (see lib/instructions.py).
+    On every update (and when the session is closed), drafts whose inputs did not change are kept,
+    the rest is discarded and drafted again.
+    """
+
+    def __init__(self,
+                 language: str,
+                 speculate_completions: bool = None,
+                 topic_image_search: bool = True,
+                 num_wrong_topics: int = 2,
+                 scheduler: StageScheduler = None):  # Shared scheduler, owned by the caller
+        self.language = language
+        self.speculate_completions = SPECULATE_COMPLETIONS if speculate_completions is None else speculate_completions
+        self.topic_image_search = topic_image_search
+        self.num_wrong_topics = num_wrong_topics
+        self.openai_client = get_completion_backend()
+        self.owns_scheduler = scheduler is None
+        self.scheduler = scheduler or StageScheduler()
+
+        self.presentations: list[Presentation] = []
+        self.players_key = None
+        self.search_planner = SearchPlanner()  # Passed on to the generation, s.t. the topic searches are not sent again
+        self.topic_searches: dict[str, Future] = {}
+
+        self.num_kept = 0
+        self.num_discarded = 0
+
+    def update(self, session: dict):
+        """ Called with every update of the session while it is READY. """
+        players = session_players(session)
+        if not self._draftable(players):
+            # Not enough input for a draft yet
+            return
+        key = cache_key([(p["id"], p["name"], p.get("isSpeaker", True), sorted(t["name"] for t in p["topics"])) for p in players])
+        if key == self.players_key:
+            return
+        self.players_key = key
+        self._reconcile(players)
+        self._start_topic_work()
+
+    def finalize(self, session: dict) -> list[Presentation] | None:
+        """ Reconciles the drafts with the closed session, returns the presentations (None if it cannot be drafted). """
+        if not self._draftable(session_players(session)):
+            # e.g. a player left or removed topics after the last draft, the drafts do not fit the session anymore
+            for presentation in self.presentations:
+                self._discard(presentation)
+            for future in self.topic_searches.values():
+                future.cancel()
+            self.presentations, self.players_key, self.topic_searches = [], None, {}
+            if self.owns_scheduler:
+                self.scheduler.shutdown(wait=False)
+            return None
+
+        self.update(session)
+        print(f"Speculation: Kept {self.num_kept} and discarded {self.num_discarded} drafted presentation(s).")
+        if self.owns_scheduler:
+            self.scheduler.shutdown(wait=False)
+        return self.presentations
+
+    def _draftable(self, players: list[dict]) -> bool:
+        return len(players) >= 2 and all(len(p["topics"]) >= 1 + self.num_wrong_topics for p in players)
+
+    def _reconcile(self, players: list[dict]):
+        players_by_id = {p["id"]: p for p in players}
+        topics_by_author = {p["id"]: {t["name"] for t in p["topics"]} for p in players}
+
+        # Keep drafts whose speaker is unchanged and whose topics are still all provided by one other player
+        kept, used_authors = [], set()
+        for presentation in self.presentations:
+            player = players_by_id.get(presentation.player_id, None)
+            author = self._find_author(presentation, topics_by_author, used_authors)
+            if player is None or player["name"] != presentation.speaker or not player.get("isSpeaker", True) or author is None:
+                self._discard(presentation)
+                continue
+            presentation.author_id = author
+            used_authors.add(author)
+            kept.append(presentation)
+
+        # Draft the rest among the remaining speakers and topic groups. If that is impossible without someone
+        # getting their own topics (e.g. a single new player), give up kept drafts one by one.
+        while True:
+            kept_speakers = {presentation.player_id for presentation in kept}
+            speakers = [p for p in players if p["id"] not in kept_speakers]
+            authors = [p for p in players if p["id"] not in used_authors]
+            assignment = self._assign(speakers, authors)
+            if assignment is not None:
+                break
+            presentation = kept.pop(random.randrange(len(kept)))
+            used_authors.discard(presentation.author_id)
+            self._discard(presentation)
+
+        drafts = []
+        for speaker, author in assignment:
+            topics = random.sample([t["name"] for t in author["topics"]], 1 + self.num_wrong_topics)
+            presentation = Presentation(speaker=speaker["name"], topic=topics[0], wrong_topics=topics[1:])
+            presentation.player = speaker
+            presentation.player_id = speaker["id"]
+            presentation.session_id = speaker["sessionId"]
+            presentation.author_id = author["id"]
+            if speaker.get("isSpeaker", True):
+                drafts.append(presentation)
+        if drafts:
+            generate_prompts(presentations=drafts, language=self.language)
+
+        self.num_kept = len(kept)
+        self.presentations = kept + drafts
+        random.shuffle(self.presentations)
+
+    @staticmethod
+    def _find_author(presentation: Presentation, topics_by_author: dict[str, set], used_authors: set) -> str | None:
+        topics = {presentation.topic, *presentation.wrong_topics}
+        candidates = [presentation.author_id] if presentation.author_id is not None else list(topics_by_author)
+        for author in candidates:
+            if author != presentation.player_id and author not in used_authors and topics <= topics_by_author.get(author, set()):
+                return author
+        return None
+
+    @staticmethod
+    def _assign(speakers: list[dict], authors: list[dict]) -> list[tuple[dict, dict]] | None:
+        if not speakers:
+            return []
+        try:
+            sample = random_assignment([author["id"] for author in authors], [speaker["id"] for speaker in speakers])
+        except ValueError:
+            return None
+        return [(speaker, authors[i]) for speaker, i in zip(speakers, sample)]
+
+    def _discard(self, presentation: Presentation):
+        self.num_discarded += 1
+        if presentation.pending_markdown is not None:
+            presentation.pending_markdown.cancel()
+
+    def _search_budget_left(self) -> bool:
+        """
+        Whether the daily Google search quota covers all searches the session still needs (see plan_image_searches).
+        Otherwise no searches are sent speculatively, the generation decides which presentations get them.
+        """
+        remaining = get_rate_limiter("google_search").remaining()
+        if remaining is None:
+            return True
+        # The OpenAI image serves one slide of each presentation (see generate_from_api)
+        needed = sum(self.search_planner.num_needed(presentation, max(1, (presentation.num_slides or 5) - 1), "slide", self.language)
+                     for presentation in self.presentations)
+        if remaining < needed:
+            print(f"Speculation: Google search quota is low ({remaining} left, {needed} needed), no speculative image searches.")
+            return False
+        return True
+
+    def _start_topic_work(self):
+        for presentation in self.presentations:
+            if self.speculate_completions and presentation.pending_markdown is None:
+                presentation.pending_markdown = self.scheduler.submit_task(self.scheduler.run, "completion", openai_request,
+                                                                           self.openai_client, presentation.prompt, save_chat=True, name="presentation")
+
+        if self.topic_image_search and self._search_budget_left():
+            # First page of the topic search, which the generation shares (see SearchPlanner)
+            queries = {self.search_planner.topic_query(presentation, self.language) for presentation in self.presentations}
+            for query, future in list(self.topic_searches.items()):
+                if query not in queries:
+                    future.cancel()
+                    del self.topic_searches[query]
+            for query in queries - set(self.topic_searches):
+                self.topic_searches[query] = self.search_planner.search(query, None, self.scheduler)
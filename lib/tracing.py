@@ -0,0 +1,181 @@
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+import itertools
+import json
+import os
+import threading
+import time
+from typing import Callable, Iterator
+
+from lib.config import *
+
+
+@dataclass
+class Span:
+    name: str
+    start: float  # perf_counter seconds
+    end: float | None = None
+    attributes: dict = field(default_factory=lambda: {})
+    thread_id: int = 0
+    span_id: int = 0
+    parent_id: int | None = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+
+# Context attributes that spans take over from their parent span
+INHERITED_ATTRIBUTES = ["session", "player", "speaker", "presentation", "slide"]
+
+
+def inherited_attributes(parent: Span | None) -> dict:
+    if parent is None:
+        return {}
+    return {k: v for k, v in parent.attributes.items() if k in INHERITED_ATTRIBUTES}
+
+
+_tracer: ContextVar["Tracer | None"] = ContextVar("tracer", default=None)
+_span: ContextVar[Span | None] = ContextVar("span", default=None)
+
+
+class Tracer:
+    """
+    Collects the spans of one session. Spans inherit the context attributes (session, player, slide, ...) of their parent span.
+    The current tracer and span are context variables, pools propagate them to their threads (see lib/scheduler.py).
+    """
+
+    def __init__(self, session_id: str = None):
+        self.session_id = session_id
+        self.spans: list[Span] = []
+        self.events: list[Span] = []
+        self.t0 = time.perf_counter()
+        self._ids = itertools.count(1)
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        parent = _span.get()
+        span = Span(name=name,
+                    start=time.perf_counter(),
+                    attributes={**inherited_attributes(parent), **attributes},
+                    thread_id=threading.get_ident(),
+                    span_id=next(self._ids),
+                    parent_id=parent.span_id if parent is not None else None)
+        token = _span.set(span)
+        try:
+            yield span
+        except GeneratorExit:
+            raise
+        except BaseException as e:
+            span.attributes["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.end = time.perf_counter()
+            _span.reset(token)
+            with self._lock:
+                self.spans.append(span)
+                self._threads.setdefault(span.thread_id, threading.current_thread().name)
+
+    def event(self, name: str, **attributes):
+        """ Instant event, e.g. a presentation being ready. """
+        parent = _span.get()
+        with self._lock:
+            self.events.append(Span(name=name,
+                                    start=time.perf_counter(),
+                                    attributes={**inherited_attributes(parent), **attributes},
+                                    thread_id=threading.get_ident()))
+            self._threads.setdefault(threading.get_ident(), threading.current_thread().name)
+
+    def chrome_trace(self) -> dict:
+        """ Trace Event Format, viewable in chrome://tracing or https://ui.perfetto.dev """
+        pid = os.getpid()
+        us = lambda t: round((t - self.t0) * 1e6)
+        with self._lock:
+            events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}} for tid, name in self._threads.items()]
+            events += [{
+                "name": span.name,
+                "cat": span.name.split(".")[0],
+                "ph": "X",
+                "ts": us(span.start),
+                "dur": us(span.end) - us(span.start),
+                "pid": pid,
+                "tid": span.thread_id,
+                "args": {k: str(v) for k, v in span.attributes.items()}
+            } for span in sorted(self.spans, key=lambda s: s.start)]
+            events += [{
+                "name": event.name,
+                "ph": "i",
+                "s": "p",
+                "ts": us(event.start),
+                "pid": pid,
+                "tid": event.thread_id,
+                "args": {k: str(v) for k, v in event.attributes.items()}
+            } for event in self.events]
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"session": self.session_id}}
+
+    def export(self, path: Path = None) -> Path:
+        path = path or TRACE_DIR / f"trace-{NOW()}{'-' + ESCAPE_PATH(self.session_id) if self.session_id else ''}.json"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        json.dump(self.chrome_trace(), open(path, "w", encoding="utf8"))
+        return path
+
+    def summary(self, top: int = 8) -> str:
+        """ Count, total and max. duration per span name, by total duration. """
+        totals = {}
+        with self._lock:
+            for span in self.spans:
+                count, total, maximum = totals.get(span.name, (0, 0, 0))
+                totals[span.name] = (count + 1, total + span.duration, max(maximum, span.duration))
+            ready = sorted(event.start - self.t0 for event in self.events if event.name == "presentation_ready")
+        lines = [f"{'span':<24} {'count':>6} {'total':>9} {'max':>8}"]
+        for name, (count, total, maximum) in sorted(totals.items(), key=lambda item: -item[1][1])[:top]:
+            lines.append(f"{name:<24} {count:>6} {total:>8.2f}s {maximum:>7.2f}s")
+        if ready:
+            lines.append(f"First presentation ready after {ready[0]:.2f}s.")
+        return "\n".join(lines)
+
+
+def current_tracer() -> Tracer | None:
+    return _tracer.get()
+
+
+def span(name: str, **attributes):
+    """ Span of the current tracer, or a no-op context if the session is not traced. """
+    tracer = _tracer.get()
+    if tracer is None:
+        return nullcontext()
+    return tracer.span(name, **attributes)
+
+
+def run_in_span(name: str, attributes: dict, fn: Callable, *args, **kwargs):
+    """ Runs fn within a span, e.g. as a pool task. """
+    with span(name, **attributes):
+        return fn(*args, **kwargs)
+
+
+def event(name: str, **attributes):
+    tracer = _tracer.get()
+    if tracer is not None:
+        tracer.event(name, **attributes)
+
+
+@contextmanager
+def tracing(session_id: str = None, enabled: bool = None, **attributes) -> Iterator[Tracer | None]:
+    """ Traces everything within the block (incl. the pool threads it starts) and exports the trace when it is left. """
+    enabled = TRACE_SESSIONS if enabled is None else enabled
+    if not enabled:
+        yield None
+        return
+    tracer = Tracer(session_id=session_id)
+    token = _tracer.set(tracer)
+    try:
+        with tracer.span("session", session=session_id, **attributes):
+            yield tracer
+    finally:
+        _tracer.reset(token)
+        path = tracer.export()
+        print(tracer.summary())
+        print(f"Saved trace to {path}.")
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+from collections import Counter
 import random
 import subprocess
 import urllib.parse
@@ -12,6 +13,8 @@ if TYPE_CHECKING:
 
 
 def show_presentation_blocking(pptx_path):
+    if PPT_EXE is None:
+        raise ValueError("Cannot launch the slideshow, POWERPOINT_EXE_PATH is not set.")
     cmd = f"{PPT_EXE} /s \"{pptx_path}\""
     subprocess.run((cmd))
 
@@ -39,48 +42,53 @@ def sample_minimal_repitions(population, k):
     return sample + random.sample(population, k % size)
 
 
-def random_derangement(xs: list, retries=100):
+def random_assignment(owners: list, slot_owners: list, max_probes: int = 32) -> list[int]:
+    """
+    Random permutation perm of the items s.t. no slot j gets an item of its own owner (owners[perm[j]] != slot_owners[j]).
+    Shuffles once and repairs every conflict by a swap with a random compatible slot: expected O(n) as long as
+    no owner has a large share of the items and slots. Raises ValueError if no such permutation exists.
+    """
+    n = len(owners)
+    if len(slot_owners) != n:
+        raise ValueError(f"random_assignment: {n} items for {len(slot_owners)} slots.")
+    # Items of an owner can go to every slot of the other owners (Hall's condition)
+    num_items, num_slots = Counter(owners), Counter(slot_owners)
+    for owner, count in num_items.items():
+        if count > n - num_slots[owner]:
+            raise ValueError(f"random_assignment: Impossible, {count} items of one owner for {n - num_slots[owner]} slots of other owners.")
+
+    perm = list(range(n))
+    random.shuffle(perm)
+    for j in range(n):
+        owner = slot_owners[j]
+        if owners[perm[j]] != owner:
+            continue
+        # Swap with a slot of another owner that holds an item of another owner (exists by the condition above)
+        compatible = lambda k: slot_owners[k] != owner and owners[perm[k]] != owner
+        for _ in range(max_probes):
+            k = random.randrange(n)
+            if compatible(k):
+                break
+        else:
+            k = random.choice([k for k in range(n) if compatible(k)])
+        perm[j], perm[k] = perm[k], perm[j]
+    return perm
+
+
+def random_derangement(xs: list):
     """ Creates a random derangement of xs (every element ends up at different index than before). """
     n = len(xs)
     if n < 2:
         raise ValueError(f"random_derangement only works with at least two elements.")
-    if retries == 0:
-        raise ValueError(f"random_derangement reached maximum retries.")
-    
-    free = set(range(n))
-    ys = {}
-    for i, x in enumerate(xs):
-        jchoice = free - {i}
-        if not jchoice:
-            return random_derangement(xs, retries - 1)
-        j = random.choice(list(jchoice))
-        ys[j] = x
-        free.remove(j)
-    # print(f"{retries} retries remaining.")
-    return [y for j, y in sorted(list(ys.items()), key=lambda item: item[0])]
-
-
-def random_chunk_derangement(xs: list, m: int, retries=100):
+    return [xs[i] for i in random_assignment(range(n), range(n))]
+
+
+def random_chunk_derangement(xs: list, m: int):
     """ Creates a random derangement of xs with no element ending up in the same chunk of size m. """
     n = len(xs)
     if n < 2:
         raise ValueError(f"random_chunk_derangement only works with at least two elements.")
     if m == 0 or m > n / 2 or n % m != 0:
         raise ValueError(f"random_chunk_derangement: Invalid value for chunk size m.")
-    if retries == 0:
-        raise ValueError(f"random_chunk_derangement reached maximum retries.")
-    
-    free = set(range(n))
-    ys = {}
-    for i, x in enumerate(xs):
-        k = i // m
-        jchoice = free - set(range(k * m, (k + 1) * m))
-        if not jchoice:
-            return random_chunk_derangement(xs, m)
-        j = random.choice(list(jchoice))
-        ys[j] = x
-        free.remove(j)
-    # print(f"{retries} retries remaining.")
-    return [y for j, y in sorted(list(ys.items()), key=lambda item: item[0])]
-
-
+    chunks = [i // m for i in range(n)]
+    return [xs[i] for i in random_assignment(chunks, chunks)]
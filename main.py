@@ -2,15 +2,17 @@
 
 from dataclasses import dataclass
 from enum import Enum
+import functools
 import json
+import importlib
+from threading import Thread
 from typing import Any
-import requests
 import time
 
-from lib.generator import assign_topics, generate_presentations
-from lib.google_images import GoogleImage, google_image_search
-from lib.markdown import parse_md_outline
-from lib.pptx_factory import make_pptx
+# The generation modules (OpenAI, python-pptx, PIL, ...) are imported on first use, s.t. watching a session starts quickly
+from lib.scheduler import StageScheduler
+from lib.session_watcher import WATCH_MODES, SessionWatcher, session_state
+from lib.tracing import tracing
 from lib.utils import *
 from lib.config import *
 from lib.types import *
@@ -18,33 +20,48 @@ from lib.types import *
 import argparse
 
 
-def backend_mainloop(session_id: str):
-    if not re.match(r"^[A-Za-z0-9\-]+$", session_id):
-        raise ValueError("Invalid session ID.")
-    
-    url = f"{os.getenv('FRONTEND_URL')}/api/session/{session_id}"
-
-    while True:
-        res = requests.get(url)
-        res_data = res.json()
-        if not res.ok:
-            if "error" in res_data:
-                print(f"Error {res.status_code}: {res_data['error']['message']}")
-            raise ValueError(f"Request failed (status code {res.status_code})")
-        session = res_data["session"]
-        session_state = [s for s in SessionState if session["state"] == s.value][0]
-
-        # session = {camel_case(k): v for k, v in session.items()}
-
-        print(f"Session state: {session_state.name}")
-        if session_state == SessionState.CLOSED:
-            generate_from_api(session)
+LANGUAGE = "de"
+
+
+def backend_mainloop(session_id: str,
+                     watch_mode: str = None,
+                     speculative: bool = False,
+                     launch: bool = True,
+                     scheduler: StageScheduler = None):  # Shared by all sessions of the daemon (see lib/daemon.py)
+    # Reacts as soon as the host closes the session (push-based if the frontend supports it)
+    watcher = SessionWatcher(session_id=session_id, mode=watch_mode)
+    # Optionally prepare the presentations while players are still entering topics
+    speculator = None
+    if speculative:
+        from lib.speculation import Speculator
+        speculator = Speculator(language=LANGUAGE, scheduler=scheduler)
+    else:
+        # Load the generation modules while the players are still entering topics
+        Thread(target=importlib.import_module, args=("lib.generator",), daemon=True).start()
+
+    for session in watcher.updates():
+        state = session_state(session)
+        print(f"Session state: {state.name}")
+        if state == SessionState.READY and speculator is not None:
+            speculator.update(session)
+        if state == SessionState.CLOSED:
             break
-        
-        time.sleep(3)
+
+    # session = {camel_case(k): v for k, v in session.items()}
+
+    if speculator is not None:
+        presentations = speculator.finalize(session)
+        return generate_from_api(session, presentations=presentations, launch=launch, scheduler=scheduler,
+                                 search_planner=speculator.search_planner)
+    return generate_from_api(session, launch=launch, scheduler=scheduler)
 
 
-def generate_from_api(session: dict):
+def generate_from_api(session: dict,
+                      presentations: list = None,  # Prepared by speculation
+                      instruction_pool: list[str] = None,
+                      launch: bool = True,  # Start the slideshows in PowerPoint
+                      **kwargs):  # Passed on to generate_presentations (e.g. scheduler, search_planner, on_presentation_ready)
+    from lib.generator import generate_presentations
     
     players = [p for p in session["players"] if p["topics"]]
     player_names = [p["name"] for p in players]
@@ -59,23 +76,45 @@ def generate_from_api(session: dict):
     
     topic_groups = [[t["name"] for t in p["topics"]] for p in players]
 
-    generate_presentations(player_names=player_names,
-                           players=players,
-                           topic_groups=topic_groups,
-                           openai_images=True,
-                           google_images=True,
-                           launch_first=True,
-                           launch_all=True,
-                           language="de")
+    # One trace per session (tmp/traces), see lib/tracing.py
+    with tracing(session_id=session.get("id", None) or players[0]["sessionId"], num_players=len(players)):
+        return generate_presentations(player_names=player_names,
+                                      players=players,
+                                      topic_groups=topic_groups,
+                                      openai_images=True,
+                                      google_images=True,
+                                      launch_first=launch,
+                                      launch_all=launch,
+                                      language=LANGUAGE,
+                                      presentations=presentations,
+                                      instruction_pool=instruction_pool,
+                                      **kwargs)
 
 
 if __name__ == "__main__":
 
     # Init communication with API
     parser = argparse.ArgumentParser("main.py")
-    parser.add_argument("session_id", help="The ID of the session to be fetched via the API.", type=str)
+    parser.add_argument("session_id", help="The ID of the session to be fetched via the API (with --serve: any number of sessions to start with).", type=str, nargs="*")
+    parser.add_argument("--watch", help="How to watch the session for changes.", choices=WATCH_MODES, default=None)
+    parser.add_argument("--speculative", help="Prepare presentations while the session is still open.", action="store_true")
+    parser.add_argument("--serve", help="Run as daemon, accepting sessions via HTTP (POST /sessions).", action="store_true")
+    parser.add_argument("--host", help="Host of the daemon's HTTP endpoint.", type=str, default=None)
+    parser.add_argument("--port", help="Port of the daemon's HTTP endpoint.", type=int, default=None)
+    parser.add_argument("--max-sessions", help="Sessions handled concurrently by the daemon.", type=int, default=None)
+    parser.add_argument("--launch", help="Launch the slideshows in daemon mode as well.", action="store_true")
     args = parser.parse_args()
-    backend_mainloop(session_id=args.session_id)
+    if args.serve:
+        from lib.daemon import SessionDaemon
+        daemon = SessionDaemon(run_session=functools.partial(backend_mainloop, watch_mode=args.watch, speculative=args.speculative, launch=args.launch),
+                               max_sessions=args.max_sessions)
+        for session_id in args.session_id:
+            daemon.submit(session_id)
+        daemon.serve(host=args.host, port=args.port)
+    elif len(args.session_id) == 1:
+        backend_mainloop(session_id=args.session_id[0], watch_mode=args.watch, speculative=args.speculative)
+    else:
+        parser.error("Give exactly one session ID, or run as daemon (--serve).")
     
     # Import topics from text file, comma-separated
     # with open(TEMPLATE_DIR / "topics" / "raimund.txt", "r", encoding="utf8") as f: